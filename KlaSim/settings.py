@@ -122,6 +122,27 @@ USE_TZ = True
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/4.0/howto/static-files/
 
+# Cache used for OpenAI key checks. With several worker processes set
+# CACHE_DIR (or configure a shared backend such as Redis or Memcached) so
+# that the checks are shared by every process.
+if os.environ.get("CACHE_DIR"):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+            "LOCATION": os.environ["CACHE_DIR"],
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+
+# Seconds a process uses its memoized configuration before checking the
+# version stored in the database for changes made by other processes
+CONFIG_CHECK_INTERVAL = float(os.environ.get("CONFIG_CHECK_INTERVAL", "2"))
+
 # Session cleanup configuration
 SESSION_LIFETIME_DAYS = int(os.environ.get('SESSION_LIFETIME_DAYS', '7'))
 STATIC_URL = 'static/'
@@ -136,3 +157,50 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # OpenAI configuration
 OPENAI_MODEL = os.environ.get("OPENAI_MODEL", "gpt-4-1106-preview")
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
+# Upper limit of prompt tokens; the model's context window also applies
+OPENAI_PROMPT_TOKEN_BUDGET = int(os.environ.get("OPENAI_PROMPT_TOKEN_BUDGET", "12000"))
+
+# Seconds a validated (or rejected) OpenAI key is cached
+OPENAI_KEY_CACHE_TTL = int(os.environ.get("OPENAI_KEY_CACHE_TTL", "3600"))
+OPENAI_KEY_CACHE_NEGATIVE_TTL = int(os.environ.get("OPENAI_KEY_CACHE_NEGATIVE_TTL", "60"))
+# Validate keys in a background thread instead of blocking page rendering
+OPENAI_KEY_CHECK_BACKGROUND = True
+
+# Shared OpenAI clients: timeouts in seconds and connection pool size
+OPENAI_CONNECT_TIMEOUT = float(os.environ.get("OPENAI_CONNECT_TIMEOUT", "5"))
+OPENAI_READ_TIMEOUT = float(os.environ.get("OPENAI_READ_TIMEOUT", "120"))
+OPENAI_MAX_CONNECTIONS = 100
+# Retries of 429/5xx responses and connection errors with jittered backoff
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", "4"))
+OPENAI_RETRY_BASE_DELAY = 1.0
+OPENAI_RETRY_MAX_DELAY = 30.0
+# Completion tokens counted against the tokens-per-minute limit when a
+# request does not set max_tokens (the limits are set in AppConfig)
+RATE_LIMIT_COMPLETION_TOKENS = 1000
+# Answer cache (enabled in AppConfig): lifetime in seconds and size limit
+LLM_CACHE_TTL = int(os.environ.get("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+LLM_CACHE_MAX_BYTES = int(os.environ.get("LLM_CACHE_MAX_BYTES", str(50 * 1024 * 1024)))
+
+# Processes that extract the PDF and docx files of a session in parallel
+# (0 or 1 extracts them one after another). By default one core is left to
+# the calling process, so a single CPU extracts in-process
+EXTRACT_WORKERS = int(
+    os.environ.get("EXTRACT_WORKERS", str(max(0, min(4, (os.cpu_count() or 1) - 1))))
+)
+# Extract large PDFs page-parallel with this many processes (0 disables)
+PDF_EXTRACT_WORKERS = int(os.environ.get("PDF_EXTRACT_WORKERS", "0"))
+PDF_PARALLEL_MIN_PAGES = 50
+PDF_PAGES_PER_TASK = 8
+
+# Number of completions requested in parallel per simulation
+SIMULATION_CONCURRENCY = int(os.environ.get("SIMULATION_CONCURRENCY", "6"))
+# Answer each exam task with its own completion instead of the whole exam.
+# Every task request repeats the whole prompt, so this is opt-in
+SIMULATION_PER_TASK = os.environ.get("SIMULATION_PER_TASK", "0") == "1"
+# Seconds a simulation may take in total before it fails (0 disables)
+SIMULATION_DEADLINE = int(os.environ.get("SIMULATION_DEADLINE", "480"))
+
+# Background simulation worker (manage.py simulation_worker)
+SIMULATION_WORKER_CONCURRENCY = int(os.environ.get("SIMULATION_WORKER_CONCURRENCY", "2"))
+# Seconds without progress after which a running job is considered abandoned
+SIMULATION_JOB_TIMEOUT = int(os.environ.get("SIMULATION_JOB_TIMEOUT", "600"))
@@ -0,0 +1,266 @@
+"""Compare WSGI and ASGI throughput of simulations.
+
+Prepares ``--simulations`` sessions in a temporary database and starts the same
+number of concurrent simulations against
+
+* gunicorn serving ``KlaSim.wsgi`` with one worker and ``--threads`` threads;
+  the sessions are submitted with ``POST run/`` and processed by a
+  ``simulation_worker`` with ``--worker-concurrency`` runners, and each is
+  timed until its job is finished,
+* uvicorn serving ``KlaSim.asgi`` with a single worker, streaming each
+  simulation with ``POST run/stream/`` until its ``done`` event,
+
+both talking to the local fake LLM server. Requires ``gunicorn`` and
+``uvicorn``. Run from the repository root::
+
+    python -m benchmarks.bench_asgi --simulations 20 --latency 0.5
+"""
+
+from __future__ import annotations
+
+import argparse
+import http.client
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from benchmarks.fake_openai import FakeOpenAIServer
+from benchmarks.utils import ROOT, make_exam
+
+CSRF_TOKEN = "b" * 32
+
+
+def prepare(bench_dir: Path, count: int) -> list:
+    """Create ``count`` sessions with uploaded files.
+
+    Returns ``(session_id, session_key)`` of each session.
+    """
+    os.environ["KLASIM_BENCH_DIR"] = str(bench_dir)
+    os.environ["DJANGO_SETTINGS_MODULE"] = "benchmarks.server_settings"
+    sys.path.insert(0, str(ROOT))
+    import django
+
+    django.setup()
+    from django.contrib.sessions.backends.db import SessionStore
+    from django.core.files import File
+    from django.core.management import call_command
+
+    from config.models import AppConfig
+    from simulator.models import ContextFile, ExamFile, Session
+
+    call_command("migrate", verbosity=0)
+    config = AppConfig.get_solo()
+    config.openai_api_key = "bench"
+    config.setup_complete = True
+    config.save()
+
+    exam_path = make_exam(bench_dir / "exam.docx")
+    context_path = bench_dir / "context.txt"
+    context_path.write_text("Kontextwissen " * 200, encoding="utf-8")
+    cookies = []
+    for i in range(count):
+        session_id = Session.ensure(f"bench{i}").session_id
+        with open(exam_path, "rb") as fh:
+            ExamFile.objects.create(file=File(fh, name="exam.docx"), session_id=session_id)
+        with open(context_path, "rb") as fh:
+            ContextFile.objects.create(file=File(fh, name="context.txt"), session_id=session_id)
+        store = SessionStore()
+        store["session_id"] = session_id
+        store.create()
+        cookies.append((session_id, store.session_key))
+    return cookies
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server on port {port} did not start")
+
+
+def post(port: int, path: str, session_key: str) -> tuple:
+    """Send an empty form to ``path``; return ``(status, body)``."""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=600)
+    conn.request(
+        "POST",
+        path,
+        body="",
+        headers={
+            "Cookie": f"sessionid={session_key}; csrftoken={CSRF_TOKEN}",
+            "X-CSRFToken": CSRF_TOKEN,
+            "Content-Type": "application/x-www-form-urlencoded",
+        },
+    )
+    response = conn.getresponse()
+    body = response.read().decode()
+    conn.close()
+    return response.status, body
+
+
+def stream_all(port: int, cookies: list) -> list:
+    """Stream one simulation per session; return ``(seconds, succeeded)`` each."""
+
+    def simulate(session_key: str) -> tuple:
+        start = time.perf_counter()
+        _, body = post(port, "/run/stream/", session_key)
+        return time.perf_counter() - start, "event: done" in body
+
+    with ThreadPoolExecutor(max_workers=len(cookies)) as pool:
+        return list(pool.map(simulate, [key for _, key in cookies]))
+
+
+def queue_all(port: int, cookies: list, timeout: float = 600.0) -> list:
+    """Queue one simulation per session and wait until all jobs are finished.
+
+    Returns ``(seconds, succeeded)`` of each session, counted from the start
+    of the submissions to the end of its job.
+    """
+    from django.db import connection
+    from django.utils import timezone
+
+    from simulator.models import SimulationJob
+
+    since = timezone.now()
+    with ThreadPoolExecutor(max_workers=len(cookies)) as pool:
+        responses = list(pool.map(lambda cookie: post(port, "/run/", cookie[1]), cookies))
+    # The view redirects to the index page once the job is queued
+    session_ids = [sid for (sid, _), (status, _) in zip(cookies, responses) if status == 302]
+
+    deadline = time.monotonic() + timeout
+    jobs = {}
+    while len(jobs) < len(session_ids) and time.monotonic() < deadline:
+        time.sleep(0.2)
+        finished = SimulationJob.objects.filter(
+            session_id__in=session_ids, created__gte=since, finished__isnull=False
+        )
+        jobs = {job.session_id: job for job in finished}
+    connection.close()
+    outcomes = [
+        ((job.finished - since).total_seconds(), job.status == SimulationJob.STATUS_DONE)
+        for job in jobs.values()
+    ]
+    # Sessions that were not queued or did not finish in time
+    failed = len(cookies) - len(outcomes)
+    return outcomes + [(timeout, False)] * failed
+
+
+def start_worker(command: list, env: dict, timeout: float = 60.0) -> subprocess.Popen:
+    """Start ``simulation_worker`` and wait until it polls for jobs."""
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.PIPE, text=True)
+    ready = threading.Event()
+
+    def drain() -> None:
+        for line in process.stdout:
+            if "started" in line:
+                ready.set()
+
+    threading.Thread(target=drain, daemon=True).start()
+    if not ready.wait(timeout):
+        process.terminate()
+        raise RuntimeError("simulation_worker did not start")
+    return process
+
+
+def run_load(command: list, worker: list | None, env: dict, port: int, load) -> dict:
+    """Start the server (and worker), run ``load(port)`` and summarize it."""
+    processes = [subprocess.Popen(command, cwd=ROOT, env=env)]
+    try:
+        if worker is not None:
+            processes.append(start_worker(worker, env))
+        wait_for_port(port)
+        start = time.perf_counter()
+        outcomes = load(port)
+        wall = time.perf_counter() - start
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+    latencies = sorted(seconds for seconds, _ in outcomes)
+    return {
+        "wall": wall,
+        "throughput": len(outcomes) / wall,
+        "p50": latencies[len(latencies) // 2],
+        "p95": latencies[max(0, int(len(latencies) * 0.95) - 1)],
+        "failed": sum(1 for _, ok in outcomes if not ok),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--simulations", type=int, default=20, help="Concurrent simulations")
+    parser.add_argument("--latency", type=float, default=0.5, help="Fake completion time in seconds")
+    parser.add_argument("--threads", type=int, default=4, help="Threads of the WSGI worker")
+    parser.add_argument(
+        "--worker-concurrency",
+        type=int,
+        default=4,
+        help="Simulations run in parallel by simulation_worker behind WSGI",
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="klasim-load-") as tmp, FakeOpenAIServer(
+        latency=args.latency
+    ) as llm:
+        cookies = prepare(Path(tmp), args.simulations)
+        env = {
+            **os.environ,
+            "DJANGO_SETTINGS_MODULE": "benchmarks.server_settings",
+            "KLASIM_BENCH_DIR": tmp,
+            "OPENAI_BASE_URL": llm.base_url,
+        }
+        worker = [
+            sys.executable, "manage.py", "simulation_worker",
+            "--concurrency", str(args.worker_concurrency), "--poll-interval", "0.2",
+        ]
+        modes = {
+            f"WSGI ({args.threads} threads)": (
+                lambda port: [
+                    sys.executable, "-m", "gunicorn", "KlaSim.wsgi:application",
+                    "--workers", "1", "--threads", str(args.threads),
+                    "--bind", f"127.0.0.1:{port}", "--timeout", "600", "--log-level", "warning",
+                ],
+                worker,
+                lambda port: queue_all(port, cookies),
+            ),
+            "ASGI (1 worker)": (
+                lambda port: [
+                    sys.executable, "-m", "uvicorn", "KlaSim.asgi:application",
+                    "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning",
+                ],
+                None,
+                lambda port: stream_all(port, cookies),
+            ),
+        }
+        results = {}
+        for label, (command, worker_command, load) in modes.items():
+            port = free_port()
+            results[label] = run_load(command(port), worker_command, env, port, load)
+
+    print(f"{args.simulations} simulations, {args.latency}s per completion")
+    print(f"{'':>18}  {'wall':>8}  {'sims/s':>7}  {'p50':>7}  {'p95':>7}  failed")
+    for label, stats in results.items():
+        print(
+            f"{label:>18}  {stats['wall']:7.2f}s  {stats['throughput']:7.2f}  "
+            f"{stats['p50']:6.2f}s  {stats['p95']:6.2f}s  {stats['failed']:>6}"
+        )
+
+
+if __name__ == "__main__":
+    main()
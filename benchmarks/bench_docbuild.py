@@ -0,0 +1,99 @@
+"""Compare per-level re-parsing with the shared exam template.
+
+The legacy path opens the exam once per level and resolves
+``doc.paragraphs`` for every inserted segment, as the builder did before
+``simulator.docbuild``. Both paths build the three level documents for an
+exam with placeholders and for one where the AI chooses the positions.
+
+Run from the repository root::
+
+    python -m benchmarks.bench_docbuild --paragraphs 500
+"""
+
+from __future__ import annotations
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.utils import make_exam, setup_django
+
+SEGMENTS = 50
+
+
+def legacy_build(path: Path, levels, colors, placeholders: bool) -> None:
+    from docx import Document
+
+    from simulator.docbuild import insert_paragraph_after, to_bytes
+
+    def insert_answer_after(para, level, text, color):
+        head = insert_paragraph_after(para, f"{level.title()} Antwort:", style="Heading2")
+        run = insert_paragraph_after(head, "").add_run(text)
+        run.font.color.rgb = color
+
+    for level in levels:
+        doc = Document(path)
+        if placeholders:
+            for para in doc.paragraphs:
+                if "[Antwort]" in para.text:
+                    para.text = para.text.replace("[Antwort]", "").rstrip()
+                    insert_answer_after(para, level, "Antwort", colors[level])
+        else:
+            numbered = "\n".join(f"{i}: {p.text}" for i, p in enumerate(doc.paragraphs))
+            assert numbered
+            step = max(1, len(doc.paragraphs) // SEGMENTS)
+            for idx in range(len(doc.paragraphs) - 1, 0, -step):
+                if idx > 0 and idx <= len(doc.paragraphs):
+                    idx -= 1
+                insert_answer_after(doc.paragraphs[idx], level, "Antwort", colors[level])
+        to_bytes(doc)
+
+
+def template_build(path: Path, levels, colors, placeholders: bool) -> None:
+    from simulator.docbuild import ExamTemplate, to_bytes
+
+    template = ExamTemplate(path)
+    for level in levels:
+        doc, paragraphs = template.copy()
+        if placeholders:
+            template.fill_placeholders(paragraphs, level, "Antwort", colors[level])
+        else:
+            assert template.numbered()
+            step = max(1, len(paragraphs) // SEGMENTS)
+            segments = [(idx, "Antwort") for idx in range(len(paragraphs) - 1, 0, -step)]
+            template.insert_segments(paragraphs, segments, level, colors[level])
+        to_bytes(doc)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--paragraphs", type=int, default=500, help="Approximate exam length")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    setup_django()
+    from simulator.services import LEVEL_COLORS, LEVELS
+
+    tasks = 50
+    filler = max(0, args.paragraphs // tasks - 2)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = make_exam(Path(tmp) / "exam.docx", tasks, filler)
+        for label, placeholders in (("placeholders", True), ("placement", False)):
+            timings = {}
+            for name, build in (("legacy", legacy_build), ("template", template_build)):
+                best = float("inf")
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    build(path, LEVELS, LEVEL_COLORS, placeholders)
+                    best = min(best, time.perf_counter() - start)
+                timings[name] = best
+            print(
+                f"{label:>12}: legacy {timings['legacy']:.3f}s, "
+                f"template {timings['template']:.3f}s, "
+                f"speedup {timings['legacy'] / timings['template']:.2f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Compare sequential and process-parallel text extraction of a session.
+
+A synthetic session of ten files (an exam, five PDFs and four docx files) is
+extracted with ``extract_texts`` once in the calling process and once with a
+process pool. The extraction cache is cleared before every run, so each run
+parses all files. The time spent per file is printed for the parallel run.
+
+Run from the repository root::
+
+    python -m benchmarks.bench_extraction --workers 4 --pages 40
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.utils import make_exam, make_pdf, setup_django, test_database
+
+PDF_FILES = 5
+DOCX_FILES = 4
+
+
+def make_session(directory: Path, pages: int) -> list:
+    from docx import Document
+
+    paths = [make_exam(directory / "exam.docx", tasks=20, filler=10)]
+    for i in range(PDF_FILES):
+        paths.append(make_pdf(directory / f"book{i}.pdf", pages=pages, lines=40 + i))
+    for i in range(DOCX_FILES):
+        doc = Document()
+        for j in range(pages * 40):
+            doc.add_paragraph(f"Skript {i}, Absatz {j}: Lorem ipsum dolor sit amet.")
+        path = directory / f"script{i}.docx"
+        doc.save(path)
+        paths.append(path)
+    return paths
+
+
+def run(paths: list, workers: int, repeat: int):
+    from simulator.extraction import extract_texts
+    from simulator.models import ExtractedText
+
+    best, results = float("inf"), None
+    for _ in range(repeat):
+        ExtractedText.objects.all().delete()
+        start = time.perf_counter()
+        extracted = extract_texts([(str(path), None) for path in paths], workers=workers)
+        elapsed = time.perf_counter() - start
+        if elapsed < best:
+            best, results = elapsed, extracted
+    return best, results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--pages", type=int, default=40, help="Pages per PDF")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    setup_django()
+    with tempfile.TemporaryDirectory() as tmp, test_database():
+        paths = make_session(Path(tmp), args.pages)
+        sequential, _ = run(paths, 0, args.repeat)
+        parallel, results = run(paths, args.workers, args.repeat)
+
+    for item in results:
+        print(f"{Path(item.path).name:>14}: {item.seconds:.3f}s, {len(item.text)} chars")
+    print(
+        f"{len(paths)} files: sequential {sequential:.3f}s, "
+        f"{args.workers} workers {parallel:.3f}s, speedup {sequential / parallel:.2f}x"
+    )
+
+
+if __name__ == "__main__":
+    main()
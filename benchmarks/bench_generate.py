@@ -0,0 +1,63 @@
+"""Compare sequential, concurrent and per-task generation against a fake LLM.
+
+Run from the repository root::
+
+    python -m benchmarks.bench_generate --latency 0.5
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import time
+from pathlib import Path
+
+from benchmarks.fake_openai import FakeOpenAIServer
+from benchmarks.utils import make_exam, setup_django, test_database
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency", type=float, default=0.5, help="Fake round-trip in seconds")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.conf import settings
+    from django.core.files import File
+    from django.test import override_settings
+
+    from simulator.models import ContextFile, ExamFile, Session
+    from simulator.services import generate_ai_results
+
+    with FakeOpenAIServer(latency=args.latency) as server, test_database():
+        os.environ["OPENAI_BASE_URL"] = server.base_url
+        media = Path(settings.MEDIA_ROOT)
+        exam_path = make_exam(media / "exam.docx")
+        context_path = media / "context.txt"
+        context_path.write_text("Kontextwissen " * 200, encoding="utf-8")
+
+        session_id = Session.ensure("bench").session_id
+        with open(exam_path, "rb") as fh:
+            ExamFile.objects.create(file=File(fh, name="exam.docx"), session_id=session_id)
+        with open(context_path, "rb") as fh:
+            ContextFile.objects.create(file=File(fh, name="context.txt"), session_id=session_id)
+
+        timings = {}
+        modes = (("sequential", 1, False), ("concurrent", 3, False), ("per task", 6, True))
+        for label, workers, per_task in modes:
+            with override_settings(SIMULATION_CONCURRENCY=workers, SIMULATION_PER_TASK=per_task):
+                best = float("inf")
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    generate_ai_results(session_id, api_key="bench")
+                    best = min(best, time.perf_counter() - start)
+            timings[label] = best
+            print(f"{label:>10}: {best:.3f}s (best of {args.repeat})")
+
+        for label in ("concurrent", "per task"):
+            print(f"speedup ({label}): {timings['sequential'] / timings[label]:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""A tiny local stand-in for the OpenAI HTTP API used by the benchmarks.
+
+Only the endpoints KlaSim touches are implemented. Every completion sleeps for
+``latency`` seconds to mimic a real model round-trip; streamed completions
+spread the delay over their chunks.
+"""
+
+from __future__ import annotations
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def _completion(content: str, prompt_chars: int) -> dict:
+    return {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": "fake-model",
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": {
+            "prompt_tokens": prompt_chars // 4,
+            "completion_tokens": len(content) // 4,
+            "total_tokens": (prompt_chars + len(content)) // 4,
+        },
+    }
+
+
+def _chunk(delta: dict, usage: dict | None = None) -> bytes:
+    payload = {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": "fake-model",
+        "choices": [{"index": 0, "delta": delta, "finish_reason": None}] if delta else [],
+        "usage": usage,
+    }
+    return f"data: {json.dumps(payload)}\n\n".encode()
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+
+class FakeOpenAIServer:
+    """Serve fake chat completions on ``127.0.0.1`` in a background thread."""
+
+    def __init__(self, latency: float = 0.5, answer: str = "Simulierte Antwort."):
+        self.latency = latency
+        self.answer = answer
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):  # silence request logging
+                pass
+
+            def _send_json(self, payload: dict) -> None:
+                body = json.dumps(payload).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self._send_json({"object": "list", "data": [{"id": "fake-model", "object": "model"}]})
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                payload = json.loads(self.rfile.read(length) or b"{}")
+                server.requests += 1
+                prompt_chars = sum(len(str(m.get("content", ""))) for m in payload.get("messages", []))
+                if payload.get("stream"):
+                    self._stream(_completion(server.answer, prompt_chars))
+                    return
+                time.sleep(server.latency)
+                self._send_json(_completion(server.answer, prompt_chars))
+
+            def _stream(self, completion: dict) -> None:
+                words = server.answer.split(" ")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                for i, word in enumerate(words):
+                    time.sleep(server.latency / len(words))
+                    text = word if i == 0 else f" {word}"
+                    self.wfile.write(_chunk({"content": text}))
+                self.wfile.write(_chunk({}, completion["usage"]))
+                self.wfile.write(b"data: [DONE]\n\n")
+
+        self._httpd = _Server(("127.0.0.1", 0), Handler)
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def __enter__(self) -> "FakeOpenAIServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
@@ -0,0 +1,24 @@
+"""Settings for the app servers started by :mod:`benchmarks.bench_asgi`.
+
+Database and media files live in ``KLASIM_BENCH_DIR`` so the benchmark never
+touches the development database.
+"""
+
+import os
+from pathlib import Path
+
+from KlaSim.settings import *  # noqa: F401,F403
+
+BENCH_DIR = Path(os.environ["KLASIM_BENCH_DIR"])
+
+DEBUG = False
+ALLOWED_HOSTS = ["127.0.0.1", "localhost"]
+DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": BENCH_DIR / "db.sqlite3",
+        # Concurrent simulations write progress at the same time
+        "OPTIONS": {"timeout": 30},
+    }
+}
+MEDIA_ROOT = BENCH_DIR / "media"
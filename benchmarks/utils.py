@@ -0,0 +1,89 @@
+"""Helpers shared by the benchmark scripts."""
+
+from __future__ import annotations
+
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def setup_django() -> None:
+    """Configure Django with a throw-away media directory."""
+    sys.path.insert(0, str(ROOT))
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "KlaSim.settings")
+    import django
+    from django.conf import settings
+
+    settings.MEDIA_ROOT = tempfile.mkdtemp(prefix="klasim-bench-")
+    django.setup()
+
+
+@contextmanager
+def test_database():
+    """Create a temporary test database for the duration of the block."""
+    from django.db import connection
+    from django.test.utils import setup_test_environment, teardown_test_environment
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+def make_exam(path: Path, tasks: int = 3, filler: int = 0) -> Path:
+    """Write an exam docx with ``tasks`` answer placeholders."""
+    from docx import Document
+
+    doc = Document()
+    for i in range(1, tasks + 1):
+        doc.add_paragraph(f"Aufgabe {i}: Erläutere den Sachverhalt {i}.")
+        for j in range(filler):
+            doc.add_paragraph(f"Material {i}.{j}: Lorem ipsum dolor sit amet.")
+        doc.add_paragraph("[Antwort]")
+    doc.save(path)
+    return path
+
+
+def make_pdf(path: Path, pages: int = 20, lines: int = 40) -> Path:
+    """Write a text PDF with ``pages`` pages of ``lines`` lines each."""
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # page tree, written once the page objects are known
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    kids = []
+    for page in range(pages):
+        text = "".join(
+            f"({page + 1}.{line}: Lorem ipsum dolor sit amet, consectetur adipiscing.) Tj T* "
+            for line in range(lines)
+        )
+        stream = f"BT /F1 10 Tf 12 TL 40 800 Td {text}ET".encode()
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % (len(objects))
+        )
+        kids.append(b"%d 0 R" % len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(kids), pages)
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1,
+        xref,
+    )
+    path.write_bytes(bytes(out))
+    return path
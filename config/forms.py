@@ -46,10 +46,25 @@ class SettingsForm(forms.ModelForm):
 
     class Meta:
         model = AppConfig
-        fields = ["openai_api_key", "language"]
+        fields = [
+            "openai_api_key",
+            "language",
+            "rate_limit_rpm",
+            "rate_limit_tpm",
+            "max_running_simulations",
+            "response_cache_enabled",
+            "prepare_on_upload",
+            "prepare_answers",
+        ]
         labels = {
             "openai_api_key": _("OpenAI API Key"),
             "language": _("Language"),
+            "rate_limit_rpm": _("Requests per minute"),
+            "rate_limit_tpm": _("Tokens per minute"),
+            "max_running_simulations": _("Simultaneous simulations"),
+            "response_cache_enabled": _("Cache AI answers"),
+            "prepare_on_upload": _("Prepare on upload"),
+            "prepare_answers": _("Request answers in advance"),
         }
 
     def save(self, commit=True):
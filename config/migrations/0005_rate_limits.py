@@ -0,0 +1,28 @@
+# Generated by Django 4.2.23 on 2026-10-18 13:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('config', '0004_increase_key_length'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appconfig',
+            name='max_running_simulations',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='appconfig',
+            name='rate_limit_rpm',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='appconfig',
+            name='rate_limit_tpm',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.23 on 2026-10-18 13:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('config', '0005_rate_limits'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appconfig',
+            name='response_cache_enabled',
+            field=models.BooleanField(default=False),
+        ),
+    ]
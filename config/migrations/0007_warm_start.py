@@ -0,0 +1,23 @@
+# Generated by Django 4.2.23 on 2026-10-18 13:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('config', '0006_response_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appconfig',
+            name='prepare_answers',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='appconfig',
+            name='prepare_on_upload',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.23 on 2026-10-18 14:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('config', '0007_warm_start'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appconfig',
+            name='version',
+            field=models.CharField(blank=True, editable=False, max_length=32),
+        ),
+    ]
@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+import uuid
+
 from django.db import models
 from django.contrib.auth.hashers import make_password, check_password
 
@@ -11,12 +13,36 @@ class AppConfig(models.Model):
     simulation_password_hash = models.CharField(max_length=128, blank=True)
     language = models.CharField(max_length=5, choices=[("en", "English"), ("de", "Deutsch")], default="en")
     setup_complete = models.BooleanField(default=False)
+    # Limits shared by all processes; 0 disables a limit
+    rate_limit_rpm = models.PositiveIntegerField(default=0)
+    rate_limit_tpm = models.PositiveIntegerField(default=0)
+    max_running_simulations = models.PositiveIntegerField(default=0)
+    response_cache_enabled = models.BooleanField(default=False)
+    # Prepare simulations in the background as soon as files are uploaded;
+    # with prepare_answers the AI answers are requested in advance as well
+    prepare_on_upload = models.BooleanField(default=False)
+    prepare_answers = models.BooleanField(default=False)
+    # Changed on every save of the configuration or a prompt; processes
+    # compare it to decide whether their memoized configuration is current
+    version = models.CharField(max_length=32, blank=True, editable=False)
+
+    def save(self, *args, **kwargs):
+        self.version = uuid.uuid4().hex
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None:
+            kwargs["update_fields"] = {*update_fields, "version"}
+        super().save(*args, **kwargs)
 
     @classmethod
     def get_solo(cls):
         config, _ = cls.objects.get_or_create(pk=1)
         return config
 
+    @classmethod
+    async def aget_solo(cls):
+        config, _ = await cls.objects.aget_or_create(pk=1)
+        return config
+
     def set_admin_password(self, raw_password: str) -> None:
         self.admin_password_hash = make_password(raw_password)
 
@@ -0,0 +1,34 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import AppConfig, PromptConfig
+from .utils import bump_config_version, expire_config_memo, invalidate_openai_key
+
+
+@receiver(post_save, sender=AppConfig)
+def reset_key_validation(sender, instance, update_fields=None, **kwargs):
+    """Force a fresh validation whenever the stored API key is saved."""
+    if update_fields is None or "openai_api_key" in update_fields:
+        invalidate_openai_key(instance.openai_api_key)
+
+
+@receiver(post_save, sender=AppConfig)
+@receiver(post_delete, sender=AppConfig)
+def reload_config(sender, created=False, **kwargs):
+    """Pick up a configuration saved by this process right away.
+
+    Other processes notice the new version within ``CONFIG_CHECK_INTERVAL``.
+    A newly created row is what ``get_config`` just loaded.
+    """
+    if not created:
+        expire_config_memo()
+
+
+@receiver(post_save, sender=PromptConfig)
+@receiver(post_delete, sender=PromptConfig)
+def reset_config_cache(sender, **kwargs):
+    """Make all processes reload the configuration after a prompt change.
+
+    Saving the ``AppConfig`` changes its version by itself.
+    """
+    bump_config_version()
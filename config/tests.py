@@ -1,7 +1,23 @@
-from django.test import TestCase
+import io
+import shutil
+import tempfile
+import zipfile
+from unittest import mock
+
+from django.test import TestCase, override_settings
 from django.urls import reverse
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.core.files.base import ContentFile
 from django.core.files.uploadedfile import SimpleUploadedFile
 from config.models import AppConfig
+from config.utils import (
+    acheck_openai_key,
+    check_openai_key,
+    get_config,
+    validate_openai_key,
+)
 
 class SessionViewsTest(TestCase):
     def setUp(self):
@@ -19,3 +35,261 @@ class SessionViewsTest(TestCase):
     def test_cleanup_redirect(self):
         response = self.client.post(reverse('cleanup_sessions'))
         self.assertEqual(response.status_code, 302)
+
+    def test_metrics_view(self):
+        from simulator.models import LLMCall, SimulationRun
+
+        run = SimulationRun.objects.create(
+            session_id="s1",
+            model="m",
+            status="done",
+            duration=2.0,
+            stages={"llm": 1.5},
+            files=[
+                {"name": "a.pdf", "type": ".pdf", "seconds": 0.8, "chars": 10, "cached": False},
+                {"name": "b.pdf", "type": ".pdf", "seconds": 0.0, "chars": 10, "cached": True},
+            ],
+        )
+        LLMCall.objects.create(
+            run=run, purpose="answer", model="m", latency=1.5, outcome="ok", prompt_tokens=10
+        )
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["metrics"]["calls"][0]["prompt_tokens"], 10)
+        self.assertEqual(response.context["metrics"]["duration"]["p95"], 2.0)
+        self.assertEqual(
+            response.context["metrics"]["files"], [{"type": ".pdf", "count": 1, "p50": 0.8, "p95": 0.8}]
+        )
+
+    def test_settings_show_and_flush_response_cache(self):
+        from simulator.models import CachedResponse
+        from simulator.response_cache import store
+
+        store("k" * 64, "m", "Antwort")
+        response = self.client.get(reverse('settings'))
+        self.assertEqual(response.context["cache_stats"]["entries"], 1)
+        response = self.client.post(reverse('flush_response_cache'))
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(CachedResponse.objects.exists())
+
+    def test_batch_view_queues_selected_sessions(self):
+        from simulator.models import ContextFile, ExamFile, Session, SimulationJob
+
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        override = override_settings(MEDIA_ROOT=media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+        Session.ensure("s1")
+        ExamFile.objects.create(file=ContentFile(b"x", name="exam.docx"), session_id="s1")
+        ContextFile.objects.create(file=ContentFile(b"x", name="c.txt"), session_id="s1")
+        Session.refresh("s1")
+        # Context files are optional
+        Session.ensure("s2")
+        ExamFile.objects.create(file=ContentFile(b"y", name="exam.docx"), session_id="s2")
+        Session.refresh("s2")
+        response = self.client.get(reverse('batch'))
+        self.assertEqual(
+            sorted(s.session_id for s in response.context["sessions"]), ["s1", "s2"]
+        )
+        response = self.client.post(reverse('batch'), {"session": ["s1"], "mode": "queue"})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(SimulationJob.objects.get().session_id, "s1")
+
+
+class KeyValidationCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_result_is_cached(self):
+        with mock.patch("config.utils.validate_openai_key", return_value=True) as validate:
+            self.assertTrue(check_openai_key("key"))
+            self.assertTrue(check_openai_key("key"))
+        self.assertEqual(validate.call_count, 1)
+
+    def test_invalid_key_is_cached(self):
+        with mock.patch("config.utils.validate_openai_key", return_value=False) as validate:
+            self.assertFalse(check_openai_key("bad"))
+            self.assertFalse(check_openai_key("bad", blocking=False))
+        self.assertEqual(validate.call_count, 1)
+
+    @override_settings(OPENAI_KEY_CHECK_BACKGROUND=True)
+    def test_non_blocking_miss_returns_none(self):
+        with mock.patch("config.utils._refresh_in_background") as refresh:
+            self.assertIsNone(check_openai_key("key", blocking=False))
+        refresh.assert_called_once_with("key")
+
+    def test_saving_config_invalidates_key(self):
+        with mock.patch("config.utils.validate_openai_key", return_value=True) as validate:
+            check_openai_key("key")
+            config = AppConfig.get_solo()
+            config.openai_api_key = "key"
+            config.save()
+            check_openai_key("key")
+        self.assertEqual(validate.call_count, 2)
+
+    def test_validation_does_not_register_a_client(self):
+        from simulator import llm
+
+        with mock.patch("config.utils.openai.OpenAI") as client_cls:
+            self.assertTrue(validate_openai_key("probe"))
+        client_cls.assert_called_once_with(api_key="probe")
+        client_cls.return_value.__exit__.assert_called_once()
+        self.assertFalse(any(key[0] == "probe" for key in llm._clients))
+
+    async def test_async_check_shares_cache(self):
+        with mock.patch("config.utils.avalidate_openai_key", return_value=True) as validate:
+            self.assertTrue(await acheck_openai_key("key"))
+            self.assertTrue(await acheck_openai_key("key"))
+        self.assertEqual(validate.call_count, 1)
+        self.assertTrue(check_openai_key("key", blocking=False))
+
+    def test_api_key_view_requires_login(self):
+        with mock.patch("config.utils.avalidate_openai_key", return_value=True):
+            response = self.client.post(reverse("test_key"), {"api_key": "key"})
+            self.assertEqual(response.status_code, 302)
+            session = self.client.session
+            session["admin_logged_in"] = True
+            session.save()
+            response = self.client.post(reverse("test_key"), {"api_key": "key"})
+        self.assertEqual(response.json(), {"ok": True})
+
+
+
+class SessionListingTest(TestCase):
+    def setUp(self):
+        config = AppConfig.get_solo()
+        config.set_admin_password('pw')
+        config.setup_complete = True
+        config.save()
+        self.client.post(reverse('login'), {'password': 'pw'})
+
+    def _create_sessions(self, count):
+        from simulator.models import ExamFile, Session
+
+        for i in range(count):
+            sid = Session.ensure(f"{Session.objects.count():04d}").session_id
+            ExamFile.objects.create(file=f"exam_files/{sid}.docx", session_id=sid)
+            Session.refresh(sid)
+
+    def _count_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(reverse('sessions'))
+        return len(ctx.captured_queries)
+
+    def test_query_count_does_not_grow_with_sessions(self):
+        self._create_sessions(1)
+        few = self._count_queries()
+        self._create_sessions(10)
+        self.assertEqual(self._count_queries(), few)
+
+    def test_keyset_pagination(self):
+        from config import views
+
+        self._create_sessions(5)
+        with mock.patch.object(views, "SESSIONS_PAGE_SIZE", 2):
+            seen = []
+            url = reverse('sessions')
+            while url:
+                response = self.client.get(url)
+                seen += [s["id"] for s in response.context["sessions"]]
+                query = response.context["next_page_query"]
+                url = f"{reverse('sessions')}?{query}" if query else None
+        self.assertEqual(seen, ["0004", "0003", "0002", "0001", "0000"])
+
+
+class SessionDownloadTest(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        override = override_settings(MEDIA_ROOT=self.media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        config = AppConfig.get_solo()
+        config.set_admin_password('pw')
+        config.setup_complete = True
+        config.save()
+        self.client.post(reverse('login'), {'password': 'pw'})
+
+        from simulator.models import ContextFile, ExamFile, Session
+
+        for sid in ("a", "b"):
+            Session.ensure(sid)
+            ExamFile.objects.create(file=ContentFile(b"exam " + sid.encode(), name="exam.docx"), session_id=sid)
+            ContextFile.objects.create(file=ContentFile(b"ctx " * 1000, name="ctx.txt"), session_id=sid)
+
+    def _archive(self, response):
+        self.assertTrue(response.streaming)
+        return zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content)))
+
+    def test_single_session_zip_is_streamed(self):
+        archive = self._archive(self.client.get(reverse('download_session_zip', args=["a"])))
+        self.assertEqual(sorted(archive.namelist()), ["ctx.txt", "exam.docx"])
+        self.assertEqual(archive.getinfo("exam.docx").compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(archive.getinfo("ctx.txt").compress_type, zipfile.ZIP_DEFLATED)
+        self.assertEqual(archive.read("exam.docx"), b"exam a")
+
+    def test_bulk_download(self):
+        response = self.client.post(reverse('download_sessions_zip'), {"session": ["a", "b"]})
+        names = self._archive(response).namelist()
+        self.assertEqual(len(names), 4)
+        self.assertEqual({name.split("/")[0] for name in names}, {"session_a", "session_b"})
+
+    def test_files_with_the_same_name_are_kept_apart(self):
+        from simulator.models import ContextFile
+
+        second = ContextFile.objects.create(
+            file=ContentFile(b"other", name="notes.txt"), session_id="a", original_name="ctx.txt"
+        )
+        archive = self._archive(self.client.get(reverse('download_session_zip', args=["a"])))
+        self.assertEqual(
+            sorted(archive.namelist()), ["ctx.txt", f"ctx_{second.pk}.txt", "exam.docx"]
+        )
+        self.assertEqual(archive.read(f"ctx_{second.pk}.txt"), b"other")
+
+    async def test_zip_is_streamed_asynchronously_under_asgi(self):
+        self.async_client.cookies = self.client.cookies
+        response = await self.async_client.get(reverse('download_session_zip', args=["a"]))
+        self.assertTrue(response.is_async)
+        data = b"".join([chunk async for chunk in response.streaming_content])
+        archive = zipfile.ZipFile(io.BytesIO(data))
+        self.assertEqual(sorted(archive.namelist()), ["ctx.txt", "exam.docx"])
+
+
+class ConfigCacheTest(TestCase):
+    def setUp(self):
+        AppConfig.get_solo()
+        cache.clear()
+
+    def test_prompts_are_memoized_until_changed(self):
+        from config.models import PromptConfig
+        from config.utils import load_prompts
+
+        get_config()
+        with self.assertNumQueries(1):
+            load_prompts("en")
+        with self.assertNumQueries(0):
+            prompts = load_prompts("en")
+            get_config()
+        self.assertNotEqual(prompts["system"], "Custom")
+
+        PromptConfig.objects.update_or_create(
+            language="en", prompt_type="system", defaults={"is_custom": True, "text": "Custom"}
+        )
+        self.assertEqual(load_prompts("en")["system"], "Custom")
+
+    @override_settings(CONFIG_CHECK_INTERVAL=0)
+    def test_changes_by_other_processes_are_visible(self):
+        get_config()
+        # Another process changes the row; this process only sees the version
+        AppConfig.objects.filter(pk=1).update(language="de", version="other")
+        with self.assertNumQueries(2):
+            self.assertEqual(get_config().language, "de")
+        with self.assertNumQueries(1):
+            get_config()
+
+    def test_config_changes_are_visible(self):
+        config = AppConfig.get_solo()
+        config.language = "de"
+        config.save()
+        self.assertEqual(get_config().language, "de")
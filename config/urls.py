@@ -8,6 +8,10 @@ urlpatterns = [
     path('settings/test_key/', views.test_api_key_view, name='test_key'),
     path('settings/', views.settings_view, name='settings'),
     path('settings/sessions/', views.sessions_view, name='sessions'),
+    path('settings/metrics/', views.metrics_view, name='metrics'),
+    path('settings/batch/', views.batch_view, name='batch'),
+    path('settings/cache/flush/', views.flush_response_cache_view, name='flush_response_cache'),
     path('settings/sessions/cleanup/', views.cleanup_sessions_view, name='cleanup_sessions'),
+    path('settings/sessions/download/', views.download_sessions_zip, name='download_sessions_zip'),
     path('settings/sessions/<str:session_id>/download/', views.download_session_zip, name='download_session_zip'),
 ]
@@ -1,15 +1,241 @@
+from __future__ import annotations
+
+import copy
+import hashlib
+import threading
+import time
+import uuid
+
+import openai
+from django.conf import settings
+from django.core.cache import cache
+
 from .models import AppConfig, PromptConfig
 from .prompt_defaults import PROMPT_DEFAULTS
 
 
-def load_prompts() -> dict:
-    config = AppConfig.get_solo()
-    prompts = {}
-    language = config.language
-    for ptype in ["system", "base", "level_low", "level_medium", "level_high"]:
-        pc = PromptConfig.objects.filter(language=language, prompt_type=ptype).first()
-        if pc and pc.is_custom:
-            prompts[ptype] = pc.text
-        else:
-            prompts[ptype] = PROMPT_DEFAULTS[language][ptype]
-    return prompts
+PROMPT_TYPES = ["system", "base", "level_low", "level_medium", "level_high"]
+
+_memo = {"version": None, "checked": None, "config": None, "prompts": {}}
+_memo_lock = threading.Lock()
+
+
+def expire_config_memo() -> None:
+    """Make the next call in this process check the configuration version."""
+    with _memo_lock:
+        _memo["checked"] = None
+
+
+def bump_config_version() -> None:
+    """Invalidate memoized configuration in every process.
+
+    ``AppConfig.save()`` changes the version itself; call this after changes
+    made without it, e.g. to prompts or through ``QuerySet.update()``.
+    """
+    if not AppConfig.objects.filter(pk=1).update(version=uuid.uuid4().hex):
+        AppConfig.get_solo()
+    expire_config_memo()
+
+
+def _version_query():
+    return AppConfig.objects.filter(pk=1).values_list("version", flat=True)
+
+
+def _memo_is_current() -> bool:
+    checked = _memo["checked"]
+    interval = getattr(settings, "CONFIG_CHECK_INTERVAL", 2)
+    return checked is not None and time.monotonic() - checked < interval
+
+
+def _memoized() -> dict:
+    """Return the process-local memo, resetting it if the version changed.
+
+    The version is stored in the database, so every process, including
+    ``simulation_worker``, sees changes without a shared cache. It is read
+    at most once per ``CONFIG_CHECK_INTERVAL`` seconds.
+    """
+    if _memo_is_current():
+        return _memo
+    return _memo_for(_version_query().first())
+
+
+def _memo_for(version: str | None) -> dict:
+    with _memo_lock:
+        if _memo["version"] != version:
+            _memo.update(version=version, config=None, prompts={})
+        _memo["checked"] = time.monotonic()
+        return _memo
+
+
+def get_config() -> AppConfig:
+    """Return the application configuration without querying on every call.
+
+    The returned object is a copy; use ``AppConfig.get_solo()`` to modify and
+    save the configuration.
+    """
+    memo = _memoized()
+    if memo["config"] is None:
+        memo["config"] = AppConfig.get_solo()
+    return copy.copy(memo["config"])
+
+
+async def aget_config() -> AppConfig:
+    """Async variant of :func:`get_config` for async views."""
+    if _memo_is_current():
+        memo = _memo
+    else:
+        memo = _memo_for(await _version_query().afirst())
+    if memo["config"] is None:
+        memo["config"] = await AppConfig.aget_solo()
+    return copy.copy(memo["config"])
+
+
+def prompt_settings(language: str) -> dict:
+    """Return ``{prompt_type: (is_custom, text)}`` for a language.
+
+    All prompts of a language are loaded in a single query; types without a
+    custom text fall back to the defaults.
+    """
+    memo = _memoized()
+    rows = memo["prompts"].get(language)
+    if rows is None:
+        stored = {
+            pc.prompt_type: pc
+            for pc in PromptConfig.objects.filter(language=language)
+        }
+        rows = {}
+        for ptype in PROMPT_TYPES:
+            pc = stored.get(ptype)
+            if pc and pc.is_custom:
+                rows[ptype] = (True, pc.text)
+            else:
+                rows[ptype] = (False, PROMPT_DEFAULTS[language][ptype])
+        memo["prompts"][language] = rows
+    return dict(rows)
+
+
+def load_prompts(language: str | None = None) -> dict:
+    language = language or get_config().language
+    return {ptype: text for ptype, (_, text) in prompt_settings(language).items()}
+
+
+_refreshing: set[str] = set()
+_refreshing_lock = threading.Lock()
+
+
+def _key_cache_key(key: str) -> str:
+    digest = hashlib.sha256((key or "").encode()).hexdigest()
+    return f"openai_key_valid:{digest}"
+
+
+def validate_openai_key(key: str) -> bool:
+    """Return True if the given key can access the OpenAI API.
+
+    This always performs a network request; use :func:`check_openai_key` to
+    benefit from the validation cache. The request uses a client of its own
+    that is closed afterwards, so keys that are only tested are not kept in
+    the shared client registry of :mod:`simulator.llm`.
+    """
+    try:
+        with openai.OpenAI(api_key=key) as client:
+            client.models.list()
+        return True
+    except Exception:
+        return False
+
+
+async def avalidate_openai_key(key: str) -> bool:
+    """Async variant of :func:`validate_openai_key`."""
+    try:
+        async with openai.AsyncOpenAI(api_key=key) as client:
+            await client.models.list()
+        return True
+    except Exception:
+        return False
+
+
+def _key_result_ttl(valid: bool) -> int:
+    if valid:
+        return getattr(settings, "OPENAI_KEY_CACHE_TTL", 3600)
+    return getattr(settings, "OPENAI_KEY_CACHE_NEGATIVE_TTL", 60)
+
+
+def _store_key_result(key: str, valid: bool) -> None:
+    cache.set(_key_cache_key(key), (valid, time.time()), _key_result_ttl(valid))
+
+
+def refresh_openai_key(key: str) -> bool:
+    """Validate ``key`` over the network and update the cache."""
+    valid = validate_openai_key(key)
+    _store_key_result(key, valid)
+    return valid
+
+
+async def arefresh_openai_key(key: str) -> bool:
+    """Async variant of :func:`refresh_openai_key`."""
+    valid = await avalidate_openai_key(key)
+    await cache.aset(_key_cache_key(key), (valid, time.time()), _key_result_ttl(valid))
+    return valid
+
+
+def _refresh_in_background(key: str) -> None:
+    cache_key = _key_cache_key(key)
+    with _refreshing_lock:
+        if cache_key in _refreshing:
+            return
+        _refreshing.add(cache_key)
+
+    def run() -> None:
+        try:
+            refresh_openai_key(key)
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(cache_key)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def check_openai_key(key: str, *, blocking: bool = True) -> bool | None:
+    """Return whether ``key`` is valid, using a cache keyed by its hash.
+
+    Valid keys are cached for ``OPENAI_KEY_CACHE_TTL`` seconds, invalid ones
+    for ``OPENAI_KEY_CACHE_NEGATIVE_TTL`` seconds. Entries older than half
+    their TTL are refreshed in a background thread while the cached value is
+    returned. With ``blocking=False`` a cache miss returns ``None``
+    immediately and the validation runs in the background, so page rendering
+    never waits on the network.
+    """
+    if not key:
+        return False
+    entry = cache.get(_key_cache_key(key))
+    background = getattr(settings, "OPENAI_KEY_CHECK_BACKGROUND", True)
+    if entry is not None:
+        valid, checked_at = entry
+        if background and valid:
+            age = time.time() - checked_at
+            if age > getattr(settings, "OPENAI_KEY_CACHE_TTL", 3600) / 2:
+                _refresh_in_background(key)
+        return valid
+    if blocking or not background:
+        return refresh_openai_key(key)
+    _refresh_in_background(key)
+    return None
+
+
+async def acheck_openai_key(key: str) -> bool:
+    """Async variant of :func:`check_openai_key` that awaits a cache miss."""
+    if not key:
+        return False
+    entry = await cache.aget(_key_cache_key(key))
+    if entry is None:
+        return await arefresh_openai_key(key)
+    valid, checked_at = entry
+    if valid and getattr(settings, "OPENAI_KEY_CHECK_BACKGROUND", True):
+        if time.time() - checked_at > getattr(settings, "OPENAI_KEY_CACHE_TTL", 3600) / 2:
+            _refresh_in_background(key)
+    return valid
+
+
+def invalidate_openai_key(key: str) -> None:
+    """Drop the cached validation result for ``key``."""
+    cache.delete(_key_cache_key(key))
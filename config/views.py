@@ -1,22 +1,45 @@
+import asyncio
+import posixpath
+
+from asgiref.sync import sync_to_async
 from django.shortcuts import render, redirect
 from django.http import JsonResponse
 from django.urls import reverse
 from django.contrib import messages
 from django.conf import settings
 from django.core.management import call_command
-from django.http import HttpResponse
-import io
-import zipfile
-import openai
-from django.utils import translation
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+from datetime import timedelta
+from django.db.models import Q
+from django.utils import timezone, translation
+from django.utils.dateparse import parse_datetime
 
 from .models import AppConfig, PromptConfig
 from .forms import SetupForm, LoginForm, SettingsForm, PromptForm
 from .prompt_defaults import PROMPT_DEFAULTS
+from .utils import (
+    PROMPT_TYPES,
+    aget_config,
+    arefresh_openai_key,
+    check_openai_key,
+    get_config,
+    prompt_settings,
+)
+from .zipstream import astream_zip, stream_zip
 
 
 
 def admin_login_required(view_func):
+    if asyncio.iscoroutinefunction(view_func):
+        async def async_wrapped(request, *args, **kwargs):
+            # Loading the session touches the database
+            if not await sync_to_async(request.session.get)("admin_logged_in"):
+                return redirect("login")
+            return await view_func(request, *args, **kwargs)
+
+        return async_wrapped
+
     def wrapped(request, *args, **kwargs):
         if not request.session.get("admin_logged_in"):
             return redirect("login")
@@ -25,16 +48,6 @@ def admin_login_required(view_func):
     return wrapped
 
 
-def _check_openai_key(key: str) -> bool:
-    """Return True if the given key can access the OpenAI API."""
-    try:
-        client = openai.OpenAI(api_key=key)
-        client.models.list()
-        return True
-    except Exception:
-        return False
-
-
 def setup_view(request):
     config = AppConfig.get_solo()
     if config.setup_complete:
@@ -51,15 +64,14 @@ def setup_view(request):
 
 
 @admin_login_required
-def test_api_key_view(request):
+async def test_api_key_view(request):
     """Return JSON indicating whether the provided or stored key is valid."""
-    config = AppConfig.get_solo()
-    key = request.POST.get("api_key") or config.openai_api_key
-    return JsonResponse({"ok": _check_openai_key(key)})
+    key = request.POST.get("api_key") or (await aget_config()).openai_api_key
+    return JsonResponse({"ok": await arefresh_openai_key(key)})
 
 
 def login_view(request):
-    config = AppConfig.get_solo()
+    config = get_config()
     if not config.setup_complete:
         return redirect("setup")
 
@@ -83,14 +95,9 @@ def settings_view(request):
     translation.activate(display_lang)
     request.session['django_language'] = display_lang
     prompts = {}
-    for ptype in ["system", "base", "level_low", "level_medium", "level_high"]:
-        pc = PromptConfig.objects.filter(language=display_lang, prompt_type=ptype).first()
-        if pc:
-            prompts[f"{ptype}_custom"] = pc.is_custom
-            prompts[f"{ptype}_text"] = pc.text if pc.is_custom else PROMPT_DEFAULTS[display_lang][ptype]
-        else:
-            prompts[f"{ptype}_custom"] = False
-            prompts[f"{ptype}_text"] = PROMPT_DEFAULTS[display_lang][ptype]
+    for ptype, (is_custom, text) in prompt_settings(display_lang).items():
+        prompts[f"{ptype}_custom"] = is_custom
+        prompts[f"{ptype}_text"] = text
 
     if request.method == "POST":
         form = SettingsForm(request.POST, instance=config)
@@ -100,7 +107,7 @@ def settings_view(request):
             display_lang = form.cleaned_data["language"]
             translation.activate(display_lang)
             request.session['django_language'] = display_lang
-            for ptype in ["system", "base", "level_low", "level_medium", "level_high"]:
+            for ptype in PROMPT_TYPES:
                 pc, _ = PromptConfig.objects.get_or_create(language=display_lang, prompt_type=ptype)
                 use_custom = prompt_form.cleaned_data[f"{ptype}_custom"]
                 if use_custom:
@@ -118,13 +125,16 @@ def settings_view(request):
         form = SettingsForm(instance=config, initial={"language": display_lang})
         prompt_form = PromptForm(initial=prompts)
 
-    key_valid = _check_openai_key(config.openai_api_key)
+    from simulator.response_cache import stats
+
+    key_valid = check_openai_key(config.openai_api_key, blocking=False)
     context = {
         "form": form,
         "prompt_form": prompt_form,
         "key_valid": key_valid,
         "language": display_lang,
         "sim_pw_set": bool(config.simulation_password_hash),
+        "cache_stats": stats(),
     }
     resp = render(request, "config/settings.html", context)
     resp.set_cookie(settings.LANGUAGE_COOKIE_NAME, display_lang)
@@ -136,50 +146,207 @@ def logout_view(request):
     return redirect("index")
 
 
+SESSIONS_PAGE_SIZE = 50
+
+
+def _parse_cursor(cursor: str):
+    """Split a ``<last_activity>|<session_id>`` pagination cursor."""
+    stamp, _, session_id = cursor.partition("|")
+    last_activity = parse_datetime(stamp) if session_id else None
+    if last_activity is None:
+        return None
+    return last_activity, session_id
+
+
 @admin_login_required
 def sessions_view(request):
-    """Display all sessions with download options."""
-    from simulator.models import ContextFile, ExamFile, AIResult
+    """Display sessions with download options, one page at a time.
+
+    Sessions are ordered by last activity and paginated with a keyset cursor,
+    so a page costs the same handful of queries regardless of how many
+    sessions exist.
+    """
+    from simulator.models import ContextFile, ExamFile, AIResult, Session
 
-    session_ids = set(
-        ContextFile.objects.values_list("session_id", flat=True)
-    ) | set(ExamFile.objects.values_list("session_id", flat=True)) | set(
-        AIResult.objects.values_list("session_id", flat=True)
+    newest_first = request.GET.get("sort", "recent") != "oldest"
+    queryset = Session.objects.all()
+    now = timezone.now()
+    for param, lookup in (("older_than", "last_activity__lt"), ("newer_than", "last_activity__gte")):
+        try:
+            days = int(request.GET.get(param, ""))
+        except ValueError:
+            continue
+        queryset = queryset.filter(**{lookup: now - timedelta(days=days)})
+
+    cursor = _parse_cursor(request.GET.get("after", ""))
+    if cursor:
+        last_activity, session_id = cursor
+        if newest_first:
+            queryset = queryset.filter(
+                Q(last_activity__lt=last_activity)
+                | Q(last_activity=last_activity, session_id__lt=session_id)
+            )
+        else:
+            queryset = queryset.filter(
+                Q(last_activity__gt=last_activity)
+                | Q(last_activity=last_activity, session_id__gt=session_id)
+            )
+    ordering = ("-last_activity", "-session_id") if newest_first else ("last_activity", "session_id")
+    page = list(queryset.order_by(*ordering)[: SESSIONS_PAGE_SIZE + 1])
+    next_cursor = None
+    if len(page) > SESSIONS_PAGE_SIZE:
+        page = page[:SESSIONS_PAGE_SIZE]
+        last = page[-1]
+        next_cursor = f"{last.last_activity.isoformat()}|{last.session_id}"
+
+    ids = [session.session_id for session in page]
+    files = {sid: {"context": [], "exam": [], "results": []} for sid in ids}
+    for key, model in (("context", ContextFile), ("exam", ExamFile), ("results", AIResult)):
+        for obj in model.objects.filter(session_id__in=ids):
+            files[obj.session_id][key].append(obj)
+
+    sessions = [{"id": s.session_id, "summary": s, **files[s.session_id]} for s in page]
+    params = request.GET.copy()
+    params.pop("after", None)
+    if next_cursor:
+        next_params = params.copy()
+        next_params["after"] = next_cursor
+    return render(
+        request,
+        "config/sessions.html",
+        {
+            "sessions": sessions,
+            "sort": "recent" if newest_first else "oldest",
+            "older_than": request.GET.get("older_than", ""),
+            "newer_than": request.GET.get("newer_than", ""),
+            "first_page_query": params.urlencode(),
+            "next_page_query": next_params.urlencode() if next_cursor else None,
+            "is_first_page": cursor is None,
+        },
     )
-    sessions = []
-    for sid in session_ids:
-        sessions.append(
-            {
-                "id": sid,
-                "context": list(ContextFile.objects.filter(session_id=sid)),
-                "exam": list(ExamFile.objects.filter(session_id=sid)),
-                "results": list(AIResult.objects.filter(session_id=sid)),
-            }
-        )
-    return render(request, "config/sessions.html", {"sessions": sessions})
 
 
 @admin_login_required
-def download_session_zip(request, session_id: str):
-    """Return a zip file containing all data for a session."""
+def metrics_view(request):
+    """Display latency percentiles and token usage of recent simulations."""
+    from simulator.telemetry import summarize
+
+    try:
+        days = max(1, int(request.GET.get("days", 7)))
+    except ValueError:
+        days = 7
+    since = timezone.now() - timedelta(days=days)
+    return render(
+        request, "config/metrics.html", {"metrics": summarize(since), "days": days}
+    )
+
+
+def _unique_arcname(arcname: str, pk: int, used: set) -> str:
+    """Return ``arcname``, suffixed with ``pk`` if it is already in ``used``."""
+    stem, ext = posixpath.splitext(arcname)
+    candidate, n = arcname, 0
+    while candidate in used:
+        n += 1
+        candidate = f"{stem}_{pk}{ext}" if n == 1 else f"{stem}_{pk}_{n}{ext}"
+    used.add(candidate)
+    return candidate
+
+
+def _session_entries(session_ids, prefix_with_session: bool = False):
+    """Yield ``(path, arcname)`` for all files of the given sessions.
+
+    Uploads keep their original names, so two files of the same name get
+    their primary key appended to keep the zip members unique.
+    """
     from simulator.models import ContextFile, ExamFile, AIResult
 
-    buffer = io.BytesIO()
-    with zipfile.ZipFile(buffer, "w") as zf:
-        for obj in ExamFile.objects.filter(session_id=session_id):
-            zf.write(obj.file.path, obj.file.name.split("/", 1)[-1])
-        for obj in ContextFile.objects.filter(session_id=session_id):
-            zf.write(obj.file.path, obj.file.name.split("/", 1)[-1])
-        for obj in AIResult.objects.filter(session_id=session_id):
-            zf.write(obj.file.path, obj.file.name.split("/", 1)[-1])
-    buffer.seek(0)
-    response = HttpResponse(buffer.getvalue(), content_type="application/zip")
-    response[
-        "Content-Disposition"
-    ] = f"attachment; filename=session_{session_id}.zip"
+    used = set()
+    for model in (ExamFile, ContextFile, AIResult):
+        for obj in model.objects.filter(session_id__in=session_ids).iterator():
+            arcname = getattr(obj, "original_name", "") or obj.file.name.split("/", 1)[-1]
+            if prefix_with_session:
+                arcname = f"session_{obj.session_id}/{arcname}"
+            yield obj.file.path, _unique_arcname(arcname, obj.pk, used)
+
+
+def _zip_response(request, entries, filename: str) -> StreamingHttpResponse:
+    stream = astream_zip if isinstance(request, ASGIRequest) else stream_zip
+    response = StreamingHttpResponse(stream(entries), content_type="application/zip")
+    response["Content-Disposition"] = f"attachment; filename={filename}"
     return response
 
 
+@admin_login_required
+def download_session_zip(request, session_id: str):
+    """Stream a zip file containing all data for a session."""
+    return _zip_response(
+        request, _session_entries([session_id]), f"session_{session_id}.zip"
+    )
+
+
+@admin_login_required
+def download_sessions_zip(request):
+    """Stream one zip file with the data of all selected sessions."""
+    session_ids = request.POST.getlist("session") if request.method == "POST" else []
+    if not session_ids:
+        messages.error(request, "No sessions selected")
+        return redirect("sessions")
+    return _zip_response(
+        request, _session_entries(session_ids, prefix_with_session=True), "sessions.zip"
+    )
+
+
+@admin_login_required
+def flush_response_cache_view(request):
+    """Delete all cached AI answers."""
+    from simulator.response_cache import flush
+
+    if request.method == "POST":
+        flush()
+        messages.success(request, "Cache cleared")
+    return redirect("settings")
+
+
+BATCH_SESSION_LIMIT = 200
+
+
+@admin_login_required
+def batch_view(request):
+    """Simulate several sessions at once, queued or as an OpenAI batch."""
+    from simulator.batch import collect_pending, submit_batch
+    from simulator.jobs import enqueue_simulation
+    from simulator.models import ExamFile, Session, SimulationBatch
+
+    if request.method == "POST":
+        config = get_config()
+        session_ids = request.POST.getlist("session")
+        if request.POST.get("action") == "collect":
+            collected = collect_pending(api_key=config.openai_api_key)
+            messages.success(request, f"{collected} batch(es) collected")
+        elif not session_ids:
+            messages.error(request, "No sessions selected")
+        elif request.POST.get("mode") == "openai":
+            try:
+                batch = submit_batch(session_ids, api_key=config.openai_api_key)
+            except Exception as exc:
+                messages.error(request, f"Batch could not be submitted: {exc}")
+            else:
+                messages.success(request, f"Batch {batch.openai_batch_id} submitted")
+        else:
+            created = sum(enqueue_simulation(sid)[1] for sid in session_ids)
+            messages.success(request, f"{created} simulation(s) queued")
+        return redirect("batch")
+
+    sessions = Session.objects.filter(
+        session_id__in=ExamFile.objects.values("session_id")
+    ).order_by("-last_activity")[:BATCH_SESSION_LIMIT]
+    return render(
+        request,
+        "config/batch.html",
+        {"sessions": sessions, "batches": SimulationBatch.objects.all()[:20]},
+    )
+
+
 @admin_login_required
 def cleanup_sessions_view(request):
     """Delete all stored sessions and files."""
@@ -0,0 +1,75 @@
+"""Incremental ZIP archive generation for streaming responses."""
+
+from __future__ import annotations
+
+import os
+import zipfile
+from typing import AsyncIterator, Iterable, Iterator, Tuple
+
+from asgiref.sync import sync_to_async
+
+CHUNK_SIZE = 64 * 1024
+
+# Formats that are already compressed and are stored without deflating
+STORED_EXTENSIONS = {".docx", ".pdf", ".zip", ".png", ".jpg", ".jpeg"}
+
+
+class _Sink:
+    """Write-only, unseekable file object collecting the archive bytes."""
+
+    def __init__(self):
+        self._chunks: list[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> Iterator[bytes]:
+        if self._chunks:
+            data = b"".join(self._chunks)
+            self._chunks.clear()
+            yield data
+
+
+def stream_zip(entries: Iterable[Tuple[str, str]]) -> Iterator[bytes]:
+    """Yield a ZIP archive of ``(path, arcname)`` entries piece by piece.
+
+    Only one read chunk is held in memory at a time. Missing files are
+    skipped.
+    """
+    sink = _Sink()
+    with zipfile.ZipFile(sink, "w") as zf:
+        for path, arcname in entries:
+            if not os.path.isfile(path):
+                continue
+            info = zipfile.ZipInfo.from_file(path, arcname)
+            ext = os.path.splitext(path)[1].lower()
+            info.compress_type = (
+                zipfile.ZIP_STORED if ext in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+            )
+            large = info.file_size > zipfile.ZIP64_LIMIT
+            with open(path, "rb") as src, zf.open(info, "w", force_zip64=large) as dst:
+                for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+                    dst.write(chunk)
+                    yield from sink.drain()
+            yield from sink.drain()
+    yield from sink.drain()
+
+
+async def astream_zip(entries: Iterable[Tuple[str, str]]) -> AsyncIterator[bytes]:
+    """Async variant of :func:`stream_zip` for responses served over ASGI.
+
+    Django collects synchronous iterators of streaming responses into a list
+    under ASGI, which would hold the whole archive in memory. Here every
+    chunk is produced in a worker thread and passed on right away.
+    """
+    chunks = stream_zip(entries)
+    next_chunk = sync_to_async(next)
+    while True:
+        chunk = await next_chunk(chunks, None)
+        if chunk is None:
+            return
+        yield chunk
@@ -0,0 +1,224 @@
+"""Simulate many sessions at once.
+
+Sessions can be created from a directory of exams (:func:`import_exams`) and
+are then either queued for the ``simulation_worker`` like single runs, or
+submitted together to the OpenAI Batch API (:func:`submit_batch`). Batch
+requests cost half as much and do not count against the regular rate limits,
+but OpenAI may take up to 24 hours to answer them. :func:`collect_batch`
+fetches the answers of a finished batch and stores the results of each
+session like a regular run, using the requests planned at submission.
+"""
+
+from __future__ import annotations
+
+import json
+import uuid
+from pathlib import Path
+from typing import Iterable, List
+
+from django.conf import settings
+from django.core.files import File
+from django.utils import timezone
+from openai.types.chat import ChatCompletion
+
+from .examscan import ResultDocumentError, scan_exam
+from .forms import ContextUploadForm, ExamUploadForm
+from .llm import get_client
+from .models import ContextFile, ExamFile, Session, SimulationBatch
+from .prompt_builder import usage_counts
+from .services import (
+    LEVELS,
+    SimulationPlan,
+    _build_level_document,
+    _load_template,
+    plan_simulation,
+    store_results,
+)
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+# Batch states reported by OpenAI that will not change any more
+FINAL_STATES = {"completed", "failed", "expired", "cancelled"}
+
+
+def _files(directory: str, extensions: set) -> List[Path]:
+    return sorted(
+        path
+        for path in Path(directory).iterdir()
+        if path.is_file() and path.suffix.lower() in extensions
+    )
+
+
+def import_exams(exam_dir: str, context_dir: str | None = None) -> List[str]:
+    """Create one session per exam in ``exam_dir`` and return their ids.
+
+    Every session gets all files of ``context_dir``, if given, as context.
+    """
+    exams = _files(exam_dir, ExamUploadForm.ALLOWED_EXTENSIONS)
+    if not exams:
+        raise ValueError(f"No exams found in {exam_dir}")
+    contexts = _files(context_dir, ContextUploadForm.ALLOWED_EXTENSIONS) if context_dir else []
+
+    indexes = {}
+    for exam in exams:
+        try:
+            indexes[exam] = scan_exam(exam)
+        except ResultDocumentError:
+            raise ValueError(f"{exam.name} appears to be an AI result")
+        except Exception:
+            # Unreadable exams are parsed again by the simulation
+            indexes[exam] = {}
+
+    session_ids = []
+    for exam in exams:
+        session_id = uuid.uuid4().hex
+        Session.ensure(session_id)
+        with open(exam, "rb") as fh:
+            ExamFile.objects.create(
+                file=File(fh, name=exam.name), session_id=session_id, index=indexes[exam]
+            )
+        for path in contexts:
+            with open(path, "rb") as fh:
+                ContextFile.objects.create(file=File(fh, name=path.name), session_id=session_id)
+        Session.refresh(session_id)
+        session_ids.append(session_id)
+    return session_ids
+
+
+def _custom_id(session_id: str, level: str, index: int | None) -> str:
+    return f"{session_id}:{level}:{'' if index is None else index}"
+
+
+def submit_batch(session_ids: Iterable[str], *, api_key: str | None = None) -> SimulationBatch:
+    """Build the requests of all sessions and submit them as one batch."""
+    session_ids = list(session_ids)
+    model = getattr(settings, "OPENAI_MODEL", "gpt-4-1106-preview")
+    lines = []
+    planned = {}
+    for session_id in session_ids:
+        plan = plan_simulation(session_id)
+        planned[session_id] = {
+            "exam": plan.exam.pk,
+            "requests": [[level, index] for level, index in plan.requests],
+        }
+        for (level, index), messages in plan.requests.items():
+            body = {"model": model, "messages": messages}
+            lines.append(
+                json.dumps(
+                    {
+                        "custom_id": _custom_id(session_id, level, index),
+                        "method": "POST",
+                        "url": BATCH_ENDPOINT,
+                        "body": body,
+                    },
+                    ensure_ascii=False,
+                )
+            )
+
+    client = get_client(api_key)
+    upload = client.files.create(
+        file=("simulations.jsonl", "\n".join(lines).encode()), purpose="batch"
+    )
+    remote = client.batches.create(
+        input_file_id=upload.id, endpoint=BATCH_ENDPOINT, completion_window="24h"
+    )
+    return SimulationBatch.objects.create(
+        openai_batch_id=remote.id,
+        remote_status=remote.status,
+        session_ids=session_ids,
+        planned=planned,
+        request_count=len(lines),
+    )
+
+
+def _read_output(client, file_id: str | None) -> dict:
+    """Return ``{custom_id: completion}`` of the successful requests."""
+    if not file_id:
+        return {}
+    answers = {}
+    for line in client.files.content(file_id).text.splitlines():
+        if not line.strip():
+            continue
+        entry = json.loads(line)
+        response = entry.get("response") or {}
+        if response.get("status_code") == 200:
+            answers[entry["custom_id"]] = ChatCompletion.model_validate(response["body"])
+    return answers
+
+
+def _planned(batch: SimulationBatch, session_id: str) -> dict:
+    """Return the requests of a session as planned when the batch was submitted."""
+    planned = batch.planned.get(session_id)
+    if planned is None:
+        # Submitted before the plan was stored with the batch
+        plan = plan_simulation(session_id)
+        planned = {"exam": plan.exam.pk, "requests": [list(key) for key in plan.requests]}
+    return planned
+
+
+def _store_session(
+    session_id: str, planned: dict, responses: dict, client, model: str
+) -> None:
+    """Build and store the result documents of one session."""
+    exam = ExamFile.objects.filter(pk=planned["exam"], session_id=session_id).first()
+    if exam is None:
+        raise ValueError("The exam was replaced after the batch was submitted")
+    answers = {level: {} for level in LEVELS}
+    usage = {level: [] for level in LEVELS}
+    for level, index in planned["requests"]:
+        response = responses.get(_custom_id(session_id, level, index))
+        if response is None:
+            raise ValueError(f"No answer for level {level}")
+        answers[level][index] = (response.choices[0].message.content or "").strip()
+        usage[level].append(usage_counts(response))
+    template = _load_template(exam)
+    per_task = any(index is not None for _, index in planned["requests"])
+    # Only the template and its tasks are needed to assemble the answers
+    plan = SimulationPlan(exam, template, template.tasks if per_task else [], {}, "", {})
+    documents = {
+        level: _build_level_document(
+            template, level, plan.level_answer(answers[level]), client, model
+        )
+        for level in LEVELS
+    }
+    store_results(session_id, exam, documents, usage)
+
+
+def collect_batch(batch: SimulationBatch, *, api_key: str | None = None) -> bool:
+    """Store the results of a finished batch.
+
+    Returns ``False`` while OpenAI is still working on it. Sessions with
+    failed requests are reported in ``batch.error``; the others get their
+    results.
+    """
+    client = get_client(api_key)
+    remote = client.batches.retrieve(batch.openai_batch_id)
+    batch.remote_status = remote.status
+    if remote.status not in FINAL_STATES:
+        batch.save(update_fields=["remote_status"])
+        return False
+
+    model = getattr(settings, "OPENAI_MODEL", "gpt-4-1106-preview")
+    responses = _read_output(client, remote.output_file_id)
+    errors = [] if remote.status == "completed" else [f"Batch {remote.status}"]
+    stored = 0
+    for session_id in batch.session_ids if responses else []:
+        try:
+            _store_session(session_id, _planned(batch, session_id), responses, client, model)
+            stored += 1
+        except Exception as exc:
+            errors.append(f"{session_id}: {exc}")
+
+    batch.status = SimulationBatch.STATUS_DONE if stored else SimulationBatch.STATUS_FAILED
+    batch.stored_count = stored
+    batch.error = "\n".join(errors)
+    batch.finished = timezone.now()
+    batch.save(update_fields=["remote_status", "status", "stored_count", "error", "finished"])
+    return True
+
+
+def collect_pending(*, api_key: str | None = None) -> int:
+    """Collect all submitted batches that finished; returns their number."""
+    collected = 0
+    for batch in SimulationBatch.objects.filter(status=SimulationBatch.STATUS_SUBMITTED):
+        collected += collect_batch(batch, api_key=api_key)
+    return collected
@@ -0,0 +1,160 @@
+"""Token budgeting and relevance-based selection of context text.
+
+The prompt is limited to a token budget for the configured model. The exam is
+always included completely; the context files are split into chunks, ranked
+against the exam text with BM25 and the best chunks are packed into the
+remaining budget.
+"""
+
+from __future__ import annotations
+
+import math
+import re
+from collections import Counter
+from typing import Iterable, List
+
+from django.conf import settings
+
+try:  # pragma: no cover - optional dependency
+    import tiktoken
+except ImportError:  # pragma: no cover - optional dependency
+    tiktoken = None
+
+# Context window sizes of common models in tokens
+MODEL_CONTEXT_TOKENS = {
+    "gpt-3.5-turbo": 16385,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-turbo": 128000,
+    "gpt-4-1106-preview": 128000,
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+    "gpt-4.1": 1047576,
+}
+DEFAULT_CONTEXT_TOKENS = 8192
+# Tokens kept free for the answer
+COMPLETION_RESERVE_TOKENS = 4096
+# Rough characters per token if tiktoken is not installed
+CHARS_PER_TOKEN = 4
+CHUNK_TOKENS = 300
+# Context text read for ranking, as a multiple of the remaining budget
+CANDIDATE_FACTOR = 10
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def _encoding(model: str):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str, model: str | None = None) -> int:
+    """Return the number of tokens of ``text`` for ``model``.
+
+    Uses ``tiktoken`` when installed and a character based estimate otherwise.
+    """
+    encoding = _encoding(model or settings.OPENAI_MODEL)
+    if encoding is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def prompt_token_budget(model: str | None = None) -> int:
+    """Return the number of prompt tokens available for ``model``."""
+    model = model or settings.OPENAI_MODEL
+    window = DEFAULT_CONTEXT_TOKENS
+    # Prefer the longest matching prefix, e.g. "gpt-4o-mini" over "gpt-4"
+    for name in sorted(MODEL_CONTEXT_TOKENS, key=len, reverse=True):
+        if model.startswith(name):
+            window = MODEL_CONTEXT_TOKENS[name]
+            break
+    available = window - COMPLETION_RESERVE_TOKENS
+    configured = getattr(settings, "OPENAI_PROMPT_TOKEN_BUDGET", None)
+    return min(available, configured) if configured else available
+
+
+def _terms(text: str) -> List[str]:
+    return [w.lower() for w in _WORD_RE.findall(text) if len(w) > 2]
+
+
+def chunk_text(text: str, chunk_tokens: int = CHUNK_TOKENS) -> List[str]:
+    """Split text at paragraph boundaries into chunks of roughly equal size."""
+    limit = chunk_tokens * CHARS_PER_TOKEN
+    chunks: List[str] = []
+    current: List[str] = []
+    size = 0
+    for para in text.splitlines():
+        para = para.strip()
+        if not para:
+            continue
+        # Hard-wrap paragraphs that alone exceed the chunk size
+        while len(para) > limit:
+            if current:
+                chunks.append("\n".join(current))
+                current, size = [], 0
+            chunks.append(para[:limit])
+            para = para[limit:]
+        if size + len(para) > limit and current:
+            chunks.append("\n".join(current))
+            current, size = [], 0
+        current.append(para)
+        size += len(para) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def bm25_scores(query: str, documents: List[str], k1: float = 1.5, b: float = 0.75) -> List[float]:
+    """Return the BM25 score of every document for ``query``."""
+    tokenized = [_terms(doc) for doc in documents]
+    if not tokenized:
+        return []
+    avg_len = sum(len(t) for t in tokenized) / len(tokenized) or 1.0
+    doc_freq: Counter = Counter()
+    for terms in tokenized:
+        doc_freq.update(set(terms))
+    query_terms = set(_terms(query))
+    n = len(tokenized)
+    scores = []
+    for terms in tokenized:
+        freqs = Counter(terms)
+        score = 0.0
+        for term in query_terms:
+            tf = freqs.get(term)
+            if not tf:
+                continue
+            idf = math.log(1 + (n - doc_freq[term] + 0.5) / (doc_freq[term] + 0.5))
+            score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len(terms) / avg_len))
+        scores.append(score)
+    return scores
+
+
+def select_context(
+    exam_text: str,
+    context_texts: Iterable[str],
+    budget_tokens: int,
+    model: str | None = None,
+) -> str:
+    """Pack the context chunks most relevant to the exam into the budget.
+
+    Selected chunks keep their original order so the context stays readable.
+    """
+    chunks = [chunk for text in context_texts for chunk in chunk_text(text)]
+    if not chunks or budget_tokens <= 0:
+        return ""
+    scores = bm25_scores(exam_text, chunks)
+    ranked = sorted(range(len(chunks)), key=lambda i: (-scores[i], i))
+    separator_tokens = count_tokens("\n\n", model)
+    chosen = []
+    used = 0
+    for i in ranked:
+        cost = count_tokens(chunks[i], model) + separator_tokens
+        if used + cost > budget_tokens:
+            continue
+        chosen.append(i)
+        used += cost
+    return "\n\n".join(chunks[i] for i in sorted(chosen))
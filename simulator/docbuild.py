@@ -0,0 +1,260 @@
+"""Assembly of the result documents from the uploaded exam.
+
+The exam is parsed once into an :class:`ExamTemplate` that indexes the
+paragraph texts and the positions of the ``[Antwort]`` placeholders. Each
+level document is a copy of the parsed template; answers are inserted through
+the indexed paragraph list, so building a document is linear in the number of
+paragraphs. If the index was stored at upload time (see
+:mod:`simulator.examscan`) the document is only parsed once a copy is needed.
+
+The template also splits the exam into its tasks so that every task can be
+answered by a separate completion and the answer placed after its task.
+"""
+
+from __future__ import annotations
+
+import copy
+import io
+import re
+import threading
+from typing import Iterable, List, NamedTuple, Sequence, Tuple
+
+from docx import Document
+from docx.enum.style import WD_STYLE_TYPE
+from docx.oxml import OxmlElement
+from docx.shared import RGBColor
+from docx.text.paragraph import Paragraph
+
+PLACEHOLDER = "[Antwort]"
+HEADING_STYLE = "Heading 2"
+# "Aufgabe 3", "Task 2b", "3." or "2a)" at the start of a paragraph
+TASK_NUMBER_RE = re.compile(
+    r"^\s*(?:(?:aufgabe|teilaufgabe|frage|task|question)\s+\d+[a-z]?\b|\d+[a-z]?[.)])",
+    re.IGNORECASE,
+)
+
+
+class ExamTask(NamedTuple):
+    """A single task of an exam.
+
+    ``anchor`` is the paragraph after which the answer is inserted. If
+    ``placeholder`` is set the anchor holds an ``[Antwort]`` marker that is
+    removed when the answer is filled in.
+    """
+
+    number: int
+    text: str
+    anchor: int
+    placeholder: bool
+
+
+def insert_paragraph_after(paragraph: Paragraph, text: str = "", style: str | None = None) -> Paragraph:
+    """Insert a new paragraph after the given one and return it.
+
+    If a style is provided but not found in the document, the paragraph will be
+    added using the document's default style instead of raising ``KeyError``.
+    """
+    new_p = OxmlElement("w:p")
+    paragraph._p.addnext(new_p)
+    new_para = Paragraph(new_p, paragraph._parent)
+    if text:
+        new_para.add_run(text)
+    if style:
+        try:
+            new_para.style = style
+        except KeyError:
+            # Fall back to default style if the requested style is not present
+            pass
+    return new_para
+
+
+def insert_answer_after(
+    paragraph: Paragraph,
+    level: str,
+    text: str,
+    color: RGBColor,
+    heading_style_id: str | None = None,
+) -> None:
+    """Insert the level heading and the coloured answer after ``paragraph``.
+
+    ``heading_style_id`` is the resolved id of the heading style; resolving it
+    once per document avoids a scan of all styles for every answer.
+    """
+    head = insert_paragraph_after(paragraph, f"{level.title()} Antwort:")
+    if heading_style_id:
+        head._p.style = heading_style_id
+    ans_p = insert_paragraph_after(head, "")
+    run = ans_p.add_run(text)
+    run.font.color.rgb = color
+
+
+class ExamTemplate:
+    """An exam document parsed once and shared by all level documents."""
+
+    def __init__(self, path, index: dict | None = None):
+        """Parse the exam at ``path``, or use its stored ``index`` if given."""
+        self._path = path
+        self._document: Document | None = None
+        self._lock = threading.Lock()
+        if index is not None:
+            self.paragraphs: List[str] = list(index["paragraphs"])
+            self.placeholders: List[int] = list(index["placeholders"])
+            self.headings: List[int] = list(index["headings"])
+        else:
+            paragraphs = self.document.paragraphs
+            self.paragraphs = [p.text for p in paragraphs]
+            self.placeholders = [
+                i for i, text in enumerate(self.paragraphs) if PLACEHOLDER in text
+            ]
+            heading_ids = {
+                style.styleId
+                for style in self.document.styles.element.style_lst
+                if (style.name_val or "").lower().startswith("heading")
+            }
+            self.headings = [
+                i for i, p in enumerate(paragraphs) if p._p.style in heading_ids
+            ]
+        self.tasks: List[ExamTask] = self._segment()
+
+    def _load(self) -> None:
+        with self._lock:
+            if self._document is not None:
+                return
+            document = Document(self._path)
+            try:
+                self._heading_style_id = document.part.get_style_id(
+                    HEADING_STYLE, WD_STYLE_TYPE.PARAGRAPH
+                )
+            except KeyError:
+                # Fall back to the default style if the template lacks headings
+                self._heading_style_id = None
+            self._document = document
+
+    @property
+    def document(self) -> Document:
+        """The parsed exam, loaded on first use."""
+        self._load()
+        return self._document
+
+    @property
+    def heading_style_id(self) -> str | None:
+        """Id of the style used for the answer headings."""
+        self._load()
+        return self._heading_style_id
+
+    def _segment(self) -> List[ExamTask]:
+        """Split the exam into tasks.
+
+        ``[Antwort]`` markers end a task. Without markers, headings and then
+        numbered paragraphs such as "Aufgabe 2" or "3." start a task. Returns
+        an empty list if the exam has none of these.
+        """
+        if self.placeholders:
+            tasks = []
+            start = 0
+            for number, idx in enumerate(self.placeholders, 1):
+                lines = self.paragraphs[start:idx] + [
+                    self.paragraphs[idx].replace(PLACEHOLDER, "")
+                ]
+                tasks.append(ExamTask(number, _join(lines), idx, True))
+                start = idx + 1
+            return tasks
+
+        starts = self.headings or [
+            i for i, text in enumerate(self.paragraphs) if TASK_NUMBER_RE.match(text)
+        ]
+        tasks = []
+        for number, start in enumerate(starts, 1):
+            end = starts[number] if number < len(starts) else len(self.paragraphs)
+            # Answer below the last non-empty paragraph of the task
+            anchor = end - 1
+            while anchor > start and not self.paragraphs[anchor].strip():
+                anchor -= 1
+            tasks.append(ExamTask(number, _join(self.paragraphs[start:end]), anchor, False))
+        return tasks
+
+    def numbered(self) -> str:
+        """Return the paragraphs as ``"<index>: <text>"`` lines."""
+        return "\n".join(f"{i}: {text}" for i, text in enumerate(self.paragraphs))
+
+    def copy(self) -> Tuple[Document, List[Paragraph]]:
+        """Return a fresh document and its paragraphs in template order.
+
+        The template itself is never modified, so copies may be created from
+        several threads at once.
+        """
+        # Copy the package rather than the ``Document`` proxy so the copied
+        # body is the one that gets saved
+        package = copy.deepcopy(self.document.part.package)
+        doc = package.main_document_part.document
+        return doc, doc.paragraphs
+
+    def fill_placeholders(
+        self, paragraphs: List[Paragraph], level: str, answer: str, color: RGBColor
+    ) -> bool:
+        """Replace every placeholder with ``answer``. Returns ``True`` if any."""
+        for i in self.placeholders:
+            para = paragraphs[i]
+            para.text = self.paragraphs[i].replace(PLACEHOLDER, "").rstrip()
+            insert_answer_after(para, level, answer, color, self.heading_style_id)
+        return bool(self.placeholders)
+
+    def fill_tasks(
+        self, paragraphs: List[Paragraph], answers: Sequence[str], level: str, color: RGBColor
+    ) -> None:
+        """Insert one answer per task of :attr:`tasks`, in the same order."""
+        for task, answer in zip(self.tasks, answers):
+            para = paragraphs[task.anchor]
+            if task.placeholder:
+                para.text = self.paragraphs[task.anchor].replace(PLACEHOLDER, "").rstrip()
+            insert_answer_after(para, level, answer, color, self.heading_style_id)
+
+    def insert_segments(
+        self,
+        paragraphs: List[Paragraph],
+        segments: Iterable[Tuple[int, str]],
+        level: str,
+        color: RGBColor,
+    ) -> bool:
+        """Insert ``(after, text)`` answer segments at template paragraph indexes.
+
+        ``after`` is treated as 1-based where possible. Returns ``True`` if at
+        least one segment was inserted.
+        """
+        made_change = False
+        count = len(paragraphs)
+        for idx, text in segments:
+            if idx > 0 and idx <= count:
+                idx -= 1  # treat response as 1-based index
+            if not text or idx < 0 or idx >= count:
+                continue
+            insert_answer_after(paragraphs[idx], level, text, color, self.heading_style_id)
+            made_change = True
+        return made_change
+
+
+def _join(lines: Iterable[str]) -> str:
+    return "\n".join(line.strip() for line in lines if line.strip())
+
+
+def append_answer(doc: Document, level: str, answer: str, color: RGBColor) -> None:
+    """Add the answer below the last paragraph of the document."""
+    # Add heading with graceful fallback if the "Heading 2" style is
+    # missing in the template
+    try:
+        head = doc.add_heading(f"{level.title()} Antwort:", level=2)
+    except KeyError:
+        head = doc.add_paragraph(f"{level.title()} Antwort:")
+        try:
+            head.style = "Heading2"
+        except KeyError:
+            pass
+    p = doc.add_paragraph()
+    run = p.add_run(answer)
+    run.font.color.rgb = color
+
+
+def to_bytes(doc: Document) -> bytes:
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
@@ -0,0 +1,159 @@
+"""Lightweight scan of uploaded exam documents.
+
+Instead of building the python-docx object model, the body of the docx is
+streamed out of the zip archive and parsed incrementally. The scan yields the
+same paragraph texts as ``Document(path).paragraphs`` and is used twice: the
+upload form rejects documents that look like AI results, and the resulting
+index of paragraphs, placeholders and headings is stored on the
+:class:`~simulator.models.ExamFile` so the simulation does not parse the exam
+again to plan its requests.
+"""
+
+from __future__ import annotations
+
+import posixpath
+import re
+import zipfile
+from typing import IO, Iterator, Tuple
+from xml.etree.ElementTree import iterparse
+
+from .docbuild import PLACEHOLDER
+
+INDEX_VERSION = 1
+RESULT_MARKER_RE = re.compile(r"(low|medium|high)\s+(antwort|answer)", re.IGNORECASE)
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_REL = "{http://schemas.openxmlformats.org/package/2006/relationships}Relationship"
+_OFFICE_DOCUMENT = "/officeDocument"
+_STYLES = "/styles"
+# Text equivalents of run content, as in ``Run.text`` of python-docx
+_RUN_TEXT = {
+    _W + "tab": "\t",
+    _W + "ptab": "\t",
+    _W + "cr": "\n",
+    _W + "noBreakHyphen": "-",
+}
+
+
+class ResultDocumentError(ValueError):
+    """The document contains answers inserted by a simulation."""
+
+
+def _rels(archive: zipfile.ZipFile, part: str) -> dict:
+    """Return ``{type suffix: target part}`` of the relationships of ``part``."""
+    folder, name = posixpath.split(part)
+    rels_name = posixpath.join(folder, "_rels", f"{name}.rels")
+    targets = {}
+    try:
+        with archive.open(rels_name) as fh:
+            for _, elem in iterparse(fh):
+                if elem.tag == _REL and elem.get("TargetMode") != "External":
+                    kind = "/" + elem.get("Type", "").rsplit("/", 1)[-1]
+                    target = elem.get("Target", "")
+                    if target.startswith("/"):
+                        target = target[1:]
+                    else:
+                        target = posixpath.normpath(posixpath.join(folder, target))
+                    targets.setdefault(kind, target)
+    except KeyError:
+        pass
+    return targets
+
+
+def _heading_style_ids(archive: zipfile.ZipFile, part: str | None) -> set:
+    """Return the ids of paragraph styles named "Heading ..."."""
+    ids = set()
+    if not part:
+        return ids
+    try:
+        with archive.open(part) as fh:
+            for _, elem in iterparse(fh):
+                if elem.tag == _W + "style":
+                    name = elem.find(_W + "name")
+                    style_id = elem.get(_W + "styleId")
+                    label = (name.get(_W + "val") or "") if name is not None else ""
+                    if style_id and label.lower().startswith("heading"):
+                        ids.add(style_id)
+                    elem.clear()
+    except KeyError:
+        pass
+    return ids
+
+
+def _iter_body_paragraphs(fh: IO[bytes]) -> Iterator[Tuple[str, str | None]]:
+    """Yield ``(text, style id)`` of the paragraphs directly in the body.
+
+    Like python-docx, only runs that are children of the paragraph or of one
+    of its hyperlinks contribute text; paragraphs in tables are skipped.
+    """
+    path: list = []
+    parts: list = []
+    style = None
+    for event, elem in iterparse(fh, events=("start", "end")):
+        if event == "start":
+            path.append(elem.tag)
+            continue
+        path.pop()
+        depth = len(path)
+        # path is now [document, body, p, (hyperlink,) r, ...] for run content
+        in_body_p = depth >= 3 and path[1] == _W + "body" and path[2] == _W + "p"
+        if in_body_p and path[-1] == _W + "r" and (
+            depth == 4 or (depth == 5 and path[3] == _W + "hyperlink")
+        ):
+            if elem.tag == _W + "t":
+                parts.append(elem.text or "")
+            elif elem.tag == _W + "br":
+                if elem.get(_W + "type", "textWrapping") == "textWrapping":
+                    parts.append("\n")
+            elif elem.tag in _RUN_TEXT:
+                parts.append(_RUN_TEXT[elem.tag])
+        elif elem.tag == _W + "pStyle" and depth == 4 and in_body_p and path[3] == _W + "pPr":
+            style = elem.get(_W + "val")
+        elif elem.tag == _W + "p" and depth == 2 and path[1] == _W + "body":
+            yield "".join(parts), style
+            parts = []
+            style = None
+            elem.clear()
+        elif depth == 2:
+            # Tables and other body content are not needed
+            elem.clear()
+
+
+def stored_index(exam) -> dict | None:
+    """Return the index stored on an ``ExamFile`` if it is usable."""
+    index = exam.index
+    if index and index.get("version") == INDEX_VERSION:
+        return index
+    return None
+
+
+def scan_exam(file) -> dict:
+    """Return the paragraph index of a docx exam given as path or file object.
+
+    Raises :class:`ResultDocumentError` as soon as the text looks like a
+    simulation result, and ``zipfile.BadZipFile``, ``KeyError`` or an XML
+    ``ParseError`` if the file is not a valid docx.
+    """
+    with zipfile.ZipFile(file) as archive:
+        main = _rels(archive, "").get(_OFFICE_DOCUMENT, "word/document.xml")
+        headings_ids = _heading_style_ids(archive, _rels(archive, main).get(_STYLES))
+        paragraphs = []
+        headings = []
+        tail = ""
+        with archive.open(main) as fh:
+            for index, (text, style) in enumerate(_iter_body_paragraphs(fh)):
+                # Keep the end of the previous paragraph so markers split
+                # across paragraphs are found as in the joined text
+                window = tail + "\n" + text
+                if RESULT_MARKER_RE.search(window):
+                    raise ResultDocumentError(text)
+                tail = window[-20:]
+                paragraphs.append(text)
+                if style in headings_ids:
+                    headings.append(index)
+    return {
+        "version": INDEX_VERSION,
+        "paragraphs": paragraphs,
+        "placeholders": [i for i, text in enumerate(paragraphs) if PLACEHOLDER in text],
+        "headings": headings,
+    }
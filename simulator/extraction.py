@@ -0,0 +1,315 @@
+"""Text extraction for uploaded exam and context files.
+
+Extracted text is cached in :class:`~simulator.models.ExtractedText` under the
+SHA-256 of the file content, so identical files are only parsed once even if
+they were uploaded to different sessions. Files are read as a stream of pages
+or paragraphs so extraction can stop once a character budget is used up.
+:func:`extract_texts` parses the PDF and docx files of a session concurrently
+in a process pool, because parsing them is CPU-bound and holds the GIL.
+"""
+
+from __future__ import annotations
+
+import csv
+import hashlib
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+from itertools import islice
+from typing import Iterator, NamedTuple, Sequence, Tuple
+
+import django
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from docx import Document
+from PyPDF2 import PdfReader
+
+from .models import ExtractedText
+from .storage import blob_hash
+
+HASH_CHUNK_SIZE = 1024 * 1024
+TEXT_CHUNK_SIZE = 64 * 1024
+# File types worth sending to another process; others are read directly
+PARALLEL_TYPES = {".pdf", ".docx"}
+
+
+class Extraction(NamedTuple):
+    """Text of one file returned by :func:`extract_texts`."""
+
+    path: str
+    text: str
+    # Time spent on this file; parsing time in the worker for parsed files
+    seconds: float
+    cached: bool
+
+
+_pools: dict[int, ProcessPoolExecutor] = {}
+_pools_lock = threading.Lock()
+
+
+def _get_pool(workers: int) -> ProcessPoolExecutor:
+    """Return the shared process pool with ``workers`` processes.
+
+    Pools are created once per process and reused. Their processes are
+    started by a fork server: forking the multithreaded web and worker
+    processes directly could copy a lock held by another thread into the
+    child and deadlock it.
+    """
+    with _pools_lock:
+        pool = _pools.get(workers)
+        if pool is None:
+            pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("forkserver"),
+                initializer=django.setup,
+            )
+            _pools[workers] = pool
+        return pool
+
+
+def _discard_pool(pool: ProcessPoolExecutor) -> None:
+    """Forget a pool whose processes died so the next call starts a new one."""
+    with _pools_lock:
+        for workers, existing in list(_pools.items()):
+            if existing is pool:
+                del _pools[workers]
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _iter_pdf_range(path: str, start: int, stop: int) -> list[str]:
+    """Extract the text of pages ``start`` to ``stop`` (used by worker processes)."""
+    with open(path, "rb") as fh:
+        reader = PdfReader(fh)
+        return [(reader.pages[i].extract_text() or "") for i in range(start, stop)]
+
+
+def _iter_pdf_pages(path: str, workers: int | None = None) -> Iterator[str]:
+    if workers is None:
+        workers = getattr(settings, "PDF_EXTRACT_WORKERS", 0)
+    try:
+        with open(path, "rb") as fh:
+            reader = PdfReader(fh)
+            page_count = len(reader.pages)
+            if workers <= 1 or page_count < getattr(settings, "PDF_PARALLEL_MIN_PAGES", 50):
+                for page in reader.pages:
+                    yield page.extract_text() or ""
+                return
+    except Exception:
+        return
+    yield from _iter_pdf_pages_parallel(path, page_count, workers)
+
+
+def _iter_pdf_pages_parallel(path: str, page_count: int, workers: int) -> Iterator[str]:
+    """Yield page texts in order while extracting batches in a process pool.
+
+    Only ``2 * workers`` batches are in flight at a time, so a consumer that
+    stops early does not pay for the rest of the document.
+    """
+    batch = getattr(settings, "PDF_PAGES_PER_TASK", 8)
+    ranges = [(i, min(i + batch, page_count)) for i in range(0, page_count, batch)]
+    pool = _get_pool(workers)
+    pending = deque()
+    ranges_iter = iter(ranges)
+    try:
+        for start, stop in islice(ranges_iter, 2 * workers):
+            pending.append(pool.submit(_iter_pdf_range, path, start, stop))
+        while pending:
+            pages = pending.popleft().result()
+            for start, stop in islice(ranges_iter, 1):
+                pending.append(pool.submit(_iter_pdf_range, path, start, stop))
+            yield from pages
+    except BrokenProcessPool:
+        _discard_pool(pool)
+        return
+    except Exception:
+        return
+    finally:
+        for fut in pending:
+            fut.cancel()
+
+
+def iter_text(path: str, page_workers: int | None = None) -> Iterator[str]:
+    """Yield the text of a file piece by piece.
+
+    PDFs are yielded per page, docx files per paragraph, CSV files per row
+    and everything else in fixed-size chunks. Concatenating the pieces gives
+    the full text. ``page_workers`` overrides ``PDF_EXTRACT_WORKERS``.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".docx":
+        pieces = (p.text for p in Document(path).paragraphs)
+    elif ext == ".csv":
+        fh = open(path, newline="", encoding="utf-8", errors="ignore")
+        pieces = _closing_iter(fh, (",".join(row) for row in csv.reader(fh)))
+    elif ext == ".pdf":
+        pieces = _iter_pdf_pages(path, page_workers)
+    else:
+        # Fallback to plain text
+        with open(path, "r", encoding="utf-8", errors="ignore") as fh:
+            yield from iter(lambda: fh.read(TEXT_CHUNK_SIZE), "")
+        return
+
+    for i, piece in enumerate(pieces):
+        yield piece if i == 0 else "\n" + piece
+
+
+def _closing_iter(fh, iterator: Iterator[str]) -> Iterator[str]:
+    with fh:
+        yield from iterator
+
+
+def read_text(
+    path: str, limit: int | None = None, page_workers: int | None = None
+) -> tuple[str, bool]:
+    """Return ``(text, truncated)`` reading at most ``limit`` characters.
+
+    Extraction stops as soon as the limit is reached, so only the needed part
+    of a large file is parsed and held in memory.
+    """
+    pieces: list[str] = []
+    size = 0
+    stream = iter_text(path, page_workers)
+    try:
+        for piece in stream:
+            if limit is not None and size + len(piece) > limit:
+                pieces.append(piece[: limit - size])
+                return "".join(pieces), True
+            pieces.append(piece)
+            size += len(piece)
+    finally:
+        stream.close()
+    return "".join(pieces), False
+
+
+def read_file(path: str) -> str:
+    """Return text content from a file path."""
+    return read_text(path)[0]
+
+
+def file_hash(path: str) -> str:
+    """Return the hex SHA-256 digest of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _cache_key(path: str) -> Tuple[str, str]:
+    # Uploaded files are named by their hash; only hash other files
+    content_hash = blob_hash(path) or file_hash(path)
+    return content_hash, os.path.splitext(path)[1].lower()
+
+
+def _lookup(key: Tuple[str, str], limit: int | None) -> str | None:
+    """Return the cached text of ``key`` if it covers ``limit`` characters."""
+    content_hash, file_type = key
+    entry = ExtractedText.objects.filter(
+        content_hash=content_hash, file_type=file_type
+    ).first()
+    if entry is None or (
+        entry.truncated and (limit is None or len(entry.text) < limit)
+    ):
+        return None
+    now = timezone.now()
+    # Only touch the entry once a day to keep cache hits read-only
+    if entry.last_used < now - timedelta(days=1):
+        ExtractedText.objects.filter(pk=entry.pk).update(last_used=now)
+    return entry.text[:limit] if limit is not None else entry.text
+
+
+def _store(key: Tuple[str, str], text: str, truncated: bool) -> None:
+    content_hash, file_type = key
+    fields = {"text": text, "truncated": truncated, "last_used": timezone.now()}
+    # Write without reading first so concurrent SQLite writers wait for the
+    # lock instead of failing on a lock upgrade
+    try:
+        with transaction.atomic():
+            updated = ExtractedText.objects.filter(
+                content_hash=content_hash, file_type=file_type
+            ).update(**fields)
+            if not updated:
+                ExtractedText.objects.create(
+                    content_hash=content_hash, file_type=file_type, **fields
+                )
+    except IntegrityError:
+        # Extracted concurrently by another request
+        pass
+
+
+def _parse(
+    path: str, limit: int | None, page_workers: int | None = None
+) -> tuple[str, bool, float]:
+    """Return ``(text, truncated, seconds)``; also run in worker processes."""
+    start = time.perf_counter()
+    text, truncated = read_text(path, limit, page_workers)
+    return text, truncated, time.perf_counter() - start
+
+
+def extract_text(path: str, limit: int | None = None) -> str:
+    """Return the text of ``path``, parsing the file only on a cache miss.
+
+    With ``limit`` at most that many characters are extracted and returned.
+    Callers that need to detect overflow should ask for one character more
+    than their budget.
+    """
+    return extract_texts([(path, limit)], workers=0)[0].text
+
+
+def extract_texts(
+    files: Sequence[Tuple[str, int | None]], workers: int | None = None
+) -> list[Extraction]:
+    """Return the texts of several ``(path, limit)`` pairs in the given order.
+
+    Cache hits are returned directly. PDF and docx files missing from the
+    cache are parsed in a shared pool of ``workers`` processes (default
+    ``EXTRACT_WORKERS``), all other files in the calling process. Every
+    result reports the time spent on its file.
+    """
+    if workers is None:
+        workers = getattr(settings, "EXTRACT_WORKERS", 0)
+    results: list[Extraction | None] = [None] * len(files)
+    misses = []
+    for i, (path, limit) in enumerate(files):
+        start = time.perf_counter()
+        key = _cache_key(path)
+        text = _lookup(key, limit)
+        if text is None:
+            misses.append((i, key))
+        else:
+            results[i] = Extraction(path, text, time.perf_counter() - start, True)
+
+    parallel = [i for i, key in misses if key[1] in PARALLEL_TYPES]
+    parsed = {}
+    if workers > 1 and len(parallel) > 1:
+        pool = _get_pool(workers)
+        try:
+            # Workers do not start page-parallel pools of their own
+            futures = {i: pool.submit(_parse, *files[i], 0) for i in parallel}
+            parsed = {i: future.result() for i, future in futures.items()}
+        except BrokenProcessPool:
+            # A worker died; parse the files here instead
+            _discard_pool(pool)
+            parsed = {}
+
+    for i, key in misses:
+        path, limit = files[i]
+        text, truncated, seconds = parsed[i] if i in parsed else _parse(path, limit)
+        _store(key, text, truncated)
+        results[i] = Extraction(path, text, seconds, False)
+    return results
+
+
+def evict_extracted_text(cutoff) -> int:
+    """Delete cache entries not used since ``cutoff``; ``None`` clears all."""
+    entries = ExtractedText.objects.all()
+    if cutoff is not None:
+        entries = entries.filter(last_used__lt=cutoff)
+    deleted, _ = entries.delete()
+    return deleted
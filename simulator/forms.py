@@ -1,6 +1,7 @@
 from django import forms
 import os
-import re
+
+from .examscan import ResultDocumentError, scan_exam
 
 
 class ContextUploadForm(forms.Form):
@@ -27,6 +28,8 @@ class ExamUploadForm(forms.Form):
     file = forms.FileField()
 
     ALLOWED_EXTENSIONS = {".docx"}
+    # Paragraph index of a valid upload, stored with the ExamFile
+    exam_index = None
 
     def clean_file(self):
         uploaded = self.cleaned_data["file"]
@@ -38,14 +41,11 @@ class ExamUploadForm(forms.Form):
             )
         if ext == ".docx":
             try:
-                from docx import Document
-
-                doc = Document(uploaded)
-                text = "\n".join(p.text for p in doc.paragraphs).lower()
-                if re.search(r"(low|medium|high)\s+(antwort|answer)", text):
-                    raise forms.ValidationError(
-                        "Uploaded file appears to be an AI result. Please use the original exam file."
-                    )
+                self.exam_index = scan_exam(uploaded)
+            except ResultDocumentError:
+                raise forms.ValidationError(
+                    "Uploaded file appears to be an AI result. Please use the original exam file."
+                )
             except Exception:
                 # If parsing fails we ignore the check but reset file pointer
                 pass
@@ -0,0 +1,324 @@
+"""Persistent job queue for running simulations outside the request cycle.
+
+Views enqueue a :class:`~simulator.models.SimulationJob` and return
+immediately. The ``simulation_worker`` management command claims queued jobs
+and runs :func:`simulator.services.generate_ai_results` for them, recording
+per-level progress that the index page polls.
+
+``AppConfig.max_running_simulations`` limits how many simulations run at once
+across all workers and streamed runs; further jobs stay queued and their
+status reports the queue position and an estimated wait.
+
+While no job is waiting, workers prepare the simulations of sessions whose
+files changed (see :mod:`simulator.warmstart`).
+"""
+
+from __future__ import annotations
+
+import math
+import os
+import socket
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import (
+    DatabaseError,
+    IntegrityError,
+    close_old_connections,
+    connection,
+    transaction,
+)
+from django.utils import timezone
+
+from config.utils import get_config
+from .models import SimulationJob
+from .services import LEVELS, generate_ai_results, prepare_simulation
+from .telemetry import recent_run_stats
+from .warmstart import claim_preparation, finish_preparation
+
+MAX_ATTEMPTS = 3
+
+
+def default_worker_name() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def active_job(session_id: str) -> SimulationJob | None:
+    """Return the queued or running job of a session, if any."""
+    return SimulationJob.objects.filter(
+        session_id=session_id, status__in=SimulationJob.ACTIVE_STATUSES
+    ).first()
+
+
+def latest_job(session_id: str) -> SimulationJob | None:
+    return SimulationJob.objects.filter(session_id=session_id).order_by("-created").first()
+
+
+async def alatest_job(session_id: str) -> SimulationJob | None:
+    return await SimulationJob.objects.filter(session_id=session_id).order_by("-created").afirst()
+
+
+def enqueue_simulation(session_id: str) -> tuple[SimulationJob, bool]:
+    """Queue a simulation for a session.
+
+    Returns ``(job, created)``. If the session already has an active job that
+    job is returned instead of creating a duplicate.
+    """
+    job = active_job(session_id)
+    if job:
+        return job, False
+    try:
+        with transaction.atomic():
+            job = SimulationJob.objects.create(
+                session_id=session_id,
+                progress={level: "pending" for level in LEVELS},
+            )
+    except IntegrityError:
+        # Another request queued a job for this session concurrently
+        job = active_job(session_id)
+        if job is None:
+            raise
+        return job, False
+    return job, True
+
+
+def start_job(session_id: str, worker: str) -> SimulationJob | None:
+    """Create a job that is run right away by ``worker`` instead of queued.
+
+    Returns ``None`` if the session already has an active job.
+    """
+    now = timezone.now()
+    try:
+        with transaction.atomic():
+            return SimulationJob.objects.create(
+                session_id=session_id,
+                status=SimulationJob.STATUS_RUNNING,
+                progress={level: "pending" for level in LEVELS},
+                worker=worker,
+                attempts=1,
+                started=now,
+                heartbeat=now,
+            )
+    except IntegrityError:
+        return None
+
+
+def has_capacity() -> bool:
+    """Return whether another simulation may start now.
+
+    The check is not atomic, so concurrent starts may briefly exceed the
+    limit by a few jobs.
+    """
+    limit = get_config().max_running_simulations
+    if not limit:
+        return True
+    return SimulationJob.objects.filter(status=SimulationJob.STATUS_RUNNING).count() < limit
+
+
+def queue_position(job: SimulationJob) -> int:
+    """Return the 1-based position of a queued job in the queue."""
+    return SimulationJob.objects.filter(
+        status=SimulationJob.STATUS_QUEUED, created__lt=job.created
+    ).count() + 1
+
+
+def estimated_wait(position: int) -> int:
+    """Estimate the seconds until the job at ``position`` has finished.
+
+    Jobs run in batches of the allowed parallel simulations, each taking as
+    long as recent runs did on average. With rate limits the requests and
+    tokens of all jobs up to ``position`` must also fit into the limits.
+    """
+    config = get_config()
+    stats = recent_run_stats()
+    slots = config.max_running_simulations or getattr(
+        settings, "SIMULATION_WORKER_CONCURRENCY", 2
+    )
+    wait = math.ceil(position / slots) * stats["duration"]
+    if config.rate_limit_rpm:
+        wait = max(wait, position * stats["requests"] * 60 / config.rate_limit_rpm)
+    if config.rate_limit_tpm:
+        wait = max(wait, position * stats["tokens"] * 60 / config.rate_limit_tpm)
+    return round(wait)
+
+
+def claim_next_job(worker: str) -> SimulationJob | None:
+    """Atomically mark the oldest queued job as running and return it.
+
+    Returns ``None`` if the queue is empty or no simulation may start.
+    """
+    while True:
+        if not has_capacity():
+            return None
+        job = SimulationJob.objects.filter(status=SimulationJob.STATUS_QUEUED).first()
+        if job is None:
+            return None
+        now = timezone.now()
+        claimed = SimulationJob.objects.filter(
+            pk=job.pk, status=SimulationJob.STATUS_QUEUED
+        ).update(
+            status=SimulationJob.STATUS_RUNNING,
+            worker=worker,
+            started=now,
+            heartbeat=now,
+            attempts=job.attempts + 1,
+        )
+        if claimed:
+            job.refresh_from_db()
+            return job
+
+
+def recover_stale_jobs(timeout: int | None = None) -> int:
+    """Requeue running jobs whose worker stopped sending heartbeats.
+
+    Jobs that already used up :data:`MAX_ATTEMPTS` are marked as failed.
+    Returns the number of recovered jobs.
+    """
+    if timeout is None:
+        timeout = getattr(settings, "SIMULATION_JOB_TIMEOUT", 600)
+    cutoff = timezone.now() - timedelta(seconds=timeout)
+    stale = SimulationJob.objects.filter(
+        status=SimulationJob.STATUS_RUNNING, heartbeat__lt=cutoff
+    )
+    stale.filter(attempts__gte=MAX_ATTEMPTS).update(
+        status=SimulationJob.STATUS_FAILED,
+        error="Worker stopped responding",
+        finished=timezone.now(),
+    )
+    return stale.update(status=SimulationJob.STATUS_QUEUED, worker="")
+
+
+def job_progress(job: SimulationJob):
+    """Return a progress callback that stores level states on ``job``."""
+
+    def progress(level: str, state: str) -> None:
+        job.progress[level] = state
+        job.heartbeat = timezone.now()
+        job.save(update_fields=["progress", "heartbeat"])
+
+    return progress
+
+
+def touch_job(job: SimulationJob) -> bool:
+    """Refresh the heartbeat of a running job."""
+    return bool(
+        SimulationJob.objects.filter(pk=job.pk, status=SimulationJob.STATUS_RUNNING).update(
+            heartbeat=timezone.now()
+        )
+    )
+
+
+def start_heartbeat(job: SimulationJob, interval: float | None = None) -> threading.Event:
+    """Refresh the job's heartbeat in a background thread until stopped.
+
+    Progress is only stored when a level finishes, which can take longer than
+    ``SIMULATION_JOB_TIMEOUT``; without heartbeats in between the job would be
+    requeued and run twice. Set the returned event to stop the thread.
+    """
+    if interval is None:
+        interval = getattr(settings, "SIMULATION_JOB_TIMEOUT", 600) / 4
+    stop = threading.Event()
+
+    def beat() -> None:
+        try:
+            while not stop.wait(interval):
+                try:
+                    touch_job(job)
+                except DatabaseError:
+                    # Try again with the next beat
+                    continue
+        finally:
+            connection.close()
+
+    threading.Thread(target=beat, name=f"heartbeat-{job.pk}", daemon=True).start()
+    return stop
+
+
+def finish_job(job: SimulationJob, error: Exception | None = None) -> None:
+    """Mark a running job as done or, if ``error`` is given, as failed."""
+    if error is not None:
+        job.status = SimulationJob.STATUS_FAILED
+        job.error = str(error)
+    else:
+        job.status = SimulationJob.STATUS_DONE
+        job.error = ""
+    job.finished = timezone.now()
+    job.save(update_fields=["status", "error", "finished"])
+
+
+def run_job(job: SimulationJob) -> None:
+    """Run the simulation of a claimed job and store the outcome."""
+    heartbeat = start_heartbeat(job)
+    try:
+        config = get_config()
+        generate_ai_results(
+            job.session_id, api_key=config.openai_api_key, progress=job_progress(job)
+        )
+    except Exception as exc:
+        finish_job(job, exc)
+    else:
+        finish_job(job)
+    finally:
+        heartbeat.set()
+
+
+def process_next_preparation() -> bool:
+    """Prepare one session if nothing else is waiting.
+
+    Returns ``False`` if there was nothing to prepare.
+    """
+    # Simulations that were actually started always come first
+    if SimulationJob.objects.filter(status=SimulationJob.STATUS_QUEUED).exists():
+        return False
+    if not has_capacity():
+        return False
+    prepared = claim_preparation()
+    if prepared is None:
+        return False
+    try:
+        config = get_config()
+        prompt, answers, usage = prepare_simulation(
+            prepared.session_id,
+            api_key=config.openai_api_key,
+            answers=config.prepare_answers,
+        )
+    except Exception as exc:
+        finish_preparation(prepared, error=exc)
+    else:
+        finish_preparation(prepared, prompt=prompt, answers=answers, usage=usage)
+    return True
+
+
+def process_next_job(worker: str) -> bool:
+    """Claim and run one job, or prepare a session while the queue is empty.
+
+    Returns ``False`` if there was nothing to do.
+    """
+    close_old_connections()
+    try:
+        job = claim_next_job(worker)
+        if job is None:
+            return process_next_preparation()
+        run_job(job)
+        return True
+    finally:
+        close_old_connections()
+
+
+def job_status(job: SimulationJob | None) -> dict:
+    """Return a JSON-serialisable summary of a job for status polling."""
+    if job is None:
+        return {"status": None, "progress": {}, "error": ""}
+    status = {
+        "id": job.pk,
+        "status": job.status,
+        "progress": job.progress,
+        "error": job.error,
+        "created": job.created.isoformat(),
+        "finished": job.finished.isoformat() if job.finished else None,
+    }
+    if job.status == SimulationJob.STATUS_QUEUED:
+        status["position"] = queue_position(job)
+        status["estimated_wait"] = estimated_wait(status["position"])
+    return status
@@ -0,0 +1,397 @@
+"""Single entry point for chat completion requests.
+
+Every completion the simulator requests goes through
+:func:`chat_completion` (or :func:`stream_chat_completion` for streamed
+answers), which measures the call and reports it to the run's
+:class:`~simulator.telemetry.RunRecorder`.
+
+Clients come from a process-wide registry keyed by API key and base URL. All
+clients share one connection pool, so keep-alive connections and TLS sessions
+are reused across simulations. Retries are done here rather than by the SDK:
+429 and 5xx responses and connection errors are retried with jittered
+exponential backoff that honours ``Retry-After``, and never beyond the
+deadline of the simulation. Before each attempt the request waits for the
+shared rate limit of :mod:`simulator.ratelimit`. If enabled, answers are
+looked up in and stored to :mod:`simulator.response_cache` first.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import email.utils
+import os
+import random
+import threading
+import time
+import weakref
+from typing import AsyncIterator
+
+import httpx
+import openai
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from . import ratelimit, response_cache
+from .budget import count_tokens
+from .prompt_builder import usage_counts
+from .telemetry import RunRecorder, stage
+
+RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+_clients: dict[tuple, openai.OpenAI] = {}
+_http_client: httpx.Client | None = None
+# Async connection pools cannot be shared between event loops
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict]" = (
+    weakref.WeakKeyDictionary()
+)
+_clients_lock = threading.Lock()
+
+
+class DeadlineExceeded(TimeoutError):
+    """The simulation ran out of time before the request could complete."""
+
+
+def _timeout() -> httpx.Timeout:
+    return httpx.Timeout(
+        getattr(settings, "OPENAI_READ_TIMEOUT", 120),
+        connect=getattr(settings, "OPENAI_CONNECT_TIMEOUT", 5),
+    )
+
+
+def _limits() -> httpx.Limits:
+    size = getattr(settings, "OPENAI_MAX_CONNECTIONS", 100)
+    return httpx.Limits(max_connections=size, max_keepalive_connections=size)
+
+
+def _client_key(api_key: str | None, base_url: str | None) -> tuple:
+    return (
+        api_key or os.environ.get("OPENAI_API_KEY"),
+        base_url or os.environ.get("OPENAI_BASE_URL"),
+    )
+
+
+def get_client(api_key: str | None = None, *, base_url: str | None = None) -> openai.OpenAI:
+    """Return the shared client for ``api_key`` and ``base_url``."""
+    global _http_client
+    key = _client_key(api_key, base_url)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            if _http_client is None:
+                _http_client = openai.DefaultHttpxClient(timeout=_timeout(), limits=_limits())
+            client = openai.OpenAI(
+                api_key=key[0],
+                base_url=key[1],
+                timeout=_timeout(),
+                max_retries=0,
+                http_client=_http_client,
+            )
+            _clients[key] = client
+        return client
+
+
+def get_async_client(
+    api_key: str | None = None, *, base_url: str | None = None
+) -> openai.AsyncOpenAI:
+    """Return the shared async client of the running event loop."""
+    key = _client_key(api_key, base_url)
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        clients = _async_clients.setdefault(loop, {})
+        if "http" not in clients:
+            clients["http"] = openai.DefaultAsyncHttpxClient(timeout=_timeout(), limits=_limits())
+        client = clients.get(key)
+        if client is None:
+            client = openai.AsyncOpenAI(
+                api_key=key[0],
+                base_url=key[1],
+                timeout=_timeout(),
+                max_retries=0,
+                http_client=clients["http"],
+            )
+            clients[key] = client
+        return client
+
+
+def close_clients() -> None:
+    """Drop all registered clients and close the shared connection pool."""
+    global _http_client
+    with _clients_lock:
+        _clients.clear()
+        _async_clients.clear()
+        if _http_client is not None:
+            _http_client.close()
+            _http_client = None
+
+
+def deadline_in(seconds: float | None) -> float | None:
+    """Return a ``time.monotonic()`` deadline ``seconds`` from now."""
+    return time.monotonic() + seconds if seconds else None
+
+
+def remaining(deadline: float | None) -> float | None:
+    """Return the seconds left until ``deadline``; raise if it passed."""
+    if deadline is None:
+        return None
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise DeadlineExceeded("Zeitlimit der Simulation überschritten")
+    return left
+
+
+def _is_retryable(exc: Exception) -> bool:
+    if isinstance(exc, openai.APIConnectionError):  # includes timeouts
+        return True
+    return isinstance(exc, openai.APIStatusError) and exc.status_code in RETRY_STATUS_CODES
+
+
+def _retry_after(exc: Exception) -> float | None:
+    """Return the delay requested by the server in seconds, if any."""
+    response = getattr(exc, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        return float(headers["retry-after-ms"]) / 1000
+    except (KeyError, ValueError):
+        pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        parsed = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        # Malformed header; fall back to the exponential backoff
+        return None
+    return max(0.0, parsed.timestamp() - time.time())
+
+
+def retry_delay(attempt: int, exc: Exception) -> float:
+    """Return how long to wait before retry number ``attempt`` (from 0)."""
+    requested = _retry_after(exc)
+    if requested is not None:
+        return requested
+    base = getattr(settings, "OPENAI_RETRY_BASE_DELAY", 1.0)
+    cap = min(getattr(settings, "OPENAI_RETRY_MAX_DELAY", 30.0), base * 2**attempt)
+    # "Equal jitter" spreads retries of concurrent requests while keeping
+    # at least half of the backoff
+    return random.uniform(cap / 2, cap)
+
+
+def _check_wait(delay: float, deadline: float | None, cause: Exception | None = None) -> float:
+    left = remaining(deadline)
+    if left is not None and delay >= left:
+        # Waiting would run past the deadline anyway
+        raise DeadlineExceeded("Zeitlimit der Simulation überschritten") from cause
+    return delay
+
+
+def _next_delay(attempt: int, exc: Exception, deadline: float | None) -> float:
+    """Return the backoff before the next attempt or re-raise ``exc``."""
+    if not _is_retryable(exc) or attempt >= getattr(settings, "OPENAI_MAX_RETRIES", 4):
+        raise exc
+    return _check_wait(retry_delay(attempt, exc), deadline, exc)
+
+
+def _reserve(kwargs: dict, tokens: int | None) -> tuple[int | None, float]:
+    """Reserve rate limit capacity for a request.
+
+    Returns the reserved tokens (``None`` without limits) and the seconds to
+    wait before asking again.
+    """
+    if not any(ratelimit.limits()):
+        return None, 0.0
+    model = kwargs.get("model", "")
+    if tokens is None:
+        tokens = ratelimit.estimate_tokens(
+            model, kwargs.get("messages", []), kwargs.get("max_tokens")
+        )
+    return tokens, ratelimit.reserve(model, tokens)
+
+
+def _settle(kwargs: dict, tokens: int | None, counts: dict | None) -> None:
+    if tokens is None:
+        return
+    # Failed requests do not use tokens
+    used = 0
+    if counts is not None:
+        if counts.get("prompt_tokens") is None:
+            return
+        used = counts["prompt_tokens"] + (counts.get("completion_tokens") or 0)
+    ratelimit.settle(kwargs.get("model", ""), tokens, used)
+
+
+def _partial_counts(kwargs: dict, parts: list) -> dict:
+    """Estimate the usage of a stream that ended without reporting it."""
+    model = kwargs.get("model", "")
+    return {
+        "prompt_tokens": ratelimit.prompt_tokens(model, kwargs.get("messages", [])),
+        "completion_tokens": count_tokens("".join(parts), model),
+    }
+
+
+def _throttle(kwargs: dict, deadline: float | None, recorder: RunRecorder | None) -> int | None:
+    """Block until the shared rate limit admits the request."""
+    tokens = None
+    while True:
+        tokens, wait = _reserve(kwargs, tokens)
+        if not wait:
+            return tokens
+        with stage(recorder, "ratelimit"):
+            time.sleep(_check_wait(wait, deadline))
+
+
+async def _athrottle(
+    kwargs: dict, deadline: float | None, recorder: RunRecorder | None
+) -> int | None:
+    tokens = None
+    while True:
+        tokens, wait = await sync_to_async(_reserve)(kwargs, tokens)
+        if not wait:
+            return tokens
+        with stage(recorder, "ratelimit"):
+            await asyncio.sleep(_check_wait(wait, deadline))
+
+
+def _record(
+    recorder, purpose, level, kwargs, start, error=None, outcome="ok", **counts
+) -> None:
+    if recorder is None:
+        return
+    recorder.record_call(
+        purpose=purpose,
+        level=level,
+        model=kwargs.get("model", ""),
+        latency=time.perf_counter() - start,
+        outcome="error" if error else outcome,
+        error=str(error) if error else "",
+        **counts,
+    )
+
+
+def chat_completion(
+    client: openai.OpenAI,
+    *,
+    purpose: str,
+    level: str = "",
+    recorder: RunRecorder | None = None,
+    deadline: float | None = None,
+    **kwargs,
+):
+    """Call ``client.chat.completions.create`` and record latency and usage.
+
+    Transient failures are retried; no attempt runs past ``deadline`` (a
+    ``time.monotonic()`` value). Cached answers are returned without usage
+    and recorded with the outcome ``"cached"``.
+    """
+    start = time.perf_counter()
+    key = response_cache.cache_key(kwargs)
+    content = response_cache.lookup(key) if key else None
+    if content is not None:
+        _record(recorder, purpose, level, kwargs, start, outcome="cached")
+        return response_cache.as_completion(content, kwargs.get("model", ""))
+
+    attempt = 0
+    while True:
+        tokens = _throttle(kwargs, deadline, recorder)
+        try:
+            left = remaining(deadline)
+        except DeadlineExceeded:
+            _settle(kwargs, tokens, None)
+            raise
+        options = {"timeout": min(left, _timeout().read)} if left is not None else {}
+        start = time.perf_counter()
+        try:
+            response = client.chat.completions.create(**kwargs, **options)
+        except Exception as exc:
+            _settle(kwargs, tokens, None)
+            _record(recorder, purpose, level, kwargs, start, error=exc)
+            time.sleep(_next_delay(attempt, exc, deadline))
+            attempt += 1
+            continue
+        counts = usage_counts(response)
+        _settle(kwargs, tokens, counts)
+        _record(recorder, purpose, level, kwargs, start, **counts)
+        if key and response.choices and response.choices[0].message.content:
+            response_cache.store(
+                key, kwargs.get("model", ""), response.choices[0].message.content
+            )
+        return response
+
+
+async def stream_chat_completion(
+    client: openai.AsyncOpenAI,
+    *,
+    purpose: str,
+    level: str = "",
+    recorder: RunRecorder | None = None,
+    usage: dict | None = None,
+    deadline: float | None = None,
+    **kwargs,
+) -> AsyncIterator[str]:
+    """Stream a completion and yield its text deltas.
+
+    The call is recorded like :func:`chat_completion` once the stream ends.
+    Usage is requested in the final chunk of the stream and copied into
+    ``usage`` if a dict is given. Opening the stream is retried like
+    :func:`chat_completion`; a stream that breaks off is not. A cached
+    answer is yielded as a single delta.
+    """
+    start = time.perf_counter()
+    key = await sync_to_async(response_cache.cache_key)(kwargs)
+    content = await sync_to_async(response_cache.lookup)(key) if key else None
+    if content is not None:
+        _record(recorder, purpose, level, kwargs, start, outcome="cached")
+        yield content
+        return
+
+    attempt = 0
+    while True:
+        tokens = await _athrottle(kwargs, deadline, recorder)
+        try:
+            left = remaining(deadline)
+        except DeadlineExceeded:
+            await sync_to_async(_settle)(kwargs, tokens, None)
+            raise
+        options = {"timeout": min(left, _timeout().read)} if left is not None else {}
+        start = time.perf_counter()
+        try:
+            stream = await client.chat.completions.create(
+                stream=True, stream_options={"include_usage": True}, **kwargs, **options
+            )
+            break
+        except Exception as exc:
+            await sync_to_async(_settle)(kwargs, tokens, None)
+            _record(recorder, purpose, level, kwargs, start, error=exc)
+            await asyncio.sleep(_next_delay(attempt, exc, deadline))
+            attempt += 1
+
+    final = None
+    parts = []
+    try:
+        async for chunk in stream:
+            if getattr(chunk, "usage", None) is not None:
+                final = chunk
+            for choice in chunk.choices:
+                if choice.delta.content:
+                    parts.append(choice.delta.content)
+                    yield choice.delta.content
+    except Exception as exc:
+        _record(recorder, purpose, level, kwargs, start, error=exc)
+        raise
+    finally:
+        # Also when the stream fails or is cancelled part way; the tokens
+        # streamed so far were used
+        if tokens is not None:
+            used = usage_counts(final) if final is not None else _partial_counts(kwargs, parts)
+            await sync_to_async(_settle)(kwargs, tokens, used)
+    counts = usage_counts(final)
+    if usage is not None:
+        usage.update(counts)
+    _record(recorder, purpose, level, kwargs, start, **counts)
+    if key and parts:
+        await sync_to_async(response_cache.store)(key, kwargs.get("model", ""), "".join(parts))
@@ -1,13 +1,31 @@
 from datetime import timedelta
+import json
+import os
 import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from django.conf import settings
+from django.core.files.storage import default_storage
 from django.core.management import BaseCommand, call_command
-from django.db import OperationalError
+from django.db import OperationalError, transaction
 from django.utils import timezone
 
-from simulator.models import ContextFile, ExamFile, AIResult
+from simulator.extraction import evict_extracted_text
+from simulator.response_cache import evict as evict_responses
+from simulator.models import (
+    AIResult,
+    ContextFile,
+    ExamFile,
+    PreparedSimulation,
+    Session,
+    SimulationJob,
+)
+from simulator.storage import is_blob, upload_storage
+
+FILE_MODELS = (ContextFile, ExamFile, AIResult)
+JOURNAL_NAME = ".clean_sessions.journal"
 
 
 class Command(BaseCommand):
@@ -15,7 +33,9 @@ class Command(BaseCommand):
 
     help = (
         "Remove uploaded files and database objects for stale sessions "
-        "and clear expired Django sessions. Use --all to remove everything."
+        "and clear expired Django sessions. Use --all to remove everything. "
+        "Sessions are deleted in batches; an interrupted run is resumed by "
+        "running the command again."
     )
 
     def add_arguments(self, parser):
@@ -24,46 +44,181 @@ class Command(BaseCommand):
             action="store_true",
             help="Delete all sessions regardless of age",
         )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report what would be deleted",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Number of sessions deleted per database transaction",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=8,
+            help="Number of threads used to delete files",
+        )
 
     def handle(self, *args, **options):
         lifetime = getattr(settings, "SESSION_LIFETIME_DAYS", 7)
-        cutoff = timezone.now() - timedelta(days=lifetime)
+        cutoff = None if options.get("all") else timezone.now() - timedelta(days=lifetime)
+        dry_run = options["dry_run"]
+        batch_size = max(1, options["batch_size"])
+        workers = max(1, options["workers"])
+        journal = Path(settings.MEDIA_ROOT) / JOURNAL_NAME
+
+        if not dry_run and journal.exists():
+            pending = self._unreferenced(self._read_journal(journal))
+            self.stdout.write(f"Resuming: removing {len(pending)} file(s) from an interrupted run.")
+            self._remove_files(pending, workers)
+            journal.unlink()
 
         try:
-            if options.get("all"):
-                session_ids = set(ContextFile.objects.values_list("session_id", flat=True))
-                session_ids.update(ExamFile.objects.values_list("session_id", flat=True))
-                session_ids.update(AIResult.objects.values_list("session_id", flat=True))
-            else:
-                session_ids = set(
-                    ContextFile.objects.filter(upload_time__lt=cutoff).values_list("session_id", flat=True)
-                )
-                session_ids.update(
-                    ExamFile.objects.filter(upload_time__lt=cutoff).values_list("session_id", flat=True)
-                )
-                session_ids.update(
-                    AIResult.objects.filter(session_id__in=session_ids).values_list("session_id", flat=True)
-                )
+            session_ids = self._stale_session_ids(cutoff)
         except OperationalError:
             self.stdout.write("Database not initialized; skipping cleanup.")
             return
 
+        label = "session(s)" if options.get("all") else "stale session(s)"
         if session_ids:
-            for sid in session_ids:
-                for model in [ContextFile, ExamFile, AIResult]:
-                    for obj in model.objects.filter(session_id=sid):
-                        if hasattr(obj, "file"):
-                            obj.file.delete(save=False)
-                        obj.delete()
-
-                session_dir = Path(settings.MEDIA_ROOT) / "ai_results" / sid
-                if session_dir.exists():
-                    shutil.rmtree(session_dir, ignore_errors=True)
-
-            label = "session(s)" if options.get("all") else "stale session(s)"
+            start = time.monotonic()
+            files_total = 0
+            for offset in range(0, len(session_ids), batch_size):
+                batch = session_ids[offset:offset + batch_size]
+                files = self._collect_files(batch)
+                files_total += len(files)
+                if not dry_run:
+                    self._delete_batch(batch, files, journal, workers)
+                done = offset + len(batch)
+                rate = done / max(time.monotonic() - start, 1e-6)
+                self.stdout.write(
+                    f"{'Would delete' if dry_run else 'Deleted'} {done}/{len(session_ids)} "
+                    f"{label}, {files_total} file(s) ({rate:.0f} sessions/s)"
+                )
+
+            if dry_run:
+                self.stdout.write(f"Dry run: {len(session_ids)} {label} would be deleted.")
+                return
             self.stdout.write(f"Deleted {len(session_ids)} {label}.")
         else:
             self.stdout.write("No stale sessions found.")
 
+        if dry_run:
+            return
+
+        evicted = evict_extracted_text(cutoff)
+        if evicted:
+            self.stdout.write(f"Evicted {evicted} cached text extraction(s).")
+        evicted = evict_responses()
+        if evicted:
+            self.stdout.write(f"Evicted {evicted} cached AI answer(s).")
+
         # Also clear expired Django sessions
         call_command("clearsessions")
+
+    def _stale_session_ids(self, cutoff) -> list:
+        """Return the ids of sessions to delete, oldest first."""
+        sessions = Session.objects.all()
+        if cutoff is not None:
+            sessions = sessions.filter(last_activity__lt=cutoff)
+        session_ids = sessions.order_by("last_activity").values_list("session_id", flat=True)
+
+        # Never remove files a running simulation still works on
+        active = set(
+            SimulationJob.objects.filter(
+                status__in=SimulationJob.ACTIVE_STATUSES
+            ).values_list("session_id", flat=True)
+        )
+        return [sid for sid in session_ids if sid not in active]
+
+    def _collect_files(self, batch: list) -> list:
+        names = []
+        for model in FILE_MODELS:
+            names.extend(
+                name
+                for name in model.objects.filter(session_id__in=batch).values_list("file", flat=True)
+                if name
+            )
+        return names
+
+    def _delete_batch(self, batch: list, files: list, journal: Path, workers: int) -> None:
+        # Record the files before the rows are gone so an interrupted run can
+        # still remove them. Shared uploads are released together with their
+        # rows instead and only removed once no other session uses them.
+        blobs = [name for name in files if is_blob(name)]
+        entries = [name for name in files if not is_blob(name)]
+        entries += [f"ai_results/{sid}/" for sid in batch]
+        journal.parent.mkdir(parents=True, exist_ok=True)
+        with open(journal, "w", encoding="utf-8") as fh:
+            json.dump(entries, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+
+        with transaction.atomic():
+            for model in FILE_MODELS:
+                model.objects.filter(session_id__in=batch).delete()
+            SimulationJob.objects.filter(session_id__in=batch).delete()
+            PreparedSimulation.objects.filter(session_id__in=batch).delete()
+            Session.objects.filter(session_id__in=batch).delete()
+            upload_storage.release(blobs)
+
+        self._remove_files(entries, workers)
+        journal.unlink()
+
+    def _read_journal(self, journal: Path) -> list:
+        try:
+            with open(journal, encoding="utf-8") as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return []
+
+    def _unreferenced(self, entries: list) -> list:
+        """Drop journal entries whose rows survived an interrupted transaction.
+
+        A result directory is only kept if its session has no results and no
+        running simulation that could store some.
+        """
+        names = [name for name in entries if not name.endswith("/")]
+        directories = {
+            name: name.rstrip("/").rsplit("/", 1)[-1] for name in entries if name.endswith("/")
+        }
+        referenced = set()
+        for offset in range(0, len(names), 500):
+            chunk = names[offset:offset + 500]
+            for model in FILE_MODELS:
+                referenced.update(
+                    model.objects.filter(file__in=chunk).values_list("file", flat=True)
+                )
+        session_ids = list(set(directories.values()))
+        in_use = set()
+        for offset in range(0, len(session_ids), 500):
+            chunk = session_ids[offset:offset + 500]
+            in_use.update(
+                AIResult.objects.filter(session_id__in=chunk).values_list("session_id", flat=True)
+            )
+            in_use.update(
+                SimulationJob.objects.filter(
+                    session_id__in=chunk, status__in=SimulationJob.ACTIVE_STATUSES
+                ).values_list("session_id", flat=True)
+            )
+        return [
+            name
+            for name in entries
+            if name not in referenced and directories.get(name) not in in_use
+        ]
+
+    def _remove_files(self, entries: list, workers: int) -> None:
+        def remove(name: str) -> None:
+            if name.endswith("/"):
+                shutil.rmtree(Path(settings.MEDIA_ROOT) / name, ignore_errors=True)
+                return
+            try:
+                default_storage.delete(name)
+            except OSError:
+                pass
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(remove, entries))
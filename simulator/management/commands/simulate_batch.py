@@ -0,0 +1,115 @@
+import time
+
+from django.core.management import BaseCommand, CommandError, call_command
+from django.utils import timezone
+
+from config.utils import get_config
+from simulator.batch import collect_batch, collect_pending, import_exams, submit_batch
+from simulator.jobs import enqueue_simulation
+from simulator.models import ExamFile, SimulationJob
+
+
+class Command(BaseCommand):
+    """Simulate many sessions in one go."""
+
+    help = (
+        "Simulate the given sessions, or one new session per exam in --exams. "
+        "By default the simulations are queued and processed right away with "
+        "high concurrency; --openai-batch submits them to the OpenAI Batch API "
+        "at half the price instead."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("session_ids", nargs="*", help="Sessions to simulate")
+        parser.add_argument("--exams", help="Directory with one exam (.docx) per session")
+        parser.add_argument(
+            "--context",
+            help="Optional directory with context files used for every exam in --exams",
+        )
+        parser.add_argument(
+            "--openai-batch",
+            action="store_true",
+            help="Submit all requests as one OpenAI batch instead of running them",
+        )
+        parser.add_argument(
+            "--wait",
+            action="store_true",
+            help="With --openai-batch, wait for the batch and store its results",
+        )
+        parser.add_argument(
+            "--collect",
+            action="store_true",
+            help="Store the results of all finished OpenAI batches and exit",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=8,
+            help="Simulations processed in parallel by the local runner",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=60.0,
+            help="Seconds between status checks of a submitted batch",
+        )
+
+    def handle(self, *args, **options):
+        api_key = get_config().openai_api_key
+        if options["collect"]:
+            collected = collect_pending(api_key=api_key)
+            self.stdout.write(f"Collected {collected} finished batch(es).")
+            return
+
+        session_ids = list(options["session_ids"])
+        if options["exams"]:
+            try:
+                session_ids += import_exams(options["exams"], options["context"])
+            except (OSError, ValueError) as exc:
+                raise CommandError(str(exc))
+        if not session_ids:
+            raise CommandError("Give session ids or --exams")
+        with_exam = set(
+            ExamFile.objects.filter(session_id__in=session_ids).values_list(
+                "session_id", flat=True
+            )
+        )
+        missing = [sid for sid in session_ids if sid not in with_exam]
+        if missing:
+            raise CommandError(f"No exam uploaded for: {', '.join(missing)}")
+
+        if options["openai_batch"]:
+            batch = submit_batch(session_ids, api_key=api_key)
+            self.stdout.write(
+                f"Submitted batch {batch.openai_batch_id} with {batch.request_count} "
+                f"request(s) for {len(session_ids)} session(s)."
+            )
+            if not options["wait"]:
+                self.stdout.write("Run with --collect later to store the results.")
+                return
+            while not collect_batch(batch, api_key=api_key):
+                self.stdout.write(f"Batch is {batch.remote_status}...")
+                time.sleep(options["poll_interval"])
+            self.stdout.write(
+                f"Stored results of {batch.stored_count} of {len(session_ids)} session(s)."
+            )
+            if batch.error:
+                self.stderr.write(batch.error)
+            return
+
+        started = timezone.now()
+        created = sum(enqueue_simulation(sid)[1] for sid in session_ids)
+        self.stdout.write(f"Queued {created} simulation(s).")
+        call_command(
+            "simulation_worker",
+            once=True,
+            concurrency=options["concurrency"],
+            stdout=self.stdout,
+            stderr=self.stderr,
+        )
+        done = SimulationJob.objects.filter(
+            session_id__in=session_ids,
+            status=SimulationJob.STATUS_DONE,
+            finished__gte=started,
+        ).values("session_id").distinct().count()
+        self.stdout.write(f"Simulated {done} of {len(session_ids)} session(s).")
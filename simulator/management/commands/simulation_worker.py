@@ -0,0 +1,80 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.management import BaseCommand
+
+from simulator.jobs import default_worker_name, process_next_job, recover_stale_jobs
+
+
+class Command(BaseCommand):
+    """Process queued AI simulations."""
+
+    help = (
+        "Run queued simulations in the background. Jobs left running by a "
+        "crashed worker are requeued on start-up."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=getattr(settings, "SIMULATION_WORKER_CONCURRENCY", 2),
+            help="Number of simulations processed in parallel",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=2.0,
+            help="Seconds to wait before checking an empty queue again",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Process all queued jobs and exit instead of polling forever",
+        )
+
+    def handle(self, *args, **options):
+        concurrency = max(1, options["concurrency"])
+        interval = options["poll_interval"]
+        once = options["once"]
+        name = default_worker_name()
+
+        recovered = recover_stale_jobs()
+        if recovered:
+            self.stdout.write(f"Requeued {recovered} interrupted job(s).")
+        self.stdout.write(f"Worker {name} started with concurrency {concurrency}.")
+
+        stop = threading.Event()
+
+        def loop(slot: int) -> None:
+            worker = f"{name}/{slot}"
+            while not stop.is_set():
+                if process_next_job(worker):
+                    continue
+                if once:
+                    return
+                stop.wait(interval)
+                recover_stale_jobs()
+
+        if concurrency == 1:
+            try:
+                loop(0)
+            except KeyboardInterrupt:
+                self.stdout.write("Worker stopped.")
+            return
+
+        threads = [
+            threading.Thread(target=loop, args=(slot,), daemon=True)
+            for slot in range(concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            while any(thread.is_alive() for thread in threads):
+                time.sleep(0.2)
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping worker after running jobs finish...")
+            stop.set()
+            for thread in threads:
+                thread.join()
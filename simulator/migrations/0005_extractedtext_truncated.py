@@ -0,0 +1,18 @@
+# Generated by Django 4.2.23 on 2026-10-18 13:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simulator', '0004_extractedtext'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='extractedtext',
+            name='truncated',
+            field=models.BooleanField(default=False),
+        ),
+    ]
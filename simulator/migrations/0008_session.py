@@ -0,0 +1,29 @@
+# Generated by Django 4.2.23 on 2026-10-18 13:11
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simulator', '0007_simulation_telemetry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Session',
+            fields=[
+                ('session_id', models.CharField(max_length=40, primary_key=True, serialize=False)),
+                ('context_count', models.PositiveIntegerField(default=0)),
+                ('exam_count', models.PositiveIntegerField(default=0)),
+                ('result_count', models.PositiveIntegerField(default=0)),
+                ('total_bytes', models.PositiveBigIntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('last_activity', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['last_activity', 'session_id'], name='session_activity_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,51 @@
+from django.core.files.storage import default_storage
+from django.db import migrations
+from django.db.models import Max
+
+
+def _size(name):
+    try:
+        return default_storage.size(name)
+    except OSError:
+        return 0
+
+
+def backfill_sessions(apps, schema_editor):
+    Session = apps.get_model("simulator", "Session")
+    sources = {
+        "context_count": apps.get_model("simulator", "ContextFile"),
+        "exam_count": apps.get_model("simulator", "ExamFile"),
+        "result_count": apps.get_model("simulator", "AIResult"),
+    }
+    summaries = {}
+    for field, model in sources.items():
+        for session_id, name in model.objects.values_list("session_id", "file").iterator():
+            summary = summaries.setdefault(session_id, {"total_bytes": 0})
+            summary[field] = summary.get(field, 0) + 1
+            summary["total_bytes"] += _size(name)
+
+    activity = {}
+    for model in (sources["context_count"], sources["exam_count"]):
+        for row in model.objects.values("session_id").annotate(last=Max("upload_time")):
+            current = activity.get(row["session_id"])
+            if current is None or row["last"] > current:
+                activity[row["session_id"]] = row["last"]
+
+    sessions = []
+    for session_id, summary in summaries.items():
+        session = Session(session_id=session_id, **summary)
+        if session_id in activity:
+            session.last_activity = activity[session_id]
+        sessions.append(session)
+    Session.objects.bulk_create(sessions, batch_size=500, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("simulator", "0008_session"),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_sessions, migrations.RunPython.noop),
+    ]
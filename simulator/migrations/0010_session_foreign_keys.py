@@ -0,0 +1,35 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def _session_fk(related_name):
+    return models.ForeignKey(
+        db_column="session_id",
+        on_delete=django.db.models.deletion.CASCADE,
+        related_name=related_name,
+        to="simulator.session",
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("simulator", "0009_backfill_sessions"),
+    ]
+
+    operations = [
+        migrations.RenameField("contextfile", "session_id", "session"),
+        migrations.AlterField("contextfile", "session", _session_fk("context_files")),
+        migrations.RenameField("examfile", "session_id", "session"),
+        migrations.AlterField("examfile", "session", _session_fk("exam_files")),
+        migrations.RenameField("airesult", "session_id", "session"),
+        migrations.AlterField("airesult", "session", _session_fk("results")),
+        migrations.AddIndex(
+            model_name="contextfile",
+            index=models.Index(fields=["session", "upload_time"], name="contextfile_session_time_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="examfile",
+            index=models.Index(fields=["session", "upload_time"], name="examfile_session_time_idx"),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.23 on 2026-10-18 13:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simulator', '0011_ratelimitbucket'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CachedResponse',
+            fields=[
+                ('key', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('model', models.CharField(max_length=100)),
+                ('content', models.TextField()),
+                ('size', models.PositiveIntegerField()),
+                ('hits', models.PositiveIntegerField(default=0)),
+                ('created', models.DateTimeField()),
+                ('last_used', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.23 on 2026-10-18 13:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simulator', '0012_cachedresponse'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SimulationBatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('openai_batch_id', models.CharField(max_length=100)),
+                ('status', models.CharField(choices=[('submitted', 'Submitted'), ('done', 'Done'), ('failed', 'Failed')], db_index=True, default='submitted', max_length=10)),
+                ('remote_status', models.CharField(blank=True, max_length=20)),
+                ('session_ids', models.JSONField(default=list)),
+                ('request_count', models.PositiveIntegerField(default=0)),
+                ('stored_count', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['-created'],
+            },
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 4.2.23 on 2026-10-18 13:45
+
+import os
+
+from django.db import migrations, models
+import simulator.storage
+
+
+def backfill_original_names(apps, schema_editor):
+    # Files uploaded before keep their names on disk
+    for model_name in ("ContextFile", "ExamFile"):
+        model = apps.get_model("simulator", model_name)
+        for obj in model.objects.filter(original_name="").only("file").iterator():
+            model.objects.filter(pk=obj.pk).update(
+                original_name=os.path.basename(obj.file.name)
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simulator', '0013_simulationbatch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredBlob',
+            fields=[
+                ('name', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('size', models.PositiveBigIntegerField()),
+                ('refs', models.IntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='contextfile',
+            name='original_name',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='examfile',
+            name='original_name',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='contextfile',
+            name='file',
+            field=models.FileField(storage=simulator.storage.get_upload_storage, upload_to='context_files/'),
+        ),
+        migrations.AlterField(
+            model_name='examfile',
+            name='file',
+            field=models.FileField(storage=simulator.storage.get_upload_storage, upload_to='exam_files/'),
+        ),
+        migrations.RunPython(backfill_original_names, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.23 on 2026-10-18 13:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simulator', '0014_content_addressed_uploads'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='examfile',
+            name='index',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.23 on 2026-10-18 13:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simulator', '0015_examfile_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='simulationrun',
+            name='files',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
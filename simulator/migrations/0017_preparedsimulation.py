@@ -0,0 +1,27 @@
+# Generated by Django 4.2.23 on 2026-10-18 13:53
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simulator', '0016_simulationrun_files'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PreparedSimulation',
+            fields=[
+                ('session_id', models.CharField(max_length=40, primary_key=True, serialize=False)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('ready', 'Ready'), ('failed', 'Failed')], db_index=True, default='pending', max_length=10)),
+                ('fingerprint', models.CharField(blank=True, max_length=64)),
+                ('prompt', models.TextField(blank=True)),
+                ('answers', models.JSONField(blank=True, default=dict)),
+                ('usage', models.JSONField(blank=True, default=dict)),
+                ('error', models.TextField(blank=True)),
+                ('updated', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.23 on 2026-10-18 14:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simulator', '0017_preparedsimulation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='simulationbatch',
+            name='planned',
+            field=models.JSONField(default=dict),
+        ),
+    ]
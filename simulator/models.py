@@ -1,28 +1,128 @@
 """Database models for the simulator app."""
 
-from django.db import models
+import os
+
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, models, transaction
+from django.utils import timezone
+
+from .storage import get_upload_storage
+
+
+class Session(models.Model):
+    """Summary of the files stored for one upload session.
+
+    The counters are refreshed whenever files of the session change so that
+    listings do not need to aggregate the file tables.
+    """
+
+    session_id = models.CharField(max_length=40, primary_key=True)
+    context_count = models.PositiveIntegerField(default=0)
+    exam_count = models.PositiveIntegerField(default=0)
+    result_count = models.PositiveIntegerField(default=0)
+    total_bytes = models.PositiveBigIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    last_activity = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["last_activity", "session_id"], name="session_activity_idx"),
+        ]
+
+    @classmethod
+    def ensure(cls, session_id: str) -> "Session":
+        """Return the session row, creating it if needed."""
+        session, _ = cls.objects.get_or_create(session_id=session_id)
+        return session
+
+    @classmethod
+    def refresh(cls, session_id: str) -> None:
+        """Recalculate the summary of a session and mark it as active."""
+        counts = {}
+        total = 0
+        for field, model in (
+            ("context_count", ContextFile),
+            ("exam_count", ExamFile),
+            ("result_count", AIResult),
+        ):
+            names = list(
+                model.objects.filter(session_id=session_id).values_list("file", flat=True)
+            )
+            counts[field] = len(names)
+            total += sum(_stored_size(name) for name in names)
+        values = {**counts, "total_bytes": total, "last_activity": timezone.now()}
+        # Update without reading first: on SQLite a transaction that has read
+        # cannot take the write lock while another connection is writing
+        if cls.objects.filter(session_id=session_id).update(**values):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(session_id=session_id, **values)
+        except IntegrityError:
+            cls.objects.filter(session_id=session_id).update(**values)
+
+    def __str__(self) -> str:  # pragma: no cover - simple representation
+        return f"Session({self.session_id})"
+
+
+def _stored_size(name: str) -> int:
+    try:
+        return default_storage.size(name)
+    except OSError:
+        return 0
 
 
 class ContextFile(models.Model):
     """File uploaded as additional context during a session."""
 
-    file = models.FileField(upload_to="context_files/")
+    file = models.FileField(upload_to="context_files/", storage=get_upload_storage)
+    # Name of the file as uploaded; stored files are named by their content
+    original_name = models.CharField(max_length=255, blank=True)
     upload_time = models.DateTimeField(auto_now_add=True)
-    session_id = models.CharField(max_length=40)
+    session = models.ForeignKey(
+        Session, on_delete=models.CASCADE, db_column="session_id", related_name="context_files"
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["session", "upload_time"], name="contextfile_session_time_idx"),
+        ]
 
     def __str__(self) -> str:  # pragma: no cover - simple representation
-        return f"ContextFile({self.file.name}) for {self.session_id}"
+        return f"ContextFile({self.original_name}) for {self.session_id}"
+
+    def save(self, *args, **kwargs):
+        if not self.original_name and self.file:
+            self.original_name = os.path.basename(self.file.name)
+        super().save(*args, **kwargs)
 
 
 class ExamFile(models.Model):
     """The exam file uploaded for a session."""
 
-    file = models.FileField(upload_to="exam_files/")
+    file = models.FileField(upload_to="exam_files/", storage=get_upload_storage)
+    # Name of the file as uploaded; stored files are named by their content
+    original_name = models.CharField(max_length=255, blank=True)
+    # Paragraphs, placeholders and headings found at upload time, see
+    # simulator.examscan; empty for exams uploaded before
+    index = models.JSONField(default=dict, blank=True)
     upload_time = models.DateTimeField(auto_now_add=True)
-    session_id = models.CharField(max_length=40)
+    session = models.ForeignKey(
+        Session, on_delete=models.CASCADE, db_column="session_id", related_name="exam_files"
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["session", "upload_time"], name="examfile_session_time_idx"),
+        ]
 
     def __str__(self) -> str:  # pragma: no cover - simple representation
-        return f"ExamFile({self.file.name}) for {self.session_id}"
+        return f"ExamFile({self.original_name}) for {self.session_id}"
+
+    def save(self, *args, **kwargs):
+        if not self.original_name and self.file:
+            self.original_name = os.path.basename(self.file.name)
+        super().save(*args, **kwargs)
 
 
 class AIResult(models.Model):
@@ -37,8 +137,245 @@ class AIResult(models.Model):
     ]
 
     level = models.CharField(max_length=10, choices=LEVEL_CHOICES)
-    session_id = models.CharField(max_length=40)
+    session = models.ForeignKey(
+        Session, on_delete=models.CASCADE, db_column="session_id", related_name="results"
+    )
+    # Token usage of the completion that produced the answer
+    prompt_tokens = models.PositiveIntegerField(null=True, blank=True)
+    completion_tokens = models.PositiveIntegerField(null=True, blank=True)
+    cached_tokens = models.PositiveIntegerField(null=True, blank=True)
 
     def __str__(self) -> str:  # pragma: no cover - simple representation
         return f"AIResult({self.level}) for {self.session_id}"
 
+
+
+class SimulationJob(models.Model):
+    """A queued AI simulation processed by the ``simulation_worker`` command."""
+
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, "Queued"),
+        (STATUS_RUNNING, "Running"),
+        (STATUS_DONE, "Done"),
+        (STATUS_FAILED, "Failed"),
+    ]
+    ACTIVE_STATUSES = (STATUS_QUEUED, STATUS_RUNNING)
+
+    session_id = models.CharField(max_length=40, db_index=True)
+    status = models.CharField(
+        max_length=10, choices=STATUS_CHOICES, default=STATUS_QUEUED, db_index=True
+    )
+    progress = models.JSONField(default=dict, blank=True)
+    error = models.TextField(blank=True)
+    worker = models.CharField(max_length=100, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    heartbeat = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["created"]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["session_id"],
+                condition=models.Q(status__in=["queued", "running"]),
+                name="unique_active_job_per_session",
+            )
+        ]
+
+    @property
+    def is_active(self) -> bool:
+        return self.status in self.ACTIVE_STATUSES
+
+    def __str__(self) -> str:  # pragma: no cover - simple representation
+        return f"SimulationJob({self.status}) for {self.session_id}"
+
+
+class PreparedSimulation(models.Model):
+    """Work done for a session before its simulation was started.
+
+    See :mod:`simulator.warmstart`. ``fingerprint`` identifies the files,
+    prompts and settings the work is based on; it is only reused while they
+    are unchanged.
+    """
+
+    STATUS_PENDING = "pending"
+    STATUS_RUNNING = "running"
+    STATUS_READY = "ready"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = [
+        (STATUS_PENDING, "Pending"),
+        (STATUS_RUNNING, "Running"),
+        (STATUS_READY, "Ready"),
+        (STATUS_FAILED, "Failed"),
+    ]
+
+    session_id = models.CharField(max_length=40, primary_key=True)
+    status = models.CharField(
+        max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING, db_index=True
+    )
+    fingerprint = models.CharField(max_length=64, blank=True)
+    # Base prompt built from the exam and context files
+    prompt = models.TextField(blank=True)
+    # Answers and token usage by "<level>:<task index>", if requested
+    answers = models.JSONField(default=dict, blank=True)
+    usage = models.JSONField(default=dict, blank=True)
+    error = models.TextField(blank=True)
+    updated = models.DateTimeField(default=timezone.now)
+
+    def __str__(self) -> str:  # pragma: no cover - simple representation
+        return f"PreparedSimulation({self.status}) for {self.session_id}"
+
+
+class ExtractedText(models.Model):
+    """Cached plain text of an uploaded file, keyed by its content hash."""
+
+    content_hash = models.CharField(max_length=64)
+    file_type = models.CharField(max_length=10)
+    text = models.TextField()
+    # True if extraction stopped at a character limit before the end
+    truncated = models.BooleanField(default=False)
+    created = models.DateTimeField(auto_now_add=True)
+    last_used = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        unique_together = ("content_hash", "file_type")
+
+    def __str__(self) -> str:  # pragma: no cover - simple representation
+        return f"ExtractedText({self.content_hash[:12]}{self.file_type})"
+
+
+class SimulationRun(models.Model):
+    """Timing information for one execution of the simulation pipeline."""
+
+    STATUS_CHOICES = [
+        ("running", "Running"),
+        ("done", "Done"),
+        ("failed", "Failed"),
+    ]
+
+    session_id = models.CharField(max_length=40, db_index=True)
+    model = models.CharField(max_length=100)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default="running")
+    started = models.DateTimeField(auto_now_add=True, db_index=True)
+    # Wall time of the whole run in seconds
+    duration = models.FloatField(null=True, blank=True)
+    # Seconds spent per pipeline stage, summed over parallel workers
+    stages = models.JSONField(default=dict, blank=True)
+    # Text extraction per file: name, type, seconds, characters, cached
+    files = models.JSONField(default=list, blank=True)
+    error = models.TextField(blank=True)
+
+    def __str__(self) -> str:  # pragma: no cover - simple representation
+        return f"SimulationRun({self.status}) for {self.session_id}"
+
+
+class LLMCall(models.Model):
+    """A single chat completion request made by the simulator."""
+
+    run = models.ForeignKey(
+        SimulationRun, on_delete=models.CASCADE, related_name="calls", null=True, blank=True
+    )
+    purpose = models.CharField(max_length=20)
+    level = models.CharField(max_length=10, blank=True)
+    model = models.CharField(max_length=100)
+    latency = models.FloatField()
+    prompt_tokens = models.PositiveIntegerField(null=True, blank=True)
+    completion_tokens = models.PositiveIntegerField(null=True, blank=True)
+    cached_tokens = models.PositiveIntegerField(null=True, blank=True)
+    outcome = models.CharField(max_length=10)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self) -> str:  # pragma: no cover - simple representation
+        return f"LLMCall({self.purpose}, {self.outcome})"
+
+
+class RateLimitBucket(models.Model):
+    """Token bucket of the OpenAI rate limits, shared by all processes.
+
+    ``requests`` and ``tokens`` are the amounts available at ``updated``
+    (seconds since the epoch); both refill continuously up to the per-minute
+    limits configured in ``AppConfig``.
+    """
+
+    name = models.CharField(max_length=100, primary_key=True)
+    requests = models.FloatField()
+    tokens = models.FloatField()
+    updated = models.FloatField()
+
+    def __str__(self) -> str:  # pragma: no cover - simple representation
+        return f"RateLimitBucket({self.name})"
+
+
+class StoredBlob(models.Model):
+    """An uploaded file shared by all rows with the same content.
+
+    ``refs`` counts the context and exam files referencing the blob; see
+    :mod:`simulator.storage`.
+    """
+
+    name = models.CharField(max_length=100, primary_key=True)
+    size = models.PositiveBigIntegerField()
+    refs = models.IntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self) -> str:  # pragma: no cover - simple representation
+        return f"StoredBlob({self.name}, {self.refs} refs)"
+
+
+class CachedResponse(models.Model):
+    """A chat completion answer stored by :mod:`simulator.response_cache`."""
+
+    # SHA-256 of the model, messages and parameters of the request
+    key = models.CharField(max_length=64, primary_key=True)
+    model = models.CharField(max_length=100)
+    content = models.TextField()
+    size = models.PositiveIntegerField()
+    hits = models.PositiveIntegerField(default=0)
+    created = models.DateTimeField()
+    last_used = models.DateTimeField(db_index=True)
+
+    def __str__(self) -> str:  # pragma: no cover - simple representation
+        return f"CachedResponse({self.key[:12]})"
+
+
+class SimulationBatch(models.Model):
+    """Simulations of several sessions submitted to the OpenAI Batch API."""
+
+    STATUS_SUBMITTED = "submitted"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = [
+        (STATUS_SUBMITTED, "Submitted"),
+        (STATUS_DONE, "Done"),
+        (STATUS_FAILED, "Failed"),
+    ]
+
+    openai_batch_id = models.CharField(max_length=100)
+    status = models.CharField(
+        max_length=10, choices=STATUS_CHOICES, default=STATUS_SUBMITTED, db_index=True
+    )
+    # Last state reported by OpenAI, e.g. "in_progress" or "completed"
+    remote_status = models.CharField(max_length=20, blank=True)
+    session_ids = models.JSONField(default=list)
+    # {session id: {"exam": exam pk, "requests": [[level, task index], ...]}}
+    # as planned at submission, so later changes to files or prompts cannot
+    # mix up the answers
+    planned = models.JSONField(default=dict)
+    request_count = models.PositiveIntegerField(default=0)
+    stored_count = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["-created"]
+
+    def __str__(self) -> str:  # pragma: no cover - simple representation
+        return f"SimulationBatch({self.openai_batch_id}, {self.status})"
@@ -0,0 +1,61 @@
+"""Construction of the chat messages sent for each performance level.
+
+Providers cache prompt prefixes that are byte-identical across requests. The
+messages are therefore laid out so that everything shared by the levels (the
+system prompt, the exam and context text and the base instructions) forms a
+stable prefix and only the final message differs per level (and task).
+"""
+
+from __future__ import annotations
+
+from typing import Dict, List
+
+Message = Dict[str, str]
+
+TASK_INSTRUCTIONS = {
+    "de": "Bearbeite nur Aufgabe {number} der Klausur:\n{task}",
+    "en": "Only answer task {number} of the exam:\n{task}",
+}
+
+
+def shared_prefix(prompts: dict, base_prompt: str) -> List[Message]:
+    """Return the messages that are identical for every level."""
+    return [
+        {"role": "system", "content": prompts["system"]},
+        {"role": "user", "content": f"{base_prompt}\n\n{prompts['base']}"},
+    ]
+
+
+def level_messages(prefix: List[Message], instruction: str) -> List[Message]:
+    """Append the level specific instruction to a shared prefix."""
+    return [*prefix, {"role": "user", "content": instruction}]
+
+
+def task_messages(
+    prefix: List[Message], instruction: str, number: int, task: str, language: str
+) -> List[Message]:
+    """Restrict the level instruction to a single task of the exam."""
+    template = TASK_INSTRUCTIONS.get(language, TASK_INSTRUCTIONS["en"])
+    return level_messages(
+        prefix, f"{instruction}\n\n{template.format(number=number, task=task)}"
+    )
+
+
+def usage_counts(response) -> dict:
+    """Return prompt, completion and cached token counts of a response."""
+    usage = getattr(response, "usage", None)
+    details = getattr(usage, "prompt_tokens_details", None)
+    return {
+        "prompt_tokens": getattr(usage, "prompt_tokens", None),
+        "completion_tokens": getattr(usage, "completion_tokens", None),
+        "cached_tokens": getattr(details, "cached_tokens", None),
+    }
+
+
+def sum_usage(counts: List[dict]) -> dict:
+    """Add up token counts of several responses, ignoring missing values."""
+    total = {}
+    for key in ("prompt_tokens", "completion_tokens", "cached_tokens"):
+        values = [c[key] for c in counts if c.get(key) is not None]
+        total[key] = sum(values) if values else None
+    return total
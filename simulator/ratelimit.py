@@ -0,0 +1,105 @@
+"""Rate limiting of OpenAI requests across all processes.
+
+Every chat completion takes one request and its estimated tokens from a token
+bucket stored in :class:`~simulator.models.RateLimitBucket`, so web and worker
+processes share the requests-per-minute and tokens-per-minute limits
+configured in ``AppConfig``. Once a response arrives the estimate is replaced
+by the tokens actually used.
+
+:func:`reserve` never blocks; it returns how long the caller has to wait
+before trying again. The waiting itself is done by :mod:`simulator.llm`.
+"""
+
+from __future__ import annotations
+
+import time
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from config.utils import get_config
+from .budget import count_tokens
+from .models import RateLimitBucket
+
+
+def limits() -> tuple[int, int]:
+    """Return the configured ``(requests, tokens)`` per minute; 0 is unlimited."""
+    config = get_config()
+    return config.rate_limit_rpm, config.rate_limit_tpm
+
+
+def prompt_tokens(model: str, messages: list) -> int:
+    """Count the tokens of the text content of ``messages``."""
+    return sum(
+        count_tokens(message["content"], model)
+        for message in messages
+        if isinstance(message.get("content"), str)
+    )
+
+
+def estimate_tokens(model: str, messages: list, max_tokens: int | None = None) -> int:
+    """Estimate the tokens a completion counts against the limit.
+
+    Like OpenAI, the prompt plus the maximum completion length is counted.
+    """
+    prompt = prompt_tokens(model, messages)
+    return prompt + (max_tokens or getattr(settings, "RATE_LIMIT_COMPLETION_TOKENS", 1000))
+
+
+def _create_bucket(name: str, rpm: int, tpm: int) -> None:
+    try:
+        with transaction.atomic():
+            RateLimitBucket.objects.create(
+                name=name, requests=rpm, tokens=tpm, updated=time.time()
+            )
+    except IntegrityError:
+        # Created concurrently by another process
+        pass
+
+
+def reserve(name: str, tokens: int) -> float:
+    """Take one request and ``tokens`` from bucket ``name`` if available.
+
+    Returns ``0`` on success, otherwise the seconds until enough capacity has
+    refilled. A request larger than the whole token limit is let through once
+    the bucket is full; the bucket then goes into debt.
+    """
+    rpm, tpm = limits()
+    if not rpm and not tpm:
+        return 0.0
+    while True:
+        with transaction.atomic():
+            # Write before reading so SQLite takes its write lock first and
+            # other databases lock the row until the transaction ends
+            if RateLimitBucket.objects.filter(name=name).update(updated=F("updated")):
+                bucket = RateLimitBucket.objects.get(name=name)
+                return _take(bucket, rpm, tpm, tokens)
+        _create_bucket(name, rpm, tpm)
+
+
+def _take(bucket: RateLimitBucket, rpm: int, tpm: int, tokens: int) -> float:
+    now = time.time()
+    elapsed = max(0.0, now - bucket.updated)
+    requests = min(rpm, bucket.requests + elapsed * rpm / 60) if rpm else 0.0
+    available = min(tpm, bucket.tokens + elapsed * tpm / 60) if tpm else 0.0
+
+    wait = 0.0
+    if rpm and requests < 1:
+        wait = (1 - requests) * 60 / rpm
+    if tpm and available < min(tokens, tpm):
+        wait = max(wait, (min(tokens, tpm) - available) * 60 / tpm)
+    if not wait:
+        requests -= 1
+        available -= tokens
+    RateLimitBucket.objects.filter(name=bucket.name).update(
+        requests=requests, tokens=available, updated=now
+    )
+    return wait
+
+
+def settle(name: str, estimated: int, used: int | None) -> None:
+    """Give back the part of a reservation that was not used."""
+    if used is None or used == estimated or not limits()[1]:
+        return
+    RateLimitBucket.objects.filter(name=name).update(tokens=F("tokens") + (estimated - used))
@@ -0,0 +1,129 @@
+"""Opt-in cache of chat completion responses.
+
+With ``AppConfig.response_cache_enabled`` every completion is stored in
+:class:`~simulator.models.CachedResponse` under the SHA-256 of its model,
+messages and parameters. Repeating a request with the same prompt returns the
+stored answer without calling OpenAI, so re-running a simulation on unchanged
+files costs nothing. Note that answers are then reproduced exactly even
+though they are sampled with a non-zero temperature.
+
+Entries expire after ``LLM_CACHE_TTL`` seconds; when the stored answers
+exceed ``LLM_CACHE_MAX_BYTES`` the least recently used ones are evicted.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.utils import timezone
+from openai.types.chat import ChatCompletion
+
+from config.utils import get_config
+from .models import CachedResponse
+
+# Request options that do not change the answer
+IGNORED_PARAMS = {"timeout", "stream", "stream_options"}
+
+
+def cache_key(kwargs: dict) -> str | None:
+    """Return the cache key of a request, or ``None`` if caching is off."""
+    if not get_config().response_cache_enabled:
+        return None
+    params = {k: v for k, v in kwargs.items() if k not in IGNORED_PARAMS}
+    payload = json.dumps(params, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _ttl() -> timedelta:
+    return timedelta(seconds=getattr(settings, "LLM_CACHE_TTL", 7 * 24 * 3600))
+
+
+def lookup(key: str) -> str | None:
+    """Return the cached answer for ``key`` and mark it as recently used."""
+    now = timezone.now()
+    content = (
+        CachedResponse.objects.filter(key=key, created__gte=now - _ttl())
+        .values_list("content", flat=True)
+        .first()
+    )
+    if content is None:
+        return None
+    CachedResponse.objects.filter(key=key).update(last_used=now, hits=F("hits") + 1)
+    return content
+
+
+def store(key: str, model: str, content: str) -> None:
+    """Store an answer and evict entries beyond the size limit."""
+    now = timezone.now()
+    fields = {
+        "model": model,
+        "content": content,
+        "size": len(content.encode()),
+        "created": now,
+        "last_used": now,
+    }
+    # Write without reading first, like the extraction cache
+    try:
+        with transaction.atomic():
+            if not CachedResponse.objects.filter(key=key).update(**fields):
+                CachedResponse.objects.create(key=key, **fields)
+    except IntegrityError:
+        # Stored concurrently by another request
+        return
+    evict()
+
+
+def as_completion(content: str, model: str) -> ChatCompletion:
+    """Wrap a cached answer in a response object without token usage."""
+    return ChatCompletion.model_validate(
+        {
+            "id": "cached",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": content},
+                }
+            ],
+        }
+    )
+
+
+def evict() -> int:
+    """Delete expired entries and the least recently used beyond the limit."""
+    deleted, _ = CachedResponse.objects.filter(
+        created__lt=timezone.now() - _ttl()
+    ).delete()
+    limit = getattr(settings, "LLM_CACHE_MAX_BYTES", 50 * 1024 * 1024)
+    excess = (CachedResponse.objects.aggregate(total=Sum("size"))["total"] or 0) - limit
+    if excess <= 0:
+        return deleted
+    keys = []
+    for key, size in CachedResponse.objects.order_by("last_used").values_list("key", "size"):
+        keys.append(key)
+        excess -= size
+        if excess <= 0:
+            break
+    return deleted + CachedResponse.objects.filter(key__in=keys).delete()[0]
+
+
+def flush() -> int:
+    """Delete all cached responses; returns the number of entries."""
+    deleted, _ = CachedResponse.objects.all().delete()
+    return deleted
+
+
+def stats() -> dict:
+    """Return the number of entries, their size in bytes and total hits."""
+    return CachedResponse.objects.aggregate(
+        entries=Count("key"), bytes=Sum("size"), hits=Sum("hits")
+    )
@@ -1,106 +1,136 @@
 from __future__ import annotations
 
-import os
-import csv
 import json
 import re
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import List
-
-MAX_PROMPT_CHARS = 25000
+from typing import Callable, Dict, List, NamedTuple, Tuple
 
 from django.conf import settings
-from django.core.files.base import File
+from django.core.files.base import ContentFile
+from django.db import transaction
 
 import openai
-from docx import Document
 from docx.shared import RGBColor
-from docx.text.paragraph import Paragraph
-from docx.oxml import OxmlElement
-from PyPDF2 import PdfReader
-
-
 
-def _insert_paragraph_after(paragraph: Paragraph, text: str = "", style: str | None = None) -> Paragraph:
-    """Insert a new paragraph after the given one and return it.
-
-    If a style is provided but not found in the document, the paragraph will be
-    added using the document's default style instead of raising ``KeyError``.
+from .budget import (
+    CANDIDATE_FACTOR,
+    CHARS_PER_TOKEN,
+    count_tokens,
+    prompt_token_budget,
+    select_context,
+)
+from .docbuild import ExamTask, ExamTemplate, append_answer, to_bytes
+from .examscan import stored_index
+from .extraction import extract_texts
+from .llm import DeadlineExceeded, chat_completion, deadline_in, get_client, remaining
+from .prompt_builder import (
+    level_messages,
+    shared_prefix,
+    sum_usage,
+    task_messages,
+    usage_counts,
+)
+from .telemetry import RunRecorder, stage
+from .warmstart import answer_key, take_preparation
+from .models import AIResult, ContextFile, ExamFile, Session
+from config.utils import get_config, load_prompts
+
+
+def _remaining_budget(exam_text: str, exam_chars: int, budget: int, model: str) -> int:
+    """Return the tokens left for context after the exam."""
+    error = "Die Klausur ist zu lang f\u00fcr die KI"
+    if len(exam_text) > exam_chars:
+        raise ValueError(error)
+    remaining = budget - count_tokens(exam_text, model)
+    if remaining < 0:
+        raise ValueError(error)
+    return remaining
+
+
+def assemble_prompt(session_id: str, *, recorder: RunRecorder | None = None) -> str:
+    """Create a base prompt from uploaded exam and context files.
+
+    The prompt is limited to the token budget of ``OPENAI_MODEL``. The exam
+    text is always included in full; the context chunks most relevant to the
+    exam fill the remaining budget. The exam and the context files are
+    extracted concurrently (see :func:`simulator.extraction.extract_texts`).
     """
-    new_p = OxmlElement("w:p")
-    paragraph._p.addnext(new_p)
-    new_para = Paragraph(new_p, paragraph._parent)
-    if text:
-        new_para.add_run(text)
-    if style:
-        try:
-            new_para.style = style
-        except KeyError:
-            # Fall back to default style if the requested style is not present
-            pass
-    return new_para
-
-
-from .models import AIResult, ContextFile, ExamFile
-from config.utils import load_prompts
-
-
-
-
-def _read_file(path: str) -> str:
-    """Return text content from a file path."""
-    ext = os.path.splitext(path)[1].lower()
-    if ext == ".docx":
-        doc = Document(path)
-        return "\n".join(p.text for p in doc.paragraphs)
-    if ext == ".csv":
-        with open(path, newline="", encoding="utf-8", errors="ignore") as fh:
-            reader = csv.reader(fh)
-            return "\n".join(",".join(row) for row in reader)
-    if ext == ".pdf":
-        try:
-            with open(path, "rb") as fh:
-                reader = PdfReader(fh)
-                return "\n".join((page.extract_text() or "") for page in reader.pages)
-        except Exception:
-            return ""
-    # Fallback to plain text
-    with open(path, "r", encoding="utf-8", errors="ignore") as fh:
-        return fh.read()
-
-
-def assemble_prompt(session_id: str) -> str:
-    """Create a base prompt from uploaded exam and context files."""
     exam = ExamFile.objects.filter(session_id=session_id).first()
     if not exam:
         raise ValueError("No exam file uploaded")
-    context_files = ContextFile.objects.filter(session_id=session_id)
-
-    exam_text = _read_file(exam.file.path)
-    context_text = "\n\n".join(_read_file(c.file.path) for c in context_files)
-
-    prompt = f"Exam:\n{exam_text}\n\nAdditional context:\n{context_text}"
-    if len(prompt) > MAX_PROMPT_CHARS:
-        raise ValueError("Zu viele oder zu große Kontextdateien f\u00fcr die KI")
-    return prompt
+    context_files = list(ContextFile.objects.filter(session_id=session_id))
+
+    model = getattr(settings, "OPENAI_MODEL", "gpt-4-1106-preview")
+    head = "Exam:\n{}\n\nAdditional context:\n"
+    budget = prompt_token_budget(model) - count_tokens(head.format(""), model)
+    exam_chars = budget * CHARS_PER_TOKEN * 2
+
+    index = stored_index(exam)
+    remaining = budget
+    if index is not None:
+        # Same text as the extraction, without parsing the docx again
+        exam_text = "\n".join(index["paragraphs"])[: exam_chars + 1]
+        with stage(recorder, "prompt"):
+            remaining = _remaining_budget(exam_text, exam_chars, budget, model)
+
+    # Read each context file only up to a bounded pool of candidate text.
+    # Without an index the exam is extracted together with the context, so
+    # the pool is bounded by the whole budget and trimmed below.
+    files = [
+        (context.file.path, remaining * CHARS_PER_TOKEN * CANDIDATE_FACTOR)
+        for context in context_files
+    ]
+    sources = list(context_files)
+    if index is None:
+        files.insert(0, (exam.file.path, exam_chars + 1))
+        sources.insert(0, exam)
+    with stage(recorder, "extraction"):
+        extracted = extract_texts(files)
+    if recorder is not None:
+        for source, item in zip(sources, extracted):
+            recorder.record_file(
+                source.original_name or source.file.name, item.seconds, len(item.text), item.cached
+            )
+    if index is None:
+        exam_text = extracted.pop(0).text
+        with stage(recorder, "prompt"):
+            remaining = _remaining_budget(exam_text, exam_chars, budget, model)
+
+    # The pool is shared by the files in upload order
+    candidate_chars = remaining * CHARS_PER_TOKEN * CANDIDATE_FACTOR
+    context_texts = []
+    for item in extracted:
+        if candidate_chars <= 0:
+            break
+        text = item.text[:candidate_chars]
+        candidate_chars -= len(text)
+        context_texts.append(text)
+
+    with stage(recorder, "prompt"):
+        context_text = select_context(exam_text, context_texts, remaining, model)
+    return head.format(exam_text) + context_text
 
 
 def _insert_answers_ai(
-    doc: Document,
+    template: ExamTemplate,
+    paragraphs: list,
     answer: str,
     level: str,
     color: RGBColor,
     client: openai.OpenAI,
     model: str,
+    recorder: RunRecorder | None = None,
+    deadline: float | None = None,
 ) -> bool:
     """Use the AI to find insertion spots for an answer within a document.
 
     The AI receives the numbered exam paragraphs and the student's complete
     answer. It returns JSON objects with the paragraph index after which each
-    answer segment should be inserted. The function inserts these segments and
-    returns ``True`` if at least one insertion was made."""
+    answer segment should be inserted. The function inserts these segments into
+    ``paragraphs`` and returns ``True`` if at least one insertion was made."""
 
-    numbered = "\n".join(f"{i}: {p.text}" for i, p in enumerate(doc.paragraphs))
     system_msg = (
         "You receive an exam with numbered paragraphs and a student's answer."
         " Decide after which paragraphs the answer segments belong and return a"
@@ -108,16 +138,22 @@ def _insert_answers_ai(
         " (exact answer text). Do not change wording or language."
     )
     user_msg = (
-        f"Exam paragraphs:\n{numbered}\n\nStudent answer:\n{answer}\n\n"
+        f"Exam paragraphs:\n{template.numbered()}\n\nStudent answer:\n{answer}\n\n"
         "Return only the JSON list."
     )
 
     try:
-        resp = client.chat.completions.create(
-            model=model,
-            messages=[{"role": "system", "content": system_msg}, {"role": "user", "content": user_msg}],
-            temperature=0,
-        )
+        with stage(recorder, "llm"):
+            resp = chat_completion(
+                client,
+                purpose="placement",
+                level=level,
+                recorder=recorder,
+                deadline=deadline,
+                model=model,
+                messages=[{"role": "system", "content": system_msg}, {"role": "user", "content": user_msg}],
+                temperature=0,
+            )
         content = resp.choices[0].message.content
     except Exception:
         return False
@@ -135,121 +171,350 @@ def _insert_answers_ai(
     if not isinstance(instructions, list):
         return False
 
-    made_change = False
+    segments = []
     for ins in sorted(instructions, key=lambda x: x.get("after", -1), reverse=True):
         try:
-            idx = int(ins.get("after"))
-            text = str(ins.get("text", "")).strip()
+            segments.append((int(ins.get("after")), str(ins.get("text", "")).strip()))
         except Exception:
             continue
 
-        if idx > 0 and idx <= len(doc.paragraphs):
-            idx -= 1  # treat response as 1-based index
+    with stage(recorder, "docx"):
+        return template.insert_segments(paragraphs, segments, level, color)
 
-        if not text or idx < 0 or idx >= len(doc.paragraphs):
-            continue
 
-        para = doc.paragraphs[idx]
-        head = _insert_paragraph_after(para, f"{level.title()} Antwort:", style="Heading2")
-        ans_p = _insert_paragraph_after(head, "")
-        run = ans_p.add_run(text)
-        run.font.color.rgb = color
-        made_change = True
+LEVELS = ("low", "medium", "high")
 
-    return made_change
+ProgressCallback = Callable[[str, str], None]
+
+LEVEL_COLORS = {
+    "low": RGBColor(0x80, 0x00, 0x00),
+    "medium": RGBColor(0x00, 0x64, 0x00),
+    "high": RGBColor(0x00, 0x00, 0x80),
+}
+
+
+def _request_answer(
+    client: openai.OpenAI,
+    model: str,
+    level: str,
+    messages: list,
+    recorder: RunRecorder | None = None,
+    deadline: float | None = None,
+) -> tuple[str, dict]:
+    """Return the stripped answer text and token usage of a chat completion."""
+    with stage(recorder, "llm"):
+        response = chat_completion(
+            client,
+            purpose="answer",
+            level=level,
+            recorder=recorder,
+            deadline=deadline,
+            model=model,
+            messages=messages,
+        )
+    return response.choices[0].message.content.strip(), usage_counts(response)
 
 
-def generate_ai_results(session_id: str, *, api_key: str | None = None) -> List[AIResult]:
-    """Generate AI answers for all performance levels."""
-    base_prompt = assemble_prompt(session_id)
-    client = openai.OpenAI(api_key=api_key or os.environ.get("OPENAI_API_KEY"))
+def _load_template(exam: ExamFile, recorder: RunRecorder | None = None) -> ExamTemplate:
+    with stage(recorder, "docx"):
+        return ExamTemplate(exam.file.path, stored_index(exam))
 
-    storage_root = getattr(settings, "MEDIA_ROOT", "")
-    session_dir = Path(storage_root) / "ai_results" / session_id
-    session_dir.mkdir(parents=True, exist_ok=True)
 
-    # Remove old results for this session
-    for old in AIResult.objects.filter(session_id=session_id):
-        old.file.delete(save=False)
-        old.delete()
+def _build_level_document(
+    template: ExamTemplate,
+    level: str,
+    answer: str | List[str],
+    client: openai.OpenAI,
+    model: str,
+    recorder: RunRecorder | None = None,
+    deadline: float | None = None,
+) -> bytes:
+    """Insert the answer into a copy of the exam and return the docx bytes.
+
+    ``answer`` is either a list with one answer per task of the template or a
+    single answer to the whole exam.
+    """
+    color = LEVEL_COLORS[level]
+    if isinstance(answer, list):
+        with stage(recorder, "docx"):
+            doc, paragraphs = template.copy()
+            template.fill_tasks(paragraphs, answer, level, color)
+            return to_bytes(doc)
+
+    with stage(recorder, "docx"):
+        doc, paragraphs = template.copy()
+        inserted = template.fill_placeholders(paragraphs, level, answer, color)
+
+    if not inserted:
+        inserted = _insert_answers_ai(
+            template, paragraphs, answer, level, color, client, model, recorder, deadline
+        )
+
+    with stage(recorder, "docx"):
+        if not inserted:
+            append_answer(doc, level, answer, color)
+        return to_bytes(doc)
+
+
+def _report(progress: ProgressCallback | None, level: str, state: str) -> None:
+    if progress is not None:
+        progress(level, state)
+
+
+def generate_ai_results(
+    session_id: str,
+    *,
+    api_key: str | None = None,
+    progress: ProgressCallback | None = None,
+) -> List[AIResult]:
+    """Generate AI answers for all performance levels.
+
+    If the exam can be split into tasks (see ``ExamTemplate.tasks``) and
+    ``SIMULATION_PER_TASK`` is enabled, every task is answered by a separate
+    completion per level and the answers are placed after their tasks.
+    Otherwise one completion per level answers the whole exam.
+
+    The completions are requested concurrently and each result document is
+    assembled as soon as all answers of its level arrived. The number of
+    parallel workers is bounded by ``SIMULATION_CONCURRENCY``. Old results are
+    replaced in one transaction once all levels succeeded.
+
+    ``progress`` is called from the calling thread with ``(level, state)``
+    whenever a level advances to ``"answered"``, ``"built"`` or ``"done"``.
+    Latency, token usage and stage timings are stored as a ``SimulationRun``.
+    Requests use the shared client of :func:`simulator.llm.get_client`; the
+    run fails with ``DeadlineExceeded`` once ``SIMULATION_DEADLINE`` seconds
+    have passed. A prompt and answers prepared for the current files are
+    taken over instead of being requested again (see :func:`plan_run`).
+    """
+    client = get_client(api_key)
+    model = getattr(settings, "OPENAI_MODEL", "gpt-4-1106-preview")
+    recorder = RunRecorder(session_id, model)
+    try:
+        results = _generate_ai_results(session_id, client, model, recorder, progress)
+    except Exception as exc:
+        recorder.finish(exc)
+        raise
+    recorder.finish()
+    return results
+
+
+class SimulationPlan(NamedTuple):
+    """Everything needed to request and assemble the answers of a session.
+
+    ``requests`` maps ``(level, task index)`` to the chat messages; the task
+    index is ``None`` when the whole exam is answered at once. ``answered``
+    holds ``(answer, usage)`` of requests answered in advance (see
+    :mod:`simulator.warmstart`).
+    """
+
+    exam: ExamFile
+    template: ExamTemplate
+    tasks: List[ExamTask]
+    requests: Dict[Tuple[str, int | None], list]
+    base_prompt: str
+    answered: Dict[Tuple[str, int | None], Tuple[str, dict]]
+
+    def level_answer(self, answers: dict) -> str | List[str]:
+        """Return the answer of a level from its answers by task index."""
+        if self.tasks:
+            return [answers[i] for i in range(len(self.tasks))]
+        return answers[None]
+
+
+def plan_simulation(
+    session_id: str,
+    recorder: RunRecorder | None = None,
+    base_prompt: str | None = None,
+) -> SimulationPlan:
+    """Build the prompt and the completion requests for a session.
+
+    ``base_prompt`` skips the extraction of the files if it was built before.
+    """
+    if base_prompt is None:
+        base_prompt = assemble_prompt(session_id, recorder=recorder)
 
     # Get the uploaded exam document to use as template
     exam = ExamFile.objects.filter(session_id=session_id).first()
     if not exam:
         raise ValueError("No exam file uploaded")
 
-    prompts = load_prompts()
-    results: List[AIResult] = []
-    level_map = {
-        "low": prompts["level_low"],
-        "medium": prompts["level_medium"],
-        "high": prompts["level_high"],
-    }
-    color_map = {
-        "low": RGBColor(0x80, 0x00, 0x00),
-        "medium": RGBColor(0x00, 0x64, 0x00),
-        "high": RGBColor(0x00, 0x00, 0x80),
-    }
-
-    for level, instruction in level_map.items():
-        messages = [
-            {"role": "system", "content": prompts["system"]},
-            {
-                "role": "user",
-                "content": f"{base_prompt}\n\n{prompts['base']}\n{instruction}",
-            },
-        ]
-        model = getattr(settings, "OPENAI_MODEL", "gpt-4-1106-preview")
-        response = client.chat.completions.create(model=model, messages=messages)
-        answer = response.choices[0].message.content.strip()
-
-        # Load exam document fresh for each level
-        doc = Document(exam.file.path)
-        inserted = False
-        for para in doc.paragraphs:
-            if "[Antwort]" in para.text:
-                para.text = para.text.replace("[Antwort]", "").rstrip()
-                head = _insert_paragraph_after(
-                    para, f"{level.title()} Antwort:", style="Heading2"
+    language = get_config().language
+    prompts = load_prompts(language)
+    prefix = shared_prefix(prompts, base_prompt)
+    template = _load_template(exam, recorder)
+    tasks = template.tasks if getattr(settings, "SIMULATION_PER_TASK", False) else []
+
+    # One request per level and task, or per level for the whole exam
+    requests = {}
+    for level in LEVELS:
+        instruction = prompts[f"level_{level}"]
+        if tasks:
+            for index, task in enumerate(tasks):
+                requests[(level, index)] = task_messages(
+                    prefix, instruction, task.number, task.text, language
                 )
-                ans_p = _insert_paragraph_after(head, "")
-                run = ans_p.add_run(answer)
-                run.font.color.rgb = color_map[level]
-                inserted = True
-
-        if not inserted:
-            inserted = _insert_answers_ai(
-                doc,
-                answer,
-                level,
-                color_map[level],
-                client,
-                model,
+        else:
+            requests[(level, None)] = level_messages(prefix, instruction)
+    return SimulationPlan(exam, template, tasks, requests, base_prompt, {})
+
+
+def plan_run(session_id: str, recorder: RunRecorder | None = None) -> SimulationPlan:
+    """Plan a simulation, taking over work prepared for the current files."""
+    prepared = take_preparation(session_id)
+    if prepared is None:
+        return plan_simulation(session_id, recorder)
+    plan = plan_simulation(session_id, recorder, prepared.prompt)
+    answered = {}
+    for level, index in plan.requests:
+        key = answer_key(level, index)
+        if key in prepared.answers:
+            answered[(level, index)] = (prepared.answers[key], prepared.usage.get(key, {}))
+    return plan._replace(answered=answered)
+
+
+def prepare_simulation(
+    session_id: str, *, api_key: str | None = None, answers: bool = False
+) -> Tuple[str, dict, dict]:
+    """Do the work of a simulation that does not depend on starting it.
+
+    Returns the base prompt and, with ``answers``, the answers and token
+    usage of all requests keyed by :func:`simulator.warmstart.answer_key`.
+    Requesting answers is recorded as a ``SimulationRun`` of its own, so the
+    completions show up in the telemetry although no simulation was started.
+    """
+    if not answers:
+        return plan_simulation(session_id).base_prompt, {}, {}
+    client = get_client(api_key)
+    model = getattr(settings, "OPENAI_MODEL", "gpt-4-1106-preview")
+    recorder = RunRecorder(session_id, model)
+    try:
+        prepared = _prepare_answers(session_id, client, model, recorder)
+    except Exception as exc:
+        recorder.finish(exc)
+        raise
+    recorder.finish()
+    return prepared
+
+
+def _prepare_answers(
+    session_id: str, client: openai.OpenAI, model: str, recorder: RunRecorder
+) -> Tuple[str, dict, dict]:
+    deadline = deadline_in(getattr(settings, "SIMULATION_DEADLINE", None))
+    plan = plan_simulation(session_id, recorder)
+    workers = max(1, getattr(settings, "SIMULATION_CONCURRENCY", len(LEVELS)))
+    texts, usage = {}, {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(
+                _request_answer, client, model, level, messages, recorder, deadline
+            ): answer_key(level, index)
+            for (level, index), messages in plan.requests.items()
+        }
+        for fut in _as_completed(futures, deadline):
+            texts[futures[fut]], usage[futures[fut]] = fut.result()
+    return plan.base_prompt, texts, usage
+
+
+def store_results(
+    session_id: str,
+    exam: ExamFile,
+    documents: Dict[str, bytes],
+    usage: Dict[str, List[dict]],
+    recorder: RunRecorder | None = None,
+    progress: ProgressCallback | None = None,
+) -> List[AIResult]:
+    """Replace the session's results with the given level documents."""
+    orig_name = Path(exam.original_name or exam.file.name).stem
+    results: List[AIResult] = []
+    # Read before the transaction so that it starts with a write; SQLite
+    # cannot upgrade a reading transaction while another connection writes
+    old_results = list(AIResult.objects.filter(session_id=session_id))
+    with stage(recorder, "storage"), transaction.atomic():
+        # Remove old results for this session
+        AIResult.objects.filter(pk__in=[old.pk for old in old_results]).delete()
+        for level in LEVELS:
+            file_name = f"{orig_name}_{level}.docx"
+            result = AIResult(level=level, session_id=session_id, **sum_usage(usage[level]))
+            result.file.save(
+                f"{session_id}/{file_name}", ContentFile(documents[level]), save=True
             )
+            results.append(result)
 
-        if not inserted:
-            # Add heading with graceful fallback if the "Heading 2" style is
-            # missing in the template
-            try:
-                head = doc.add_heading(f"{level.title()} Antwort:", level=2)
-            except KeyError:
-                head = doc.add_paragraph(f"{level.title()} Antwort:")
-                try:
-                    head.style = "Heading2"
-                except KeyError:
-                    pass
-            p = doc.add_paragraph()
-            run = p.add_run(answer)
-            run.font.color.rgb = color_map[level]
-
-        orig_name = Path(exam.file.name).stem
-        file_name = f"{orig_name}_{level}.docx"
-        file_path = session_dir / file_name
-        doc.save(file_path)
-
-        result = AIResult(level=level, session_id=session_id)
-        with open(file_path, "rb") as fh:
-            result.file.save(f"{session_id}/{file_name}", File(fh), save=True)
-        results.append(result)
+    Session.refresh(session_id)
+    for level in LEVELS:
+        _report(progress, level, "done")
+
+    for old in old_results:
+        old.file.delete(save=False)
 
     return results
+
+
+def _as_completed(futures: dict, deadline: float | None):
+    """Like ``as_completed`` but give up once ``deadline`` has passed."""
+    try:
+        yield from as_completed(futures, timeout=remaining(deadline))
+    except TimeoutError as exc:
+        for fut in futures:
+            fut.cancel()
+        raise DeadlineExceeded("Zeitlimit der Simulation überschritten") from exc
+
+
+def _generate_ai_results(
+    session_id: str,
+    client: openai.OpenAI,
+    model: str,
+    recorder: RunRecorder,
+    progress: ProgressCallback | None,
+) -> List[AIResult]:
+    deadline = deadline_in(getattr(settings, "SIMULATION_DEADLINE", None))
+    plan = plan_run(session_id, recorder)
+    workers = max(1, getattr(settings, "SIMULATION_CONCURRENCY", len(LEVELS)))
+
+    answers = {level: {} for level in LEVELS}
+    usage = {level: [] for level in LEVELS}
+    pending = Counter(level for level, _ in plan.requests)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        doc_futures = {}
+
+        def answered(level: str, index: int | None, answer: str, counts: dict) -> None:
+            answers[level][index] = answer
+            usage[level].append(counts)
+            pending[level] -= 1
+            if pending[level]:
+                return
+            # Start assembling each document as soon as all its answers arrived
+            _report(progress, level, "answered")
+            doc_futures[
+                pool.submit(
+                    _build_level_document,
+                    plan.template,
+                    level,
+                    plan.level_answer(answers[level]),
+                    client,
+                    model,
+                    recorder,
+                    deadline,
+                )
+            ] = level
+
+        for (level, index), (answer, counts) in plan.answered.items():
+            answered(level, index, answer, counts)
+        answer_futures = {
+            pool.submit(
+                _request_answer, client, model, level, messages, recorder, deadline
+            ): (level, index)
+            for (level, index), messages in plan.requests.items()
+            if (level, index) not in plan.answered
+        }
+        for fut in _as_completed(answer_futures, deadline):
+            answered(*answer_futures[fut], *fut.result())
+
+        documents = {}
+        for fut in _as_completed(doc_futures, deadline):
+            level = doc_futures[fut]
+            documents[level] = fut.result()
+            _report(progress, level, "built")
+
+    return store_results(session_id, plan.exam, documents, usage, recorder, progress)
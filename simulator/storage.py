@@ -0,0 +1,160 @@
+"""Content-addressed storage of uploaded exam and context files.
+
+Uploads are written to ``blobs/<ab>/<sha256><ext>`` and hashed in the same
+pass over their chunks, so identical files uploaded to different sessions are
+stored only once. :class:`~simulator.models.StoredBlob` counts the rows that
+reference each blob; deleting a file drops one reference and removes the blob
+once no row uses it any more. The counter row of an unused blob is deleted
+together with its file, so uploads and removals of the same blob are
+serialized on that row. The name shown to users is kept in the
+``original_name`` field of the file rows.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import re
+import tempfile
+from collections import Counter
+from pathlib import Path
+from typing import Iterable
+
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+BLOB_DIR = "blobs"
+CHUNK_SIZE = 1024 * 1024
+_HASH_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def blob_name(content_hash: str, extension: str) -> str:
+    """Return the storage name of the blob with the given hash."""
+    return f"{BLOB_DIR}/{content_hash[:2]}/{content_hash}{extension.lower()}"
+
+
+def is_blob(name: str) -> bool:
+    return name.startswith(BLOB_DIR + "/")
+
+
+def blob_hash(path: str) -> str | None:
+    """Return the SHA-256 encoded in a blob's name or path, ``None`` otherwise."""
+    p = Path(path)
+    if p.parent.parent.name == BLOB_DIR and _HASH_RE.match(p.stem):
+        return p.stem
+    return None
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """File system storage that deduplicates files by their content."""
+
+    def _save(self, name, content):
+        extension = os.path.splitext(name)[1]
+        if hasattr(content, "temporary_file_path"):
+            # Large uploads are already on disk; hash them and move them
+            # into place instead of copying
+            source = content.temporary_file_path()
+            digest = hashlib.sha256()
+            with open(source, "rb") as fh:
+                for chunk in iter(lambda: fh.read(CHUNK_SIZE), b""):
+                    digest.update(chunk)
+            return self._link(blob_name(digest.hexdigest(), extension), source)
+
+        directory = self.path(BLOB_DIR)
+        os.makedirs(directory, exist_ok=True)
+        fd, source = tempfile.mkstemp(dir=directory, suffix=".part")
+        try:
+            digest = hashlib.sha256()
+            with os.fdopen(fd, "wb") as fh:
+                for chunk in content.chunks(CHUNK_SIZE):
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    digest.update(chunk)
+                    fh.write(chunk)
+            return self._link(blob_name(digest.hexdigest(), extension), source)
+        finally:
+            if os.path.exists(source):
+                os.unlink(source)
+
+    def _link(self, name: str, source: str) -> str:
+        """Add a reference to blob ``name``, moving ``source`` there if new."""
+        from .models import StoredBlob
+
+        full_path = self.path(name)
+        while True:
+            try:
+                # The reference is taken before the file is checked, in one
+                # transaction. _remove_unused deletes an unreferenced row and
+                # its file in one transaction as well, so either it sees this
+                # reference and keeps the file, or this upload waits for the
+                # row to be gone and moves the file into place again
+                with transaction.atomic():
+                    if not StoredBlob.objects.filter(name=name).update(refs=F("refs") + 1):
+                        StoredBlob.objects.create(
+                            name=name, size=os.path.getsize(source), refs=1
+                        )
+                    if not os.path.exists(full_path):
+                        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                        file_move_safe(source, full_path, allow_overwrite=True)
+                        if self.file_permissions_mode is not None:
+                            os.chmod(full_path, self.file_permissions_mode)
+                return name
+            except IntegrityError:
+                # Created concurrently by another upload; count this one too
+                continue
+
+    def get_available_name(self, name, max_length=None):
+        # Blobs with the same name have the same content and are shared
+        return name
+
+    def release(self, names: Iterable[str]) -> int:
+        """Drop one reference per entry of ``names`` and remove unused blobs.
+
+        Names that are not blobs are ignored. Call this in the transaction
+        that deletes the referencing rows; the files are only removed once it
+        committed. Returns the number of blobs no longer referenced.
+        """
+        from .models import StoredBlob
+
+        counts = Counter(name for name in names if name and is_blob(name))
+        if not counts:
+            return 0
+        with transaction.atomic():
+            for name, count in counts.items():
+                StoredBlob.objects.filter(name=name).update(refs=F("refs") - count)
+            unused = list(
+                StoredBlob.objects.filter(name__in=list(counts), refs__lte=0).values_list(
+                    "name", flat=True
+                )
+            )
+            # The rows stay until the files are removed; see _remove_unused
+            for name in unused:
+                transaction.on_commit(lambda name=name: self._remove_unused(name))
+        return len(unused)
+
+    def _remove_unused(self, name: str) -> None:
+        from .models import StoredBlob
+
+        with transaction.atomic():
+            # Deleting the row locks it until the file is gone. Nothing is
+            # deleted if the blob was uploaded again since it was released
+            deleted, _ = StoredBlob.objects.filter(name=name, refs__lte=0).delete()
+            if deleted:
+                FileSystemStorage.delete(self, name)
+
+    def delete(self, name):
+        """Release a blob or remove another file once the transaction commits."""
+        if is_blob(name):
+            self.release([name])
+        else:
+            transaction.on_commit(lambda: FileSystemStorage.delete(self, name))
+
+
+upload_storage = ContentAddressedStorage()
+
+
+def get_upload_storage() -> ContentAddressedStorage:
+    """Return the storage of uploaded files (used by the model fields)."""
+    return upload_storage
@@ -0,0 +1,185 @@
+"""Run a simulation while streaming the answers to the browser.
+
+:func:`stream_job` is an async generator of server-sent events. The
+completions of all levels and tasks are streamed concurrently with
+``AsyncOpenAI``; every text delta is forwarded as soon as it arrives. When all
+answers of a level are complete its document is built in a worker thread, and
+the results are stored once every level is done, exactly as
+:func:`simulator.services.generate_ai_results` does for queued runs.
+
+Served through ``KlaSim.asgi`` the connection does not occupy a worker thread
+while the completions are running.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+from collections import Counter
+from typing import AsyncIterator
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .jobs import finish_job, job_progress, start_heartbeat
+from .llm import (
+    DeadlineExceeded,
+    deadline_in,
+    get_async_client,
+    get_client,
+    remaining,
+    stream_chat_completion,
+)
+from .models import SimulationJob
+from .services import (
+    LEVELS,
+    ProgressCallback,
+    SimulationPlan,
+    _build_level_document,
+    plan_run,
+    store_results,
+)
+from .telemetry import RunRecorder, stage
+
+
+def sse_event(event: str, data: dict) -> str:
+    """Format a server-sent event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def _run_streams(
+    plan: SimulationPlan,
+    api_key: str | None,
+    model: str,
+    recorder: RunRecorder,
+    events: asyncio.Queue,
+    progress: ProgressCallback,
+    deadline: float | None = None,
+) -> tuple[dict, dict]:
+    """Stream all completions of ``plan`` and build the level documents.
+
+    Events are put on ``events``; returns ``(documents, usage)``.
+    """
+    client = get_async_client(api_key)
+    # Only needed if an answer has to be placed by the AI
+    sync_client = get_client(api_key)
+    workers = max(1, getattr(settings, "SIMULATION_CONCURRENCY", len(LEVELS)))
+    semaphore = asyncio.Semaphore(workers)
+    answers = {level: {} for level in LEVELS}
+    usage = {level: [] for level in LEVELS}
+    pending = Counter(level for level, _ in plan.requests)
+    documents = {}
+
+    async def report(level: str, state: str) -> None:
+        await sync_to_async(progress)(level, state)
+        await events.put(sse_event("level", {"level": level, "state": state}))
+
+    async def complete(level: str, index: int | None, messages: list) -> None:
+        parts = []
+        counts = {}
+        if (level, index) in plan.answered:
+            # Answered in advance; send it as one delta
+            answer, counts = plan.answered[(level, index)]
+            parts.append(answer)
+            await events.put(
+                sse_event("delta", {"level": level, "task": index, "text": answer})
+            )
+        else:
+            async with semaphore:
+                with stage(recorder, "llm"):
+                    async for delta in stream_chat_completion(
+                        client,
+                        purpose="answer",
+                        level=level,
+                        recorder=recorder,
+                        usage=counts,
+                        deadline=deadline,
+                        model=model,
+                        messages=messages,
+                    ):
+                        parts.append(delta)
+                        await events.put(
+                            sse_event("delta", {"level": level, "task": index, "text": delta})
+                        )
+        answers[level][index] = "".join(parts).strip()
+        usage[level].append(counts)
+        pending[level] -= 1
+        if pending[level]:
+            return
+        await report(level, "answered")
+        documents[level] = await sync_to_async(_build_level_document, thread_sensitive=False)(
+            plan.template,
+            level,
+            plan.level_answer(answers[level]),
+            sync_client,
+            model,
+            recorder,
+            deadline,
+        )
+        await report(level, "built")
+
+    tasks = [
+        asyncio.ensure_future(complete(level, index, messages))
+        for (level, index), messages in plan.requests.items()
+    ]
+    try:
+        await asyncio.wait_for(asyncio.gather(*tasks), timeout=remaining(deadline))
+    except asyncio.TimeoutError as exc:
+        raise DeadlineExceeded("Zeitlimit der Simulation überschritten") from exc
+    finally:
+        for task in tasks:
+            task.cancel()
+    return documents, usage
+
+
+async def stream_job(job: SimulationJob, *, api_key: str | None = None) -> AsyncIterator[str]:
+    """Run the simulation of a started job and yield server-sent events.
+
+    Emits ``start``, ``delta`` (``level``, ``task``, ``text``), ``level``
+    (``level``, ``state``) and finally ``done`` with the result URLs or
+    ``error``. The job's progress and outcome are stored like for queued runs.
+    """
+    session_id = job.session_id
+    api_key = api_key or os.environ.get("OPENAI_API_KEY")
+    model = getattr(settings, "OPENAI_MODEL", "gpt-4-1106-preview")
+    progress = job_progress(job)
+    deadline = deadline_in(getattr(settings, "SIMULATION_DEADLINE", None))
+    recorder = await sync_to_async(RunRecorder)(session_id, model)
+    heartbeat = start_heartbeat(job)
+    events: asyncio.Queue = asyncio.Queue()
+    runner = None
+    error = None
+    try:
+        plan = await sync_to_async(plan_run)(session_id, recorder)
+        yield sse_event(
+            "start", {"levels": list(LEVELS), "tasks": [t.number for t in plan.tasks]}
+        )
+
+        runner = asyncio.ensure_future(
+            _run_streams(plan, api_key, model, recorder, events, progress, deadline)
+        )
+        runner.add_done_callback(lambda _: events.put_nowait(None))
+        while True:
+            event = await events.get()
+            if event is None:
+                break
+            yield event
+        documents, usage = await runner
+        results = await sync_to_async(store_results)(
+            session_id, plan.exam, documents, usage, recorder, progress
+        )
+        yield sse_event(
+            "done", {"results": [{"level": r.level, "url": r.file.url} for r in results]}
+        )
+    except Exception as exc:
+        error = exc
+        yield sse_event("error", {"message": str(exc)})
+    finally:
+        if runner is not None and not runner.done():
+            # The client went away; stop the remaining completions
+            runner.cancel()
+            error = error or RuntimeError("Stream closed by client")
+        heartbeat.set()
+        await sync_to_async(recorder.finish)(error)
+        await sync_to_async(finish_job)(job, error)
@@ -0,0 +1,172 @@
+"""Latency, token usage and stage timing of simulation runs.
+
+A :class:`RunRecorder` collects measurements in memory while the pipeline
+runs (possibly from several threads) and writes them to
+:class:`~simulator.models.SimulationRun` and :class:`~simulator.models.LLMCall`
+when the run finishes.
+"""
+
+from __future__ import annotations
+
+import math
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Sequence
+
+from django.db.models import Count, Q, Sum
+
+from .models import LLMCall, SimulationRun
+
+STAGES = ("extraction", "prompt", "llm", "ratelimit", "docx", "storage")
+# Typical run assumed before any run was recorded
+DEFAULT_RUN_STATS = {"duration": 60.0, "requests": 3, "tokens": 15000}
+
+
+class RunRecorder:
+    """Collect the measurements of one simulation run."""
+
+    def __init__(self, session_id: str, model: str):
+        self.run = SimulationRun.objects.create(session_id=session_id, model=model)
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._stages: dict[str, float] = defaultdict(float)
+        self._calls: list[LLMCall] = []
+        self._files: list[dict] = []
+
+    @contextmanager
+    def stage(self, name: str):
+        """Add the time spent inside the block to stage ``name``."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._stages[name] += elapsed
+
+    def record_call(self, **fields) -> None:
+        """Remember an LLM call; it is stored when the run finishes."""
+        with self._lock:
+            self._calls.append(LLMCall(run=self.run, **fields))
+
+    def record_file(self, name: str, seconds: float, chars: int, cached: bool) -> None:
+        """Remember the time spent extracting the text of one file."""
+        with self._lock:
+            self._files.append(
+                {
+                    "name": name,
+                    "type": os.path.splitext(name)[1].lower(),
+                    "seconds": round(seconds, 4),
+                    "chars": chars,
+                    "cached": cached,
+                }
+            )
+
+    def finish(self, error: Exception | None = None) -> None:
+        self.run.duration = time.perf_counter() - self._start
+        self.run.stages = {name: round(secs, 4) for name, secs in self._stages.items()}
+        self.run.files = self._files
+        self.run.status = "failed" if error else "done"
+        self.run.error = str(error) if error else ""
+        self.run.save(update_fields=["duration", "stages", "files", "status", "error"])
+        LLMCall.objects.bulk_create(self._calls)
+
+
+@contextmanager
+def stage(recorder: RunRecorder | None, name: str):
+    """Time a stage if a recorder is given, otherwise do nothing."""
+    if recorder is None:
+        yield
+        return
+    with recorder.stage(name):
+        yield
+
+
+def percentile(values: Sequence[float], q: float) -> float | None:
+    """Return the ``q``-th percentile (0-100) using the nearest-rank method."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(q / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def _latency_stats(values: Sequence[float]) -> dict:
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+    }
+
+
+def recent_run_stats(limit: int = 20) -> dict:
+    """Return the mean duration, LLM requests and tokens of recent runs."""
+    runs = list(
+        SimulationRun.objects.filter(status="done", duration__isnull=False)
+        .order_by("-started")
+        .annotate(
+            requests=Count("calls"),
+            prompt=Sum("calls__prompt_tokens"),
+            completion=Sum("calls__completion_tokens"),
+        )
+        .values("duration", "requests", "prompt", "completion")[:limit]
+    )
+    if not runs:
+        return dict(DEFAULT_RUN_STATS)
+    return {
+        "duration": sum(r["duration"] for r in runs) / len(runs),
+        "requests": sum(r["requests"] for r in runs) / len(runs),
+        "tokens": sum((r["prompt"] or 0) + (r["completion"] or 0) for r in runs) / len(runs),
+    }
+
+
+def summarize(since) -> dict:
+    """Aggregate runs and LLM calls started after ``since``."""
+    runs = SimulationRun.objects.filter(started__gte=since)
+    durations = []
+    stage_times: dict[str, list[float]] = defaultdict(list)
+    file_times: dict[str, list[float]] = defaultdict(list)
+    for duration, stages, files in runs.filter(status="done").values_list(
+        "duration", "stages", "files"
+    ):
+        if duration is not None:
+            durations.append(duration)
+        for name, secs in (stages or {}).items():
+            stage_times[name].append(secs)
+        for entry in files or []:
+            if not entry.get("cached"):
+                file_times[entry.get("type") or "?"].append(entry["seconds"])
+
+    calls = LLMCall.objects.filter(created__gte=since)
+    latencies: dict[str, list[float]] = defaultdict(list)
+    for purpose, latency in calls.filter(outcome="ok").values_list("purpose", "latency"):
+        latencies[purpose].append(latency)
+    totals = calls.values("purpose").annotate(
+        calls=Count("id"),
+        errors=Count("id", filter=Q(outcome="error")),
+        prompt_tokens=Sum("prompt_tokens"),
+        completion_tokens=Sum("completion_tokens"),
+        cached_tokens=Sum("cached_tokens"),
+    ).order_by("purpose")
+
+    return {
+        "runs": runs.count(),
+        "failed_runs": runs.filter(status="failed").count(),
+        "duration": _latency_stats(durations),
+        "stages": [
+            {"name": name, **_latency_stats(stage_times[name])}
+            for name in STAGES
+            if stage_times.get(name)
+        ],
+        "files": [
+            {"type": file_type, **_latency_stats(times)}
+            for file_type, times in sorted(file_times.items())
+        ],
+        "calls": [
+            {**row, **_latency_stats(latencies.get(row["purpose"], []))}
+            for row in totals
+        ],
+    }
@@ -1,3 +1,1046 @@
-from django.test import TestCase
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import httpx
+import openai
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DatabaseError
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from docx import Document
+
+from config.models import AppConfig
+from config.utils import bump_config_version
+from .extraction import extract_text, extract_texts
+from .jobs import (
+    claim_next_job,
+    enqueue_simulation,
+    job_status,
+    process_next_preparation,
+    recover_stale_jobs,
+    start_heartbeat,
+    start_job,
+    touch_job,
+)
+from .models import (
+    AIResult,
+    ContextFile,
+    ExamFile,
+    ExtractedText,
+    CachedResponse,
+    PreparedSimulation,
+    RateLimitBucket,
+    Session,
+    SimulationBatch,
+    SimulationJob,
+    SimulationRun,
+    StoredBlob,
+)
+from .budget import count_tokens, select_context
+from .batch import collect_pending, import_exams, submit_batch
+from .ratelimit import reserve, settle
+from . import extraction, ratelimit, response_cache
+from .docbuild import ExamTemplate, to_bytes
+from .examscan import ResultDocumentError, scan_exam
+from .forms import ExamUploadForm
+from .llm import (
+    DeadlineExceeded,
+    chat_completion,
+    close_clients,
+    get_client,
+    retry_delay,
+    stream_chat_completion,
+)
+from .services import LEVEL_COLORS, assemble_prompt, generate_ai_results
+
+
+def _docx_bytes(*paragraphs: str) -> bytes:
+    doc = Document()
+    for text in paragraphs:
+        doc.add_paragraph(text)
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+def _fake_completion(content: str):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+class SimulatorTestCase(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        override = override_settings(MEDIA_ROOT=self.media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        # Clients are shared per process; drop them so patched classes apply
+        close_clients()
+        self.addCleanup(close_clients)
+        self.session_id = "s1"
+        Session.ensure(self.session_id)
+        ExamFile.objects.create(
+            file=ContentFile(_docx_bytes("Aufgabe 1", "[Antwort]"), name="exam.docx"),
+            session_id=self.session_id,
+        )
+        ContextFile.objects.create(
+            file=ContentFile(b"Kontext", name="context.txt"),
+            session_id=self.session_id,
+        )
+
+
+class GenerateAIResultsTest(SimulatorTestCase):
+    def test_generates_one_result_per_level(self):
+        with mock.patch("simulator.llm.openai.OpenAI") as client_cls:
+            client_cls.return_value.chat.completions.create.return_value = _fake_completion("Antworttext")
+            results = generate_ai_results(self.session_id, api_key="key")
+
+        self.assertEqual(sorted(r.level for r in results), ["high", "low", "medium"])
+        self.assertEqual(AIResult.objects.filter(session_id=self.session_id).count(), 3)
+        texts = [p.text for p in Document(results[0].file.path).paragraphs]
+        self.assertIn("Antworttext", texts)
+        files = SimulationRun.objects.get(session_id=self.session_id).files
+        self.assertEqual([f["name"] for f in files], ["exam.docx", "context.txt"])
+
+    def test_levels_share_prompt_prefix_and_record_usage(self):
+        response = _fake_completion("A")
+        response.usage = SimpleNamespace(
+            prompt_tokens=100,
+            completion_tokens=10,
+            prompt_tokens_details=SimpleNamespace(cached_tokens=64),
+        )
+        with mock.patch("simulator.llm.openai.OpenAI") as client_cls:
+            create = client_cls.return_value.chat.completions.create
+            create.return_value = response
+            generate_ai_results(self.session_id, api_key="key")
+
+        sent = [call.kwargs["messages"] for call in create.call_args_list]
+        self.assertEqual(len(sent), 3)
+        self.assertTrue(all(m[:-1] == sent[0][:-1] for m in sent))
+        self.assertEqual(len({m[-1]["content"] for m in sent}), 3)
+        self.assertEqual(
+            set(AIResult.objects.values_list("cached_tokens", flat=True)), {64}
+        )
+
+    @override_settings(SIMULATION_PER_TASK=True)
+    def test_answers_each_task_separately(self):
+        ExamFile.objects.filter(session_id=self.session_id).delete()
+        ExamFile.objects.create(
+            file=ContentFile(
+                _docx_bytes("Aufgabe 1", "[Antwort]", "Aufgabe 2", "[Antwort]"), name="exam.docx"
+            ),
+            session_id=self.session_id,
+        )
+
+        def answer(**kwargs):
+            task = kwargs["messages"][-1]["content"].splitlines()[-1]
+            return _fake_completion(f"Lösung zu {task}")
+
+        with mock.patch("simulator.llm.openai.OpenAI") as client_cls:
+            create = client_cls.return_value.chat.completions.create
+            create.side_effect = answer
+            results = generate_ai_results(self.session_id, api_key="key")
+
+        self.assertEqual(create.call_count, 6)
+        texts = [p.text for p in Document(results[0].file.path).paragraphs]
+        first = texts.index("Lösung zu Aufgabe 1")
+        self.assertLess(first, texts.index("Aufgabe 2"))
+        self.assertLess(texts.index("Aufgabe 2"), texts.index("Lösung zu Aufgabe 2"))
+        self.assertNotIn("[Antwort]", texts)
+
+    def test_whole_exam_mode_without_tasks(self):
+        ExamFile.objects.filter(session_id=self.session_id).delete()
+        ExamFile.objects.create(
+            file=ContentFile(_docx_bytes("Einleitung", "Beschreibe das Bild."), name="exam.docx"),
+            session_id=self.session_id,
+        )
+        placement = _fake_completion('[{"after": 2, "text": "Teil"}]')
+        with mock.patch("simulator.llm.openai.OpenAI") as client_cls:
+            create = client_cls.return_value.chat.completions.create
+            create.side_effect = lambda **kw: placement if kw.get("temperature") == 0 else _fake_completion("Teil")
+            results = generate_ai_results(self.session_id, api_key="key")
+
+        # One answer and one placement call per level
+        self.assertEqual(create.call_count, 6)
+        texts = [p.text for p in Document(results[0].file.path).paragraphs]
+        self.assertEqual(texts[-1], "Teil")
+
+    def test_rerun_replaces_previous_results(self):
+        with mock.patch("simulator.llm.openai.OpenAI") as client_cls:
+            client_cls.return_value.chat.completions.create.return_value = _fake_completion("A")
+            generate_ai_results(self.session_id, api_key="key")
+            generate_ai_results(self.session_id, api_key="key")
+
+        self.assertEqual(AIResult.objects.filter(session_id=self.session_id).count(), 3)
+
+
+def _rate_limit_error(**headers):
+    request = httpx.Request("POST", "http://api.test/v1/chat/completions")
+    response = httpx.Response(429, headers=headers, request=request)
+    return openai.RateLimitError("rate limited", response=response, body=None)
+
+
+@override_settings(OPENAI_RETRY_BASE_DELAY=1.0, OPENAI_RETRY_MAX_DELAY=30.0, OPENAI_MAX_RETRIES=4)
+class ChatCompletionRetryTest(TestCase):
+    def setUp(self):
+        close_clients()
+        self.addCleanup(close_clients)
+
+    def test_clients_are_shared_per_key(self):
+        self.assertIs(get_client("key"), get_client("key"))
+        self.assertIsNot(get_client("key"), get_client("other"))
+
+    def test_retries_rate_limit_after_requested_delay(self):
+        client = mock.Mock()
+        client.chat.completions.create.side_effect = [
+            _rate_limit_error(**{"retry-after": "2"}),
+            _fake_completion("A"),
+        ]
+        with mock.patch("simulator.llm.time.sleep") as sleep:
+            response = chat_completion(client, purpose="answer", model="m", messages=[])
+
+        self.assertEqual(response.choices[0].message.content, "A")
+        self.assertEqual(client.chat.completions.create.call_count, 2)
+        sleep.assert_called_once_with(2.0)
+
+    def test_backoff_grows_exponentially_with_jitter(self):
+        error = openai.APIConnectionError(request=httpx.Request("POST", "http://api.test"))
+        for attempt in range(6):
+            cap = min(30.0, 2**attempt)
+            self.assertTrue(cap / 2 <= retry_delay(attempt, error) <= cap)
+        self.assertEqual(retry_delay(0, _rate_limit_error(**{"retry-after-ms": "250"})), 0.25)
+        # A malformed header falls back to the backoff instead of failing
+        self.assertTrue(0.5 <= retry_delay(0, _rate_limit_error(**{"retry-after": "soon"})) <= 1)
+
+    def test_client_errors_are_not_retried(self):
+        client = mock.Mock()
+        request = httpx.Request("POST", "http://api.test")
+        client.chat.completions.create.side_effect = openai.BadRequestError(
+            "bad", response=httpx.Response(400, request=request), body=None
+        )
+        with self.assertRaises(openai.BadRequestError):
+            chat_completion(client, purpose="answer", model="m", messages=[])
+        self.assertEqual(client.chat.completions.create.call_count, 1)
+
+    def test_deadline_limits_timeout_and_retries(self):
+        client = mock.Mock()
+        client.chat.completions.create.side_effect = _rate_limit_error(**{"retry-after": "60"})
+        with self.assertRaises(DeadlineExceeded):
+            chat_completion(
+                client, purpose="answer", deadline=time.monotonic() + 10, model="m", messages=[]
+            )
+        self.assertEqual(client.chat.completions.create.call_count, 1)
+        self.assertLessEqual(client.chat.completions.create.call_args.kwargs["timeout"], 10)
+
+    def test_expired_deadline_is_not_recorded_as_api_error(self):
+        client = mock.Mock()
+        recorder = mock.Mock()
+        with self.assertRaises(DeadlineExceeded):
+            chat_completion(
+                client,
+                purpose="answer",
+                recorder=recorder,
+                deadline=time.monotonic() - 1,
+                model="m",
+                messages=[],
+            )
+        client.chat.completions.create.assert_not_called()
+        recorder.record_call.assert_not_called()
+
+
+class RateLimitTest(TestCase):
+    def setUp(self):
+        self.config = AppConfig.get_solo()
+        self.config.rate_limit_rpm = 2
+        self.config.rate_limit_tpm = 1000
+        self.config.save()
+
+    def test_requests_per_minute(self):
+        self.assertEqual(reserve("gpt", 10), 0)
+        self.assertEqual(reserve("gpt", 10), 0)
+        wait = reserve("gpt", 10)
+        self.assertTrue(0 < wait <= 30)
+
+    def test_tokens_per_minute_and_settlement(self):
+        self.config.rate_limit_rpm = 0
+        self.config.save()
+        self.assertEqual(reserve("gpt", 800), 0)
+        self.assertAlmostEqual(reserve("gpt", 800), 36, delta=1)
+        # Only 100 of the 800 reserved tokens were used
+        settle("gpt", 800, 100)
+        self.assertEqual(reserve("gpt", 800), 0)
+
+    def test_disabled_without_limits(self):
+        self.config.rate_limit_rpm = self.config.rate_limit_tpm = 0
+        self.config.save()
+        self.assertEqual(reserve("gpt", 10**6), 0)
+        self.assertFalse(RateLimitBucket.objects.exists())
+
+    def test_chat_completion_waits_for_capacity(self):
+        client = mock.Mock()
+        client.chat.completions.create.return_value = _fake_completion("A")
+        with mock.patch("simulator.llm.ratelimit.reserve", side_effect=[5.0, 0.0]), mock.patch(
+            "simulator.llm.time.sleep"
+        ) as sleep:
+            chat_completion(
+                client, purpose="answer", model="m", messages=[{"role": "user", "content": "x"}]
+            )
+        sleep.assert_called_once_with(5.0)
+        self.assertEqual(client.chat.completions.create.call_count, 1)
+
+    async def test_broken_stream_settles_its_reservation(self):
+        async def chunks():
+            delta = SimpleNamespace(content="Teil")
+            yield SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=delta)])
+            raise httpx.ReadError("connection reset")
+
+        client = mock.Mock()
+        client.chat.completions.create = mock.AsyncMock(return_value=chunks())
+        messages = [{"role": "user", "content": "x"}]
+        with mock.patch("simulator.llm.ratelimit.reserve", return_value=0.0), mock.patch(
+            "simulator.llm.ratelimit.settle"
+        ) as settle:
+            with self.assertRaises(httpx.ReadError):
+                async for _ in stream_chat_completion(
+                    client, purpose="answer", model="m", messages=messages
+                ):
+                    pass
+        reserved = ratelimit.estimate_tokens("m", messages)
+        used = ratelimit.prompt_tokens("m", messages) + count_tokens("Teil", "m")
+        settle.assert_called_once_with("m", reserved, used)
+
+
+class ResponseCacheTest(TestCase):
+    def setUp(self):
+        config = AppConfig.get_solo()
+        config.response_cache_enabled = True
+        config.save()
+        self.client_mock = mock.Mock()
+        self.client_mock.chat.completions.create.return_value = _fake_completion("Antwort")
+
+    def _complete(self, **kwargs):
+        return chat_completion(
+            self.client_mock,
+            purpose="answer",
+            model="m",
+            messages=[{"role": "user", "content": "Frage"}],
+            **kwargs,
+        )
+
+    def test_repeated_request_is_answered_from_cache(self):
+        self._complete()
+        response = self._complete(timeout=5)
+        self.assertEqual(response.choices[0].message.content, "Antwort")
+        self.assertIsNone(response.usage)
+        self.assertEqual(self.client_mock.chat.completions.create.call_count, 1)
+        self.assertEqual(CachedResponse.objects.get().hits, 1)
+
+    def test_parameters_are_part_of_the_key(self):
+        self._complete()
+        self._complete(temperature=0)
+        self.assertEqual(self.client_mock.chat.completions.create.call_count, 2)
+
+    def test_disabled_cache_is_bypassed(self):
+        AppConfig.objects.filter(pk=1).update(response_cache_enabled=False)
+        bump_config_version()
+        self._complete()
+        self._complete()
+        self.assertEqual(self.client_mock.chat.completions.create.call_count, 2)
+        self.assertFalse(CachedResponse.objects.exists())
+
+    @override_settings(LLM_CACHE_MAX_BYTES=10)
+    def test_least_recently_used_entries_are_evicted(self):
+        response_cache.store("a", "m", "12345")
+        response_cache.store("b", "m", "12345")
+        CachedResponse.objects.filter(key="a").update(last_used=timezone.now() + timedelta(seconds=1))
+        response_cache.store("c", "m", "12345")
+        self.assertEqual(
+            set(CachedResponse.objects.values_list("key", flat=True)), {"a", "c"}
+        )
+
+    @override_settings(LLM_CACHE_TTL=60)
+    def test_expired_entries_are_ignored(self):
+        response_cache.store("a", "m", "Antwort")
+        CachedResponse.objects.update(created=timezone.now() - timedelta(minutes=2))
+        self.assertIsNone(response_cache.lookup("a"))
+
+
+class ExamTemplateTest(TestCase):
+    def setUp(self):
+        self.template = ExamTemplate(
+            io.BytesIO(_docx_bytes("Aufgabe 1", "[Antwort]", "Aufgabe 2", "Lösung: [Antwort]"))
+        )
+
+    def _texts(self, doc) -> list:
+        return [p.text for p in Document(io.BytesIO(to_bytes(doc))).paragraphs]
+
+    def test_indexes_placeholders_once(self):
+        self.assertEqual(self.template.placeholders, [1, 3])
+        self.assertEqual(self.template.numbered().splitlines()[2], "2: Aufgabe 2")
+
+    def test_segments_by_numbering_and_headings(self):
+        numbered = ExamTemplate(
+            io.BytesIO(_docx_bytes("Hinweise", "1. Nenne.", "Material", "", "2) Erkläre."))
+        )
+        self.assertEqual(
+            [(t.number, t.anchor, t.placeholder) for t in numbered.tasks],
+            [(1, 2, False), (2, 4, False)],
+        )
+        self.assertEqual(numbered.tasks[0].text, "1. Nenne.\nMaterial")
+
+        doc = Document()
+        doc.add_heading("Teil A", level=2)
+        doc.add_paragraph("Beschreibe.")
+        doc.add_heading("Teil B", level=2)
+        buffer = io.BytesIO()
+        doc.save(buffer)
+        headings = ExamTemplate(io.BytesIO(buffer.getvalue()))
+        self.assertEqual([t.anchor for t in headings.tasks], [1, 2])
+
+        self.assertEqual(ExamTemplate(io.BytesIO(_docx_bytes("Freitext"))).tasks, [])
+
+    def test_copies_are_independent(self):
+        color = LEVEL_COLORS["low"]
+        first, paragraphs = self.template.copy()
+        self.assertTrue(self.template.fill_placeholders(paragraphs, "low", "A", color))
+        second, _ = self.template.copy()
+
+        self.assertEqual(
+            self._texts(first),
+            ["Aufgabe 1", "", "Low Antwort:", "A", "Aufgabe 2", "Lösung:", "Low Antwort:", "A"],
+        )
+        self.assertEqual(self._texts(second), self.template.paragraphs)
+        saved = Document(io.BytesIO(to_bytes(first)))
+        self.assertEqual(saved.paragraphs[2].style.name, "Heading 2")
+
+    def test_scan_matches_the_parsed_document(self):
+        doc = Document()
+        doc.add_heading("Aufgabe 1", level=2)
+        para = doc.add_paragraph("Text\tmit Tab")
+        para.add_run().add_break()
+        para.add_run("[Antwort]")
+        doc.add_table(rows=1, cols=1).cell(0, 0).text = "Tabelle [Antwort]"
+        doc.add_paragraph("")
+        buffer = io.BytesIO()
+        doc.save(buffer)
+
+        index = scan_exam(io.BytesIO(buffer.getvalue()))
+        parsed = ExamTemplate(io.BytesIO(buffer.getvalue()))
+        self.assertEqual(index["paragraphs"], parsed.paragraphs)
+        self.assertEqual(index["placeholders"], parsed.placeholders)
+        self.assertEqual(index["headings"], parsed.headings)
+
+        with mock.patch("simulator.docbuild.Document", wraps=Document) as load:
+            template = ExamTemplate(io.BytesIO(buffer.getvalue()), index)
+            self.assertEqual(template.tasks, parsed.tasks)
+            load.assert_not_called()
+            template.copy()
+        load.assert_called_once()
+
+    def test_upload_rejects_results_and_stores_the_index(self):
+        with self.assertRaises(ResultDocumentError):
+            scan_exam(io.BytesIO(_docx_bytes("Aufgabe 1", "Medium", "Antwort: B")))
+        result = SimpleUploadedFile("result.docx", _docx_bytes("Aufgabe 1", "Low Antwort:", "A"))
+        form = ExamUploadForm(files={"file": result})
+        self.assertFalse(form.is_valid())
+
+        exam = SimpleUploadedFile("exam.docx", _docx_bytes("Aufgabe 1", "[Antwort]"))
+        form = ExamUploadForm(files={"file": exam})
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.exam_index["placeholders"], [1])
+        self.assertEqual(form.cleaned_data["file"].tell(), 0)
+
+    def test_segments_use_original_positions(self):
+        doc, paragraphs = self.template.copy()
+        inserted = self.template.insert_segments(
+            paragraphs, [(3, "zwei"), (1, "eins"), (99, "ignoriert")], "high", LEVEL_COLORS["high"]
+        )
+        self.assertTrue(inserted)
+        self.assertEqual(
+            self._texts(doc),
+            ["Aufgabe 1", "High Antwort:", "eins", "[Antwort]", "Aufgabe 2",
+             "High Antwort:", "zwei", "Lösung: [Antwort]"],
+        )
+
+
+class SimulationJobTest(SimulatorTestCase):
+    def setUp(self):
+        super().setUp()
+        config = AppConfig.get_solo()
+        config.openai_api_key = "key"
+        config.setup_complete = True
+        config.save()
+        session = self.client.session
+        session["session_id"] = self.session_id
+        session.save()
+
+    def test_enqueue_is_deduplicated_per_session(self):
+        job, created = enqueue_simulation(self.session_id)
+        again, created_again = enqueue_simulation(self.session_id)
+        self.assertTrue(created)
+        self.assertFalse(created_again)
+        self.assertEqual(job.pk, again.pk)
+
+    def test_run_simulation_enqueues_and_worker_processes(self):
+        with mock.patch("simulator.views.acheck_openai_key", return_value=True):
+            response = self.client.post(reverse("run_simulation"))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.client.get(reverse("simulation_status")).json()["status"], "queued")
+
+        with mock.patch("simulator.llm.openai.OpenAI") as client_cls:
+            client_cls.return_value.chat.completions.create.return_value = _fake_completion("A")
+            call_command("simulation_worker", once=True, concurrency=1, stdout=io.StringIO())
+
+        status = self.client.get(reverse("simulation_status")).json()
+        self.assertEqual(status["status"], "done")
+        self.assertEqual(set(status["progress"].values()), {"done"})
+        self.assertEqual(AIResult.objects.filter(session_id=self.session_id).count(), 3)
+
+    def test_stale_running_job_is_requeued(self):
+        job, _ = enqueue_simulation(self.session_id)
+        SimulationJob.objects.filter(pk=job.pk).update(
+            status=SimulationJob.STATUS_RUNNING,
+            heartbeat=timezone.now() - timedelta(hours=1),
+            attempts=1,
+        )
+        self.assertEqual(recover_stale_jobs(timeout=60), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, SimulationJob.STATUS_QUEUED)
+
+    def test_heartbeat_keeps_long_running_job_alive(self):
+        job = start_job(self.session_id, "w")
+        SimulationJob.objects.filter(pk=job.pk).update(
+            heartbeat=timezone.now() - timedelta(hours=1)
+        )
+        beats = []
+        with mock.patch("simulator.jobs.touch_job", side_effect=beats.append), mock.patch(
+            "simulator.jobs.connection"
+        ):
+            stop = start_heartbeat(job, interval=0.01)
+            time.sleep(0.1)
+            stop.set()
+        self.assertTrue(beats)
+        self.assertTrue(all(beat is job for beat in beats))
+
+        # What the thread does on every beat
+        self.assertTrue(touch_job(job))
+        self.assertEqual(recover_stale_jobs(timeout=60), 0)
+
+    async def test_stream_simulation_sends_deltas_and_stores_results(self):
+        calls = []
+
+        async def create(**kwargs):
+            calls.append(kwargs)
+
+            async def chunks():
+                for piece in ("Ant", "wort"):
+                    delta = SimpleNamespace(content=piece)
+                    yield SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=delta)])
+                usage = SimpleNamespace(prompt_tokens=50, completion_tokens=2, prompt_tokens_details=None)
+                yield SimpleNamespace(usage=usage, choices=[])
+
+            return chunks()
+
+        self.async_client.cookies = self.client.cookies
+        with mock.patch("simulator.views.acheck_openai_key", return_value=True), mock.patch(
+            "simulator.llm.openai.AsyncOpenAI"
+        ) as client_cls, mock.patch("simulator.llm.openai.OpenAI"):
+            client_cls.return_value.chat.completions.create = create
+            response = await self.async_client.post(reverse("stream_simulation"))
+            self.assertEqual(response["Content-Type"], "text/event-stream")
+            body = "".join([chunk.decode() async for chunk in response.streaming_content])
+
+        self.assertEqual(len(calls), 3)
+        self.assertTrue(all(call["stream"] for call in calls))
+        events = [block.split("\n", 1)[0] for block in body.split("\n\n") if block]
+        self.assertEqual(events[0], "event: start")
+        self.assertEqual(events.count("event: delta"), 6)
+        self.assertEqual(events.count("event: level"), 6)
+        self.assertEqual(events[-1], "event: done")
+        results = [r async for r in AIResult.objects.filter(session_id=self.session_id)]
+        self.assertEqual(len(results), 3)
+        self.assertEqual({r.completion_tokens for r in results}, {2})
+        texts = [p.text for p in Document(results[0].file.path).paragraphs]
+        self.assertIn("Antwort", texts)
+        job = await SimulationJob.objects.aget(session_id=self.session_id)
+        self.assertEqual(job.status, SimulationJob.STATUS_DONE)
+        run = await SimulationRun.objects.aget(session_id=self.session_id)
+        self.assertEqual(run.status, "done")
+        self.assertTrue({"extraction", "prompt", "llm", "docx", "storage"} <= set(run.stages))
+        self.assertEqual(await run.calls.filter(purpose="answer").acount(), 3)
+
+    def test_running_limit_keeps_jobs_queued(self):
+        AppConfig.objects.filter(pk=1).update(max_running_simulations=1)
+        bump_config_version()
+        start_job("other", "w")
+        with mock.patch("simulator.views.acheck_openai_key", return_value=True):
+            response = self.client.post(reverse("stream_simulation"))
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()["status"], "queued")
+
+        self.assertIsNone(claim_next_job("w"))
+        status = job_status(SimulationJob.objects.get(session_id=self.session_id))
+        self.assertEqual(status["position"], 1)
+        self.assertGreater(status["estimated_wait"], 0)
+
+    def test_stream_simulation_rejects_second_run(self):
+        enqueue_simulation(self.session_id)
+        with mock.patch("simulator.views.acheck_openai_key", return_value=True):
+            response = self.client.post(reverse("stream_simulation"))
+        self.assertEqual(response.status_code, 409)
+
+    def test_stream_simulation_is_queued_under_wsgi(self):
+        self.assertFalse(self.client.get(reverse("index")).context["can_stream"])
+        with mock.patch("simulator.views.acheck_openai_key", return_value=True), mock.patch(
+            "simulator.llm.openai.OpenAI"
+        ) as client_cls:
+            response = self.client.post(reverse("stream_simulation"))
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()["status"], "queued")
+        client_cls.return_value.chat.completions.create.assert_not_called()
+
+
+def _batch_output(request_lines: str) -> str:
+    """Answer every request of an uploaded batch file like OpenAI would."""
+    output = []
+    for line in request_lines.splitlines():
+        request = json.loads(line)
+        body = {
+            "id": "chatcmpl-1",
+            "object": "chat.completion",
+            "created": 0,
+            "model": request["body"]["model"],
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": "Stapelantwort"},
+                }
+            ],
+            "usage": {"prompt_tokens": 40, "completion_tokens": 5, "total_tokens": 45},
+        }
+        output.append(
+            json.dumps(
+                {"custom_id": request["custom_id"], "response": {"status_code": 200, "body": body}}
+            )
+        )
+    return "\n".join(output)
+
+
+class BatchSimulationTest(SimulatorTestCase):
+    def test_local_runner_processes_all_sessions(self):
+        with mock.patch("simulator.llm.openai.OpenAI") as client_cls:
+            client_cls.return_value.chat.completions.create.return_value = _fake_completion("A")
+            out = io.StringIO()
+            call_command("simulate_batch", self.session_id, concurrency=1, stdout=out)
+
+        self.assertIn("Simulated 1 of 1 session(s).", out.getvalue())
+        self.assertEqual(AIResult.objects.filter(session_id=self.session_id).count(), 3)
+
+    def test_import_exams_creates_one_session_per_exam(self):
+        exams = tempfile.mkdtemp()
+        contexts = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, exams)
+        self.addCleanup(shutil.rmtree, contexts)
+        for name in ("a.docx", "b.docx"):
+            with open(os.path.join(exams, name), "wb") as fh:
+                fh.write(_docx_bytes("Aufgabe 1", "[Antwort]"))
+        with open(os.path.join(contexts, "notes.txt"), "w") as fh:
+            fh.write("Kontext")
+
+        session_ids = import_exams(exams, contexts)
+
+        self.assertEqual(len(session_ids), 2)
+        for session_id in session_ids:
+            session = Session.objects.get(session_id=session_id)
+            self.assertEqual((session.exam_count, session.context_count), (1, 1))
+
+    def test_import_exams_without_context(self):
+        exams = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, exams)
+        with open(os.path.join(exams, "a.docx"), "wb") as fh:
+            fh.write(_docx_bytes("Aufgabe 1", "[Antwort]"))
+
+        (session_id,) = import_exams(exams)
+
+        session = Session.objects.get(session_id=session_id)
+        self.assertEqual((session.exam_count, session.context_count), (1, 0))
+
+    def test_openai_batch_results_are_stored(self):
+        with mock.patch("simulator.llm.openai.OpenAI") as client_cls:
+            client = client_cls.return_value
+            client.files.create.return_value = SimpleNamespace(id="file-in")
+            client.batches.create.return_value = SimpleNamespace(id="batch_1", status="validating")
+            batch = submit_batch([self.session_id], api_key="key")
+
+            uploaded = client.files.create.call_args.kwargs["file"][1].decode()
+            client.files.content.return_value = SimpleNamespace(text=_batch_output(uploaded))
+            client.batches.retrieve.return_value = SimpleNamespace(
+                status="in_progress", output_file_id=None
+            )
+            self.assertEqual(collect_pending(api_key="key"), 0)
+            client.batches.retrieve.return_value = SimpleNamespace(
+                status="completed", output_file_id="file-out"
+            )
+            self.assertEqual(collect_pending(api_key="key"), 1)
+
+        self.assertEqual(batch.request_count, 3)
+        batch.refresh_from_db()
+        self.assertEqual(batch.status, SimulationBatch.STATUS_DONE)
+        self.assertEqual(batch.stored_count, 1)
+        results = AIResult.objects.filter(session_id=self.session_id)
+        self.assertEqual(results.count(), 3)
+        self.assertEqual({r.completion_tokens for r in results}, {5})
+        texts = [p.text for p in Document(results[0].file.path).paragraphs]
+        self.assertIn("Stapelantwort", texts)
+
+    def test_openai_batch_is_collected_as_submitted(self):
+        with mock.patch("simulator.llm.openai.OpenAI") as client_cls:
+            client = client_cls.return_value
+            client.files.create.return_value = SimpleNamespace(id="file-in")
+            client.batches.create.return_value = SimpleNamespace(id="batch_1", status="validating")
+            batch = submit_batch([self.session_id], api_key="key")
+            uploaded = client.files.create.call_args.kwargs["file"][1].decode()
+            client.files.content.return_value = SimpleNamespace(text=_batch_output(uploaded))
+            client.batches.retrieve.return_value = SimpleNamespace(
+                status="completed", output_file_id="file-out"
+            )
+            # Planning again now would ask for one answer per task instead
+            with override_settings(SIMULATION_PER_TASK=True):
+                self.assertEqual(collect_pending(api_key="key"), 1)
+
+        batch.refresh_from_db()
+        self.assertEqual(batch.stored_count, 1, batch.error)
+        self.assertEqual(AIResult.objects.filter(session_id=self.session_id).count(), 3)
+
+    def test_openai_batch_answers_by_task_are_collected(self):
+        with mock.patch("simulator.llm.openai.OpenAI") as client_cls:
+            client = client_cls.return_value
+            client.files.create.return_value = SimpleNamespace(id="file-in")
+            client.batches.create.return_value = SimpleNamespace(id="batch_1", status="validating")
+            with override_settings(SIMULATION_PER_TASK=True):
+                batch = submit_batch([self.session_id], api_key="key")
+            uploaded = client.files.create.call_args.kwargs["file"][1].decode()
+            client.files.content.return_value = SimpleNamespace(text=_batch_output(uploaded))
+            client.batches.retrieve.return_value = SimpleNamespace(
+                status="completed", output_file_id="file-out"
+            )
+            self.assertEqual(collect_pending(api_key="key"), 1)
+
+        batch.refresh_from_db()
+        self.assertEqual(batch.stored_count, 1, batch.error)
+        self.assertEqual(AIResult.objects.filter(session_id=self.session_id).count(), 3)
+
+
+class ExtractedTextCacheTest(SimulatorTestCase):
+    def test_identical_files_are_parsed_once(self):
+        Session.ensure("s2")
+        other = ContextFile.objects.create(
+            file=ContentFile(b"Kontext", name="copy.txt"), session_id="s2"
+        )
+        first = ContextFile.objects.get(session_id=self.session_id)
+        with mock.patch("simulator.extraction.read_text", return_value=("Kontext", False)) as read:
+            self.assertEqual(extract_text(first.file.path), "Kontext")
+            self.assertEqual(extract_text(other.file.path), "Kontext")
+        self.assertEqual(read.call_count, 1)
+
+    def test_files_are_extracted_in_parallel_in_order(self):
+        paths = [
+            ContextFile.objects.create(
+                file=ContentFile(_docx_bytes(f"Kapitel {i}"), name=f"k{i}.docx"),
+                session_id=self.session_id,
+            ).file.path
+            for i in range(3)
+        ]
+        files = [(path, None) for path in paths]
+        pools = {}
+        self.addCleanup(lambda: [p.shutdown() for p in pools.values()])
+        with mock.patch.dict("simulator.extraction._pools", clear=True), mock.patch(
+            "simulator.extraction.ProcessPoolExecutor", wraps=ProcessPoolExecutor
+        ) as pool:
+            first = extract_texts(files, workers=2)
+            ExtractedText.objects.all().delete()
+            second = extract_texts(files, workers=2)
+            pools.update(extraction._pools)
+        # One pool of fork server processes is shared by all calls
+        pool.assert_called_once()
+        self.assertEqual(pool.call_args.kwargs["max_workers"], 2)
+        self.assertEqual(pool.call_args.kwargs["mp_context"].get_start_method(), "forkserver")
+        self.assertEqual([e.text for e in first], ["Kapitel 0", "Kapitel 1", "Kapitel 2"])
+        self.assertEqual([e.text for e in second], [e.text for e in first])
+        self.assertFalse(any(e.cached for e in first))
+        self.assertTrue(all(e.seconds > 0 for e in first))
+        self.assertTrue(all(e.cached for e in extract_texts(files, workers=2)))
+
+    @override_settings(OPENAI_PROMPT_TOKEN_BUDGET=1000)
+    def test_oversized_context_is_packed_into_the_budget(self):
+        ContextFile.objects.create(
+            file=ContentFile(b"Lorem ipsum dolor.\n" * 100000, name="book.txt"),
+            session_id=self.session_id,
+        )
+        prompt = assemble_prompt(self.session_id)
+        self.assertLessEqual(count_tokens(prompt), 1000)
+        entry = ExtractedText.objects.get(file_type=".txt", truncated=True)
+        self.assertLess(len(entry.text), 100000)
+
+    def test_clean_sessions_evicts_stale_entries(self):
+        extract_text(ContextFile.objects.get(session_id=self.session_id).file.path)
+        ExtractedText.objects.update(last_used=timezone.now() - timedelta(days=30))
+        call_command("clean_sessions", stdout=io.StringIO())
+        self.assertFalse(ExtractedText.objects.exists())
+
+
+class UploadStorageTest(SimulatorTestCase):
+    def setUp(self):
+        super().setUp()
+        session = self.client.session
+        session["session_id"] = self.session_id
+        session.save()
+
+    def _upload(self, content: bytes, name: str) -> ContextFile:
+        self.client.post(
+            reverse("upload_context"), {"file": SimpleUploadedFile(name, content)}
+        )
+        return ContextFile.objects.filter(session_id=self.session_id).latest("pk")
+
+    def test_identical_uploads_share_one_blob(self):
+        first = self._upload(b"Lehrbuch", "buch.txt")
+        second = self._upload(b"Lehrbuch", "kopie.txt")
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertEqual((first.original_name, second.original_name), ("buch.txt", "kopie.txt"))
+        self.assertEqual(StoredBlob.objects.get(name=first.file.name).refs, 2)
+        self.assertContains(self.client.get(reverse("index")), "kopie.txt")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("delete_context", args=[first.pk]))
+        self.assertTrue(os.path.exists(second.file.path))
+        self.assertEqual(StoredBlob.objects.get(name=second.file.name).refs, 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("delete_context", args=[second.pk]))
+        self.assertFalse(os.path.exists(second.file.path))
+        self.assertFalse(StoredBlob.objects.filter(name=second.file.name).exists())
+
+    def test_upload_after_release_keeps_the_file(self):
+        context = self._upload(b"Lehrbuch", "buch.txt")
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.post(reverse("delete_context", args=[context.pk]))
+        again = self._upload(b"Lehrbuch", "wieder.txt")
+        for callback in callbacks:
+            callback()
+        self.assertEqual(again.file.name, context.file.name)
+        self.assertTrue(os.path.exists(again.file.path))
+        self.assertEqual(StoredBlob.objects.get(name=again.file.name).refs, 1)
+
+    def test_failed_delete_keeps_the_file(self):
+        context = self._upload(b"Lehrbuch", "buch.txt")
+        with mock.patch.object(
+            ContextFile, "delete", side_effect=DatabaseError("locked")
+        ), self.assertRaises(DatabaseError), self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("delete_context", args=[context.pk]))
+        self.assertTrue(ContextFile.objects.filter(pk=context.pk).exists())
+        self.assertTrue(os.path.exists(context.file.path))
+        self.assertEqual(StoredBlob.objects.get(name=context.file.name).refs, 1)
+
+    def test_exam_upload_stores_the_paragraph_index(self):
+        self.client.post(
+            reverse("upload_exam"),
+            {"file": SimpleUploadedFile("neu.docx", _docx_bytes("Aufgabe 1", "[Antwort]"))},
+        )
+        exam = ExamFile.objects.get(session_id=self.session_id)
+        self.assertEqual(exam.original_name, "neu.docx")
+        self.assertEqual(exam.index["paragraphs"], ["Aufgabe 1", "[Antwort]"])
+        with mock.patch(
+            "simulator.services.extract_texts", wraps=extract_texts
+        ) as extract:
+            prompt = assemble_prompt(self.session_id)
+        self.assertIn("Aufgabe 1\n[Antwort]", prompt)
+        # Only the context file is extracted
+        context = ContextFile.objects.get(session_id=self.session_id)
+        self.assertEqual([path for path, _ in extract.call_args[0][0]], [context.file.path])
+
+    def test_extraction_reuses_the_upload_hash(self):
+        context = self._upload(b"Kapitel 1", "kapitel.txt")
+        with mock.patch("simulator.extraction.file_hash") as file_hash:
+            self.assertEqual(extract_text(context.file.path), "Kapitel 1")
+        file_hash.assert_not_called()
+
+
+class WarmStartTest(SimulatorTestCase):
+    def setUp(self):
+        super().setUp()
+        config = AppConfig.get_solo()
+        config.openai_api_key = "key"
+        config.setup_complete = True
+        config.prepare_on_upload = True
+        config.prepare_answers = True
+        config.save()
+        session = self.client.session
+        session["session_id"] = self.session_id
+        session.save()
+
+    def _prepare(self, content: str = "Vorab"):
+        with mock.patch("simulator.llm.openai.OpenAI") as client_cls:
+            client_cls.return_value.chat.completions.create.return_value = _fake_completion(content)
+            self.assertTrue(process_next_preparation())
+        close_clients()
+        return PreparedSimulation.objects.get(session_id=self.session_id)
+
+    def test_upload_schedules_preparation(self):
+        self.client.post(
+            reverse("upload_context"), {"file": SimpleUploadedFile("neu.txt", b"Mehr")}
+        )
+        prepared = PreparedSimulation.objects.get(session_id=self.session_id)
+        self.assertEqual(prepared.status, PreparedSimulation.STATUS_PENDING)
+
+        prepared = self._prepare()
+        self.assertEqual(prepared.status, PreparedSimulation.STATUS_READY)
+        self.assertIn("Mehr", prepared.prompt)
+        self.assertEqual(set(prepared.answers), {"low:", "medium:", "high:"})
+        self.assertFalse(process_next_preparation())
+
+    def test_prepared_answers_are_recorded(self):
+        self.client.post(
+            reverse("upload_context"), {"file": SimpleUploadedFile("neu.txt", b"Mehr")}
+        )
+        self._prepare()
+        run = SimulationRun.objects.get(session_id=self.session_id)
+        self.assertEqual(run.status, "done")
+        self.assertIn("extraction", run.stages)
+        self.assertEqual(
+            sorted(run.calls.values_list("level", flat=True)), ["high", "low", "medium"]
+        )
+
+    def test_simulation_takes_over_prepared_answers(self):
+        self.client.post(
+            reverse("upload_context"), {"file": SimpleUploadedFile("neu.txt", b"Mehr")}
+        )
+        self._prepare()
+        with mock.patch("simulator.llm.openai.OpenAI") as client_cls, mock.patch(
+            "simulator.services.assemble_prompt"
+        ) as assemble:
+            create = client_cls.return_value.chat.completions.create
+            results = generate_ai_results(self.session_id, api_key="key")
+        create.assert_not_called()
+        assemble.assert_not_called()
+        texts = [p.text for p in Document(results[0].file.path).paragraphs]
+        self.assertIn("Vorab", texts)
+        # Prepared answers are used only once
+        self.assertFalse(PreparedSimulation.objects.exists())
+
+    def test_changed_files_discard_the_preparation(self):
+        self.client.post(
+            reverse("upload_context"), {"file": SimpleUploadedFile("neu.txt", b"Mehr")}
+        )
+        self._prepare()
+        AppConfig.objects.filter(pk=1).update(prepare_on_upload=False)
+        bump_config_version()
+        self.client.post(
+            reverse("upload_context"), {"file": SimpleUploadedFile("neu2.txt", b"Anders")}
+        )
+        with mock.patch("simulator.llm.openai.OpenAI") as client_cls:
+            create = client_cls.return_value.chat.completions.create
+            create.return_value = _fake_completion("Neu")
+            generate_ai_results(self.session_id, api_key="key")
+        self.assertEqual(create.call_count, 3)
+        self.assertIn("Anders", str(create.call_args.kwargs["messages"]))
+
+    def test_queued_simulations_come_first(self):
+        self.client.post(
+            reverse("upload_context"), {"file": SimpleUploadedFile("neu.txt", b"Mehr")}
+        )
+        enqueue_simulation(self.session_id)
+        self.assertFalse(process_next_preparation())
+        self.assertEqual(
+            PreparedSimulation.objects.get(session_id=self.session_id).status,
+            PreparedSimulation.STATUS_PENDING,
+        )
+
+
+class ContextSelectionTest(TestCase):
+    def test_most_relevant_chunks_are_selected(self):
+        relevant = "Die Photosynthese findet im Chlorophyll der Chloroplasten statt."
+        filler = "\n".join(f"Kapitel {i}: Die Geschichte Roms und seiner Kaiser." for i in range(400))
+        selected = select_context(
+            "Aufgabe: Erkläre die Photosynthese.", [filler, relevant], budget_tokens=60
+        )
+        self.assertIn(relevant, selected)
+        self.assertLessEqual(count_tokens(selected), 60)
+
+
+class CleanSessionsTest(SimulatorTestCase):
+    def setUp(self):
+        super().setUp()
+        Session.refresh(self.session_id)
+        self.paths = [
+            obj.file.path
+            for model in (ContextFile, ExamFile)
+            for obj in model.objects.filter(session_id=self.session_id)
+        ]
+        Session.objects.update(last_activity=timezone.now() - timedelta(days=30))
+        Session.ensure("fresh")
+        ExamFile.objects.create(
+            file=ContentFile(b"x", name="fresh.docx"), session_id="fresh"
+        )
+        Session.refresh("fresh")
+
+    def test_deletes_stale_sessions_in_batches(self):
+        out = io.StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("clean_sessions", batch_size=1, workers=2, stdout=out)
+        self.assertIn("Deleted 1 stale session(s).", out.getvalue())
+        self.assertFalse(ContextFile.objects.filter(session_id=self.session_id).exists())
+        self.assertFalse(Session.objects.filter(session_id=self.session_id).exists())
+        self.assertTrue(Session.objects.filter(session_id="fresh").exists())
+        self.assertFalse(any(os.path.exists(path) for path in self.paths))
+
+    def test_dry_run_keeps_everything(self):
+        out = io.StringIO()
+        call_command("clean_sessions", dry_run=True, stdout=out)
+        self.assertIn("1 stale session(s) would be deleted", out.getvalue())
+        self.assertTrue(all(os.path.exists(path) for path in self.paths))
+        self.assertEqual(Session.objects.count(), 2)
+
+    def test_interrupted_run_is_resumed(self):
+        leftover = default_storage.save("context_files/leftover.txt", ContentFile(b"x"))
+        kept = ExamFile.objects.get(session_id="fresh").file
+        journal = os.path.join(self.media_root, ".clean_sessions.journal")
+        with open(journal, "w") as fh:
+            json.dump([leftover, kept.name], fh)
+        call_command("clean_sessions", stdout=io.StringIO())
+        self.assertFalse(os.path.exists(journal))
+        self.assertFalse(default_storage.exists(leftover))
+        # Files still referenced by a row are never removed on resume
+        self.assertTrue(os.path.exists(kept.path))
+
+    def test_resume_keeps_results_of_surviving_sessions(self):
+        result = AIResult(level="low", session_id="fresh")
+        result.file.save("fresh/klausur_low.docx", ContentFile(b"x"))
+        gone = default_storage.save("ai_results/gone/klausur_low.docx", ContentFile(b"x"))
+        journal = os.path.join(self.media_root, ".clean_sessions.journal")
+        with open(journal, "w") as fh:
+            json.dump(["ai_results/fresh/", "ai_results/gone/"], fh)
+        call_command("clean_sessions", stdout=io.StringIO())
+        self.assertTrue(os.path.exists(result.file.path))
+        self.assertFalse(default_storage.exists(gone))
+
+    def test_shared_uploads_are_kept_for_other_sessions(self):
+        shared = ContextFile.objects.create(
+            file=ContentFile(b"Kontext", name="same.txt"), session_id="fresh"
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("clean_sessions", stdout=io.StringIO())
+        self.assertTrue(os.path.exists(shared.file.path))
+        self.assertEqual(StoredBlob.objects.get(name=shared.file.name).refs, 1)
+        self.assertFalse(any(os.path.exists(path) for path in self.paths if path != shared.file.path))
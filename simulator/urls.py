@@ -8,4 +8,6 @@ urlpatterns = [
     path('delete/context/<int:pk>/', views.delete_context, name='delete_context'),
     path('delete/exam/<int:pk>/', views.delete_exam, name='delete_exam'),
     path('run/', views.run_simulation, name='run_simulation'),
+    path('run/status/', views.simulation_status, name='simulation_status'),
+    path('run/stream/', views.stream_simulation, name='stream_simulation'),
 ]
@@ -2,16 +2,29 @@ from __future__ import annotations
 
 import uuid
 
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponseNotAllowed, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
 
 from django.contrib import messages
 from django.conf import settings
+from django.db import transaction
 
 from .forms import ContextUploadForm, ExamUploadForm
-from .models import ContextFile, ExamFile, AIResult
-from config.models import AppConfig
-from config.views import _check_openai_key
-from .services import generate_ai_results
+from .models import ContextFile, ExamFile, AIResult, Session
+from config.utils import acheck_openai_key, aget_config, check_openai_key, get_config
+from .jobs import (
+    alatest_job,
+    default_worker_name,
+    enqueue_simulation,
+    has_capacity,
+    job_status,
+    latest_job,
+    start_job,
+)
+from .streaming import stream_job
+from .warmstart import schedule_preparation
 
 
 def _ensure_session_id(request) -> str:
@@ -20,13 +33,28 @@ def _ensure_session_id(request) -> str:
     if not session_id:
         session_id = uuid.uuid4().hex
         request.session["session_id"] = session_id
+    Session.ensure(session_id)
     return session_id
 
 
+async def _asession_id(request) -> str | None:
+    """Return the session ID from an async view; loading the session is sync."""
+    return await sync_to_async(request.session.get)("session_id")
+
+
+async def _acheck_simulation_password(config, request) -> bool:
+    if not config.simulation_password_hash:
+        return True
+    sim_pw = request.POST.get("sim_password", "")
+    # Password hashing is slow; keep it off the event loop
+    check = sync_to_async(config.check_simulation_password, thread_sensitive=False)
+    return await check(sim_pw)
+
+
 def index(request):
     """Display upload forms and current session files."""
     session_id = request.session.get("session_id")
-    config = AppConfig.get_solo()
+    config = get_config()
     context_files = (
         ContextFile.objects.filter(session_id=session_id) if session_id else []
     )
@@ -42,9 +70,12 @@ def index(request):
             "exam_files": exam_files,
         "session_id": session_id,
         "ai_results": ai_results,
+        "simulation_job": latest_job(session_id) if session_id else None,
         "setup_required": not config.setup_complete,
-        "api_key_valid": _check_openai_key(config.openai_api_key),
+        "api_key_valid": check_openai_key(config.openai_api_key, blocking=False),
         "sim_password_required": bool(config.simulation_password_hash),
+        # Streaming ties up the serving thread for the whole run under WSGI
+        "can_stream": isinstance(request, ASGIRequest),
     },
     )
 
@@ -58,13 +89,15 @@ def upload_context(request):
             ContextFile.objects.create(
                 file=form.cleaned_data["file"], session_id=session_id
             )
+            Session.refresh(session_id)
+            schedule_preparation(session_id)
             return redirect("index")
         session_id = request.session.get("session_id")
         context_files = (
             ContextFile.objects.filter(session_id=session_id) if session_id else []
         )
         exam_files = ExamFile.objects.filter(session_id=session_id) if session_id else []
-        config = AppConfig.get_solo()
+        config = get_config()
         return render(
             request,
             "simulator/index.html",
@@ -75,7 +108,7 @@ def upload_context(request):
                 "exam_files": exam_files,
                 "session_id": session_id,
                 "setup_required": not config.setup_complete,
-                "api_key_valid": _check_openai_key(config.openai_api_key),
+                "api_key_valid": check_openai_key(config.openai_api_key, blocking=False),
                 "sim_password_required": bool(config.simulation_password_hash),
             },
         )
@@ -88,17 +121,23 @@ def upload_exam(request):
         form = ExamUploadForm(request.POST, request.FILES)
         if form.is_valid():
             session_id = _ensure_session_id(request)
-            ExamFile.objects.filter(session_id=session_id).delete()
-            ExamFile.objects.create(
-                file=form.cleaned_data["file"], session_id=session_id
-            )
+            with transaction.atomic():
+                for old in ExamFile.objects.filter(session_id=session_id):
+                    _delete_upload(old)
+                ExamFile.objects.create(
+                    file=form.cleaned_data["file"],
+                    session_id=session_id,
+                    index=form.exam_index or {},
+                )
+            Session.refresh(session_id)
+            schedule_preparation(session_id)
             return redirect("index")
         session_id = request.session.get("session_id")
         context_files = (
             ContextFile.objects.filter(session_id=session_id) if session_id else []
         )
         exam_files = ExamFile.objects.filter(session_id=session_id) if session_id else []
-        config = AppConfig.get_solo()
+        config = get_config()
         return render(
             request,
             "simulator/index.html",
@@ -109,19 +148,31 @@ def upload_exam(request):
                 "exam_files": exam_files,
                 "session_id": session_id,
                 "setup_required": not config.setup_complete,
-                "api_key_valid": _check_openai_key(config.openai_api_key),
+                "api_key_valid": check_openai_key(config.openai_api_key, blocking=False),
                 "sim_password_required": bool(config.simulation_password_hash),
             },
         )
     return redirect("index")
 
 
+def _delete_upload(file_obj) -> None:
+    """Delete an uploaded file's row and release its file.
+
+    Call this in a transaction: the file is only removed once it committed,
+    so a failed delete never leaves a row pointing at a missing file.
+    """
+    file_obj.delete()
+    file_obj.file.delete(save=False)
+
+
 def delete_context(request, pk: int):
     """Remove a context file from the current session."""
     session_id = request.session.get("session_id")
     file_obj = get_object_or_404(ContextFile, pk=pk, session_id=session_id)
-    file_obj.file.delete(save=False)
-    file_obj.delete()
+    with transaction.atomic():
+        _delete_upload(file_obj)
+    Session.refresh(session_id)
+    schedule_preparation(session_id)
     return redirect("index")
 
 
@@ -129,34 +180,88 @@ def delete_exam(request, pk: int):
     """Remove an exam file from the current session."""
     session_id = request.session.get("session_id")
     file_obj = get_object_or_404(ExamFile, pk=pk, session_id=session_id)
-    file_obj.file.delete(save=False)
-    file_obj.delete()
+    with transaction.atomic():
+        _delete_upload(file_obj)
+    Session.refresh(session_id)
+    schedule_preparation(session_id)
     return redirect("index")
 
 
-def run_simulation(request):
-    """Execute the AI simulation for the current session."""
-    session_id = request.session.get("session_id")
-    config = AppConfig.get_solo()
+async def run_simulation(request):
+    """Queue the AI simulation for the current session."""
+    session_id = await _asession_id(request)
+    config = await aget_config()
     if not config.setup_complete:
         return redirect("setup")
     if not session_id:
         return redirect("index")
 
-    if not _check_openai_key(config.openai_api_key):
+    if not await acheck_openai_key(config.openai_api_key):
         messages.error(request, "Ungültiger OpenAI API Key")
         return redirect("index")
 
-    if config.simulation_password_hash:
-        sim_pw = request.POST.get("sim_password", "")
-        if not config.check_simulation_password(sim_pw):
-            messages.error(request, "Falsches Passwort")
-            return redirect("index")
+    if not await _acheck_simulation_password(config, request):
+        messages.error(request, "Falsches Passwort")
+        return redirect("index")
 
-    try:
-        generate_ai_results(session_id, api_key=config.openai_api_key)
-        messages.success(request, "Simulation abgeschlossen.")
-    except Exception as exc:  # pragma: no cover - best effort
-        messages.error(request, f"Simulation fehlgeschlagen: {exc}")
+    _, created = await sync_to_async(enqueue_simulation)(session_id)
+    if created:
+        messages.success(request, "Simulation gestartet.")
+    else:
+        messages.info(request, "Simulation läuft bereits.")
 
     return redirect("index")
+
+
+async def simulation_status(request):
+    """Return the state of the current session's latest simulation as JSON."""
+    session_id = await _asession_id(request)
+    job = await alatest_job(session_id) if session_id else None
+    return JsonResponse(await sync_to_async(job_status)(job))
+
+
+async def stream_simulation(request):
+    """Run the simulation now and stream the answers as server-sent events.
+
+    Performs the same checks as :func:`run_simulation`; failures are returned
+    as JSON with an error status instead of a redirect. If no further
+    simulation may start right now, or the request is not served over ASGI,
+    the run is queued instead and its status is returned with status 202.
+    """
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+    session_id = await _asession_id(request)
+    config = await aget_config()
+    if not config.setup_complete or not session_id:
+        return JsonResponse({"error": "Keine Sitzung"}, status=400)
+
+    if not await acheck_openai_key(config.openai_api_key):
+        return JsonResponse({"error": "Ungültiger OpenAI API Key"}, status=400)
+
+    if not await _acheck_simulation_password(config, request):
+        return JsonResponse({"error": "Falsches Passwort"}, status=403)
+
+    if not isinstance(request, ASGIRequest):
+        # Under WSGI the generator would be consumed in one go, blocking the
+        # worker for the whole simulation; leave the run to simulation_worker
+        job, created = await sync_to_async(enqueue_simulation)(session_id)
+        if not created:
+            return JsonResponse({"error": "Simulation läuft bereits."}, status=409)
+        return JsonResponse(await sync_to_async(job_status)(job), status=202)
+
+    if not await sync_to_async(has_capacity)():
+        job, _ = await sync_to_async(enqueue_simulation)(session_id)
+        return JsonResponse(await sync_to_async(job_status)(job), status=202)
+
+    job = await sync_to_async(start_job)(session_id, f"{default_worker_name()}/stream")
+    if job is None:
+        return JsonResponse({"error": "Simulation läuft bereits."}, status=409)
+
+    response = StreamingHttpResponse(
+        stream_job(job, api_key=config.openai_api_key),
+        content_type="text/event-stream",
+    )
+    response["Cache-Control"] = "no-cache"
+    # Keep proxies such as nginx from buffering the stream
+    response["X-Accel-Buffering"] = "no"
+    return response
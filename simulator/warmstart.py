@@ -0,0 +1,166 @@
+"""Speculative preparation of simulations when files are uploaded.
+
+With ``AppConfig.prepare_on_upload`` every change to the files of a session
+schedules a :class:`~simulator.models.PreparedSimulation`. The
+``simulation_worker`` prepares it whenever no simulation is waiting: the files
+are extracted into the text cache and the base prompt is built. With
+``AppConfig.prepare_answers`` the answers of all levels are requested as
+well, which costs tokens even if the simulation is never started.
+
+A simulation started later takes over the prepared prompt and answers if
+they are based on the current files, prompts and settings (see
+:func:`fingerprint`); otherwise they are discarded. Prepared answers are used
+only once, so running the simulation again produces new answers.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from config.utils import get_config, load_prompts
+from .models import ContextFile, ExamFile, PreparedSimulation
+
+
+def answer_key(level: str, index: int | None) -> str:
+    """Return the key of a request's answer in ``PreparedSimulation.answers``."""
+    return f"{level}:{'' if index is None else index}"
+
+
+def fingerprint(session_id: str) -> str:
+    """Return a hash of everything a simulation of the session depends on.
+
+    Uploaded files are named by their content, so the names identify the
+    files.
+    """
+    language = get_config().language
+    payload = {
+        "exam": ExamFile.objects.filter(session_id=session_id)
+        .values_list("file", flat=True)
+        .first(),
+        "context": list(
+            ContextFile.objects.filter(session_id=session_id).values_list("file", flat=True)
+        ),
+        "language": language,
+        "prompts": load_prompts(language),
+        "model": getattr(settings, "OPENAI_MODEL", "gpt-4-1106-preview"),
+        "budget": getattr(settings, "OPENAI_PROMPT_TOKEN_BUDGET", None),
+        "per_task": getattr(settings, "SIMULATION_PER_TASK", False),
+    }
+    encoded = json.dumps(payload, sort_keys=True, ensure_ascii=False).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def schedule_preparation(session_id: str) -> bool:
+    """Queue the preparation of a session whose files changed.
+
+    Work prepared for the previous files is dropped. Returns ``False`` if
+    preparing is switched off or the session has no exam yet.
+    """
+    if not get_config().prepare_on_upload:
+        return False
+    if not ExamFile.objects.filter(session_id=session_id).exists():
+        PreparedSimulation.objects.filter(session_id=session_id).delete()
+        return False
+    fields = {
+        "status": PreparedSimulation.STATUS_PENDING,
+        "fingerprint": "",
+        "prompt": "",
+        "answers": {},
+        "usage": {},
+        "error": "",
+        "updated": timezone.now(),
+    }
+    # Update without reading first, like Session.refresh
+    if PreparedSimulation.objects.filter(session_id=session_id).update(**fields):
+        return True
+    try:
+        with transaction.atomic():
+            PreparedSimulation.objects.create(session_id=session_id, **fields)
+    except IntegrityError:
+        PreparedSimulation.objects.filter(session_id=session_id).update(**fields)
+    return True
+
+
+def claim_preparation() -> PreparedSimulation | None:
+    """Mark the oldest pending preparation as running and return it.
+
+    Preparations left running by a crashed worker are claimed again after
+    ``SIMULATION_JOB_TIMEOUT`` seconds.
+    """
+    timeout = getattr(settings, "SIMULATION_JOB_TIMEOUT", 600)
+    stale = timezone.now() - timedelta(seconds=timeout)
+    while True:
+        prepared = (
+            PreparedSimulation.objects.filter(
+                Q(status=PreparedSimulation.STATUS_PENDING)
+                | Q(status=PreparedSimulation.STATUS_RUNNING, updated__lt=stale)
+            )
+            .order_by("updated")
+            .first()
+        )
+        if prepared is None:
+            return None
+        now = timezone.now()
+        current = fingerprint(prepared.session_id)
+        # ``updated`` changes whenever the files change, so a claim made
+        # while a file was uploaded fails and the preparation stays pending
+        claimed = PreparedSimulation.objects.filter(
+            pk=prepared.pk, status=prepared.status, updated=prepared.updated
+        ).update(status=PreparedSimulation.STATUS_RUNNING, fingerprint=current, updated=now)
+        if claimed:
+            prepared.status = PreparedSimulation.STATUS_RUNNING
+            prepared.fingerprint = current
+            prepared.updated = now
+            return prepared
+
+
+def finish_preparation(
+    prepared: PreparedSimulation,
+    *,
+    prompt: str = "",
+    answers: dict | None = None,
+    usage: dict | None = None,
+    error: Exception | None = None,
+) -> bool:
+    """Store the outcome of a claimed preparation.
+
+    Returns ``False`` if the files changed or a simulation started in the
+    meantime; the outcome is then discarded.
+    """
+    if error is not None:
+        fields = {"status": PreparedSimulation.STATUS_FAILED, "error": str(error)}
+    else:
+        fields = {
+            "status": PreparedSimulation.STATUS_READY,
+            "prompt": prompt,
+            "answers": answers or {},
+            "usage": usage or {},
+        }
+    return bool(
+        PreparedSimulation.objects.filter(
+            pk=prepared.pk,
+            status=PreparedSimulation.STATUS_RUNNING,
+            updated=prepared.updated,
+        ).update(**fields)
+    )
+
+
+def take_preparation(session_id: str) -> PreparedSimulation | None:
+    """Remove the preparation of a session and return it if still valid."""
+    prepared = PreparedSimulation.objects.filter(session_id=session_id).first()
+    if prepared is None:
+        return None
+    PreparedSimulation.objects.filter(session_id=session_id).delete()
+    if (
+        prepared.status != PreparedSimulation.STATUS_READY
+        or prepared.fingerprint != fingerprint(session_id)
+    ):
+        return None
+    return prepared